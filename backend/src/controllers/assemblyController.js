@@ -99,6 +99,66 @@ const checkImageProgress = async (req, res) => {
   }
 };
 
+// Cancel an image generation, e.g. when the user navigates away
+const cancelImageGeneration = async (req, res) => {
+  const { taskId } = req.params;
+
+  if (!taskId) {
+    return res.status(400).json({
+      success: false,
+      error: 'Missing task ID'
+    });
+  }
+
+  try {
+    const response = await axios.delete(`http://localhost:9999/task/${taskId}`, {
+      timeout: 10000
+    });
+    res.status(response.status).json(response.data);
+  } catch (error) {
+    const status = error.response ? error.response.status : 500;
+    res.status(status).json({
+      success: false,
+      error: 'Failed to cancel image generation: ' + error.message
+    });
+  }
+};
+
+// Relay the Janus service's Server-Sent Events progress stream
+const streamImageProgress = async (req, res) => {
+  const { taskId } = req.params;
+
+  if (!taskId) {
+    return res.status(400).json({
+      success: false,
+      error: 'Missing task ID'
+    });
+  }
+
+  try {
+    const response = await axios.get(`http://localhost:9999/events/${taskId}`, {
+      responseType: 'stream'
+    });
+
+    res.set({
+      'Content-Type': 'text/event-stream',
+      'Cache-Control': 'no-cache',
+      'Connection': 'keep-alive'
+    });
+    res.flushHeaders();
+    response.data.pipe(res);
+
+    // Stop relaying when the browser goes away
+    req.on('close', () => response.data.destroy());
+  } catch (error) {
+    const status = error.response ? error.response.status : 500;
+    res.status(status).json({
+      success: false,
+      error: 'Failed to stream progress: ' + error.message
+    });
+  }
+};
+
 const getGeneratedImage = async (req, res) => {
   try {
     const { taskId } = req.params;
@@ -152,5 +212,7 @@ module.exports = {
   identifyComponents, 
   generateVisualization,
   checkImageProgress,   // Add this line
+  streamImageProgress,
+  cancelImageGeneration,
   getGeneratedImage     // Add this line
 };
\ No newline at end of file
@@ -30,5 +30,7 @@ router.post('/project/identify-components', projectController.identifyAndStoreCo
 // Update the visualize route to expect prompt
 router.post('/visualize', assemblyController.generateVisualization);
 router.get('/visualize/progress/:taskId', assemblyController.checkImageProgress);
+router.get('/visualize/events/:taskId', assemblyController.streamImageProgress);
+router.delete('/visualize/:taskId', assemblyController.cancelImageGeneration);
 router.get('/visualize/result/:taskId', assemblyController.getGeneratedImage);
 module.exports = router;
\ No newline at end of file
@@ -23,6 +23,10 @@ const MainInterface = () => {
   const [generatedImage, setGeneratedImage] = useState(null);
   const [isGeneratingImage, setIsGeneratingImage] = useState(false);
   const [imageGenerationError, setImageGenerationError] = useState(null);
+  // Task of the image being generated and its progress stream, so the
+  // generation can be cancelled if the user leaves before it finishes
+  const activeTaskRef = useRef(null);
+  const progressStreamRef = useRef(null);
 
   const { 
     currentProject, 
@@ -41,6 +45,26 @@ const MainInterface = () => {
     }
   }, []);
 
+  // Cancel an unfinished image generation when the user navigates away or
+  // closes the page, so the service doesn't keep generating it for nobody
+  useEffect(() => {
+    const cancelActiveTask = () => {
+      const taskId = activeTaskRef.current;
+      activeTaskRef.current = null;
+      progressStreamRef.current?.close();
+      if (!taskId) return;
+      fetch(`http://localhost:5003/api/assembly/visualize/${taskId}`, {
+        method: 'DELETE',
+        keepalive: true // Still sent while the page unloads
+      }).catch((error) => console.warn("Could not cancel image generation:", error));
+    };
+    window.addEventListener('pagehide', cancelActiveTask);
+    return () => {
+      window.removeEventListener('pagehide', cancelActiveTask);
+      cancelActiveTask();
+    };
+  }, []);
+
   const currentStep = currentProject?.current_step || 1;
 
   const isVisualizationRequest = (transcript) => {
@@ -288,11 +312,43 @@ const storeIdentifiedComponents = async (components) => {
       }
   
       const { taskId } = data;
+      activeTaskRef.current = taskId;
       setProcessingStatus("Generating image... (this may take a few minutes)");
   
+      // Follow progress on the event stream; resolves once the task has
+      // finished or the stream is unavailable, after which the polling loop
+      // below fetches the result (or takes over progress reporting)
+      const streamProgress = () => new Promise((resolve, reject) => {
+        const events = new EventSource(`http://localhost:5003/api/assembly/visualize/events/${taskId}`);
+        progressStreamRef.current = events;
+        events.addEventListener('progress', (event) => {
+          const progressData = JSON.parse(event.data);
+          setProcessingStatus(`Generating image... (${progressData.progress || 0}%)`);
+        });
+        events.addEventListener('completed', () => {
+          events.close();
+          resolve();
+        });
+        events.addEventListener('failed', (event) => {
+          events.close();
+          reject(new Error(JSON.parse(event.data).error || 'Image generation failed'));
+        });
+        events.addEventListener('cancelled', (event) => {
+          events.close();
+          const reason = JSON.parse(event.data).reason;
+          reject(new Error(`Image generation cancelled${reason ? ` (${reason})` : ''}`));
+        });
+        events.onerror = () => {
+          console.warn("Progress stream unavailable, falling back to polling");
+          events.close();
+          resolve();
+        };
+      });
+
       // Poll for progress
       const pollProgress = async () => {
-        while (true) {
+        await streamProgress();
+        while (activeTaskRef.current === taskId) { // Stops once the task is abandoned
           try {
             const progressResponse = await fetch(`http://localhost:5003/api/assembly/visualize/progress/${taskId}`);
             const progressData = await progressResponse.json();
@@ -337,8 +393,11 @@ const storeIdentifiedComponents = async (components) => {
                 }
                 throw new Error('Failed to fetch generated image: ' + errorText);
               }
-            } else if (progressData.error) {
-              throw new Error(progressData.error);
+            } else if (progressData.status === 'cancelled') {
+              const reason = progressData.reason;
+              throw new Error(`Image generation cancelled${reason ? ` (${reason})` : ''}`);
+            } else if (progressData.status === 'failed' || progressData.error) {
+              throw new Error(progressData.error || 'Image generation failed');
             }
             
             // Wait 5 seconds before polling again
@@ -358,6 +417,11 @@ const storeIdentifiedComponents = async (components) => {
         setImageGenerationError(`Error: ${error.message}`);
         setIsGeneratingImage(false); // Make sure to turn off the loading state
         setProcessingStatus(null);
+      }).finally(() => {
+        // Finished (or failed): nothing left to cancel
+        if (activeTaskRef.current === taskId) {
+          activeTaskRef.current = null;
+        }
       });
       
     } catch (error) {
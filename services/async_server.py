@@ -0,0 +1,306 @@
+"""
+Production HTTP server for the generation service, on aiohttp.
+
+``app.run()`` in server.py is Werkzeug's development server: one OS thread per
+connection, so every progress poll, health check and synchronous /generate
+(held open for minutes) ties up a thread. Here an asyncio event loop owns the
+connections, with keep-alive and a request size limit, and:
+
+- runs the Flask views on a bounded executor, so every route behaves as it
+  does under the development server while at most JANUS_REQUEST_THREADS
+  threads serve requests, however many connections are open;
+- waits for synchronous generations on the event loop: the view hands its
+  job over (see server.finish_sync_request) and the response is built once
+  the job is done, so a waiting client holds no thread;
+- streams /events/<task_id> from the event loop.
+
+Generation keeps running on the job queue's workers (and worker processes).
+On SIGTERM or SIGINT the service drains: /ready answers 503 and new
+generations are refused with 503, while polls are still served until the
+queued and running jobs are done (at most JANUS_DRAIN_SECONDS); then the
+server closes and the image index is saved.
+
+Usage (from the services directory):
+  python async_server.py
+"""
+
+import asyncio
+import collections
+import io
+import os
+import queue
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+from flask import jsonify
+
+import server
+
+HOST = os.environ.get("JANUS_HOST", "0.0.0.0")
+PORT = int(os.environ.get("JANUS_PORT", "9999"))
+# Threads running Flask views; waiting clients do not hold one
+REQUEST_THREADS = int(os.environ.get("JANUS_REQUEST_THREADS", "16"))
+# Idle seconds before a keep-alive connection is closed
+KEEPALIVE_SECONDS = float(os.environ.get("JANUS_KEEPALIVE_SECONDS", "75"))
+# Longest wait for queued and running generations on shutdown
+DRAIN_SECONDS = float(os.environ.get("JANUS_DRAIN_SECONDS", "600"))
+# Grace period for responses still being written once the drain is over
+SHUTDOWN_SECONDS = 10.0
+
+# Hop-by-hop and length headers are set by aiohttp itself
+SKIPPED_HEADERS = {"connection", "keep-alive", "transfer-encoding", "content-length"}
+
+request_executor = ThreadPoolExecutor(REQUEST_THREADS, thread_name_prefix="http-request")
+
+
+class LoopSubscriber:
+    """
+    TaskEventBus subscriber waking a coroutine on the event loop. Keeps the
+    latest ``max_queued`` snapshots, like the bus's own queues.
+    """
+
+    def __init__(self, loop, max_queued: int):
+        self._loop = loop
+        self._snapshots = collections.deque(maxlen=max_queued)
+        self._ready = asyncio.Event()
+
+    def put_nowait(self, snapshot):
+        self._snapshots.append(snapshot)
+        try:
+            self._loop.call_soon_threadsafe(self._ready.set)
+        except RuntimeError:
+            pass  # The loop is closed
+
+    def get_nowait(self):
+        try:
+            return self._snapshots.popleft()
+        except IndexError:
+            raise queue.Empty
+
+    async def get(self, timeout: float):
+        """Return the next snapshot, raising asyncio.TimeoutError after ``timeout`` seconds."""
+        while not self._snapshots:
+            self._ready.clear()
+            if self._snapshots:
+                break
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        return self._snapshots.popleft()
+
+
+def wsgi_environ(request, body: bytes):
+    """Build the WSGI environ of an aiohttp request."""
+    host, _, port = (request.host or f"{HOST}:{PORT}").partition(":")
+    environ = {
+        "REQUEST_METHOD": request.method,
+        "SCRIPT_NAME": "",
+        # WSGI carries the decoded path as latin-1 characters
+        "PATH_INFO": request.path.encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": request.query_string,
+        "SERVER_NAME": host,
+        "SERVER_PORT": port or str(PORT),
+        "SERVER_PROTOCOL": f"HTTP/{request.version.major}.{request.version.minor}",
+        "REMOTE_ADDR": request.remote or "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": request.scheme,
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in request.headers.items():
+        key = name.upper().replace("-", "_")
+        if key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[key] = value
+            continue
+        key = f"HTTP_{key}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def run_wsgi(wsgi_app, environ):
+    """Call a WSGI application; returns (status line, headers, body)."""
+    started = {}
+    chunks = []
+
+    def start_response(status, headers, exc_info=None):
+        started["status"], started["headers"] = status, headers
+        return chunks.append
+
+    result = wsgi_app(environ, start_response)
+    try:
+        chunks.extend(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return started["status"], started["headers"], b"".join(chunks)
+
+
+def finish_deferred(environ, finish, job):
+    """Build the response of a synchronous request whose job is done, like its view would."""
+    app = server.app
+    with app.request_context(environ):
+        try:
+            rv = finish(lambda: job.wait(0))
+        except Exception as e:
+            print(f"Error during generation: {e}")
+            rv = jsonify({
+                "error": str(e),
+                "request_id": environ.get("HTTP_X_REQUEST_ID", "none")
+            }), 500
+        response = app.process_response(app.make_response(rv))
+        return run_wsgi(response, environ)
+
+
+def to_aiohttp(status: str, headers, body: bytes):
+    code, _, reason = status.partition(" ")
+    response = web.Response(status=int(code), reason=reason or None, body=body)
+    for name, value in headers:
+        if name.lower() not in SKIPPED_HEADERS:
+            response.headers.add(name, value)
+    return response
+
+
+def client_gone(request) -> bool:
+    transport = request.transport
+    return transport is None or transport.is_closing()
+
+
+async def wait_for_job(request, job) -> bool:
+    """
+    Wait for a job on the event loop. Returns False if the client went away
+    before the job was done.
+    """
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+
+    def on_done(_job):
+        loop.call_soon_threadsafe(lambda: done.done() or done.set_result(None))
+
+    job.add_done_callback(on_done)
+    while True:
+        try:
+            await asyncio.wait_for(asyncio.shield(done), server.DISCONNECT_POLL_SECONDS)
+            return True
+        except asyncio.TimeoutError:
+            if client_gone(request):
+                return False
+
+
+async def handle_flask(request):
+    """Serve a request with the Flask app, awaiting handed-over sync generations."""
+    body = await request.read()
+    environ = wsgi_environ(request, body)
+    deferred = []
+
+    def defer_job(job, cancel_key, finish):
+        deferred.append((job, cancel_key, finish))
+        return "", 204  # Replaced by the response built once the job is done
+
+    environ["janus.defer_job"] = defer_job
+    loop = asyncio.get_running_loop()
+    status, headers, body = await loop.run_in_executor(request_executor, run_wsgi, server.app, environ)
+    if deferred:
+        job, cancel_key, finish = deferred[0]
+        if not await wait_for_job(request, job):
+            server.abandon_job(job, cancel_key)
+            return web.Response(status=499, reason="Client Closed Request")
+        status, headers, body = await loop.run_in_executor(request_executor, finish_deferred, environ, finish, job)
+    return to_aiohttp(status, headers, body)
+
+
+async def stream_task_events(request):
+    """/events/<task_id> (see server.stream_task_events), streamed from the event loop."""
+    task_id = request.match_info["task_id"]
+    subscriber = LoopSubscriber(asyncio.get_running_loop(), server.task_events.max_queued)
+    # Subscribe before reading the current state so no update is missed
+    server.task_events.subscribe(task_id, subscriber)
+    try:
+        task_data = server.task_store.get(task_id)
+        if task_data is None:
+            return web.json_response({"error": "Task not found", "task_id": task_id}, status=404,
+                                     headers={"Access-Control-Allow-Origin": "*"})
+
+        response = web.StreamResponse(headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            "Access-Control-Allow-Origin": "*",
+        })
+        await response.prepare(request)
+        snapshot = task_data
+        while True:
+            event, message = server.task_event_message(task_id, snapshot)
+            await response.write(message.encode("utf-8"))
+            if event != "progress":
+                break
+            idle = 0.0
+            while True:
+                try:
+                    snapshot = await subscriber.get(server.event_stream_wait())
+                    break
+                except asyncio.TimeoutError:
+                    refreshed = server.refreshed_task_snapshot(task_id, snapshot)
+                    if refreshed is not None:
+                        snapshot = refreshed
+                        break
+                    idle += server.event_stream_wait()
+                    if idle >= server.EVENT_STREAM_KEEPALIVE:
+                        idle = 0.0
+                        await response.write(b": keep-alive\n\n")
+        await response.write_eof()
+        return response
+    finally:
+        server.task_events.unsubscribe(task_id, subscriber)
+
+
+def create_app():
+    app = web.Application(client_max_size=server.MAX_REQUEST_BYTES)
+    app.router.add_get("/events/{task_id}", stream_task_events)
+    app.router.add_route("*", "/{path:.*}", handle_flask)
+    return app
+
+
+async def drain():
+    """Refuse new generations and wait for the queued and running ones."""
+    server.draining.set()
+    stats = server.generation_queue.stats()
+    print(f"Draining: waiting for {stats['queued']} queued and {stats['running']} running generation(s)...")
+    loop = asyncio.get_running_loop()
+    if await loop.run_in_executor(None, server.generation_queue.join, DRAIN_SECONDS):
+        print("✅ All generations finished")
+    else:
+        print(f"⚠️ Generations still running after {DRAIN_SECONDS}s, shutting down anyway")
+
+
+async def serve():
+    runner = web.AppRunner(create_app(), keepalive_timeout=KEEPALIVE_SECONDS, shutdown_timeout=SHUTDOWN_SECONDS)
+    await runner.setup()
+    await web.TCPSite(runner, HOST, PORT).start()
+    print(f"Serving on {HOST}:{PORT} with {REQUEST_THREADS} request threads")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    await stop.wait()
+
+    await drain()
+    await runner.cleanup()
+    request_executor.shutdown(wait=False)
+    if not server.image_store.flush(timeout=SHUTDOWN_SECONDS):
+        print("⚠️ Some generated images were not written to disk")
+    server.image_index.save()
+    print("Janus Image Generation service stopped")
+
+
+def main():
+    print(f"Janus Image Generation service starting on port {PORT}...")
+    server.start_backend()
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
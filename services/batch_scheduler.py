@@ -0,0 +1,409 @@
+"""
+Continuous batching scheduler for Janus image token generation.
+
+Every image needs ~576 sequential decode steps, each of which runs the language
+model on a conditional and an unconditional row for classifier-free guidance.
+Running one image at a time keeps the CPU matmuls at batch 2, so instead a
+single scheduler thread owns the model and advances every active request in one
+batched forward pass per step. New requests are prefilled and join the batch at
+step boundaries; finished requests leave it and hand their tokens back to the
+thread that submitted them. Cancelled requests, or those past their deadline,
+leave at the next step boundary.
+"""
+
+import collections
+import random
+import threading
+import time
+
+import torch
+
+from cancellation import GenerationCancelled
+from cfg_schedule import CFGSchedule
+from decode_engine import DecodeEngine
+from kv_cache import cache_layers, concat_rows, select_rows
+from metrics import BATCH_SIZE, DECODE_STEP_SECONDS, STAGE_SECONDS
+from prefix_cache import PrefixCache
+
+# Decode steps captured by a profiler trace after the prefill; a trace of all
+# 576 steps runs into gigabytes for the real model
+PROFILE_STEPS = 32
+
+
+class GenerationSequence:
+    """
+    State of one image inside the shared decode batch.
+
+    A sequence occupies two consecutive batch rows: the conditional prompt and
+    the unconditional (padded) prompt used for classifier-free guidance. Once
+    its ``cfg_schedule`` cuts guidance off, the unconditional row is dropped
+    and the sequence continues on a single row.
+
+    Sampling uses a per-sequence random generator seeded with ``seed`` (a random
+    seed is picked when none is given), so a request's tokens do not depend on
+    which other requests happen to share the batch.
+
+    With a ``cancel_token`` (see cancellation) the sequence stops once the
+    token is cancelled or its deadline passes, and ``wait`` raises
+    GenerationCancelled.
+    """
+
+    def __init__(
+            self,
+            input_ids,
+            task_id=None,
+            temperature: float = 1.0,
+            cfg_weight: float = 5.0,
+            image_token_num_per_image: int = 576,
+            seed=None,
+            on_progress=None,
+            cfg_schedule: CFGSchedule = None,
+            profile_path=None,
+            cancel_token=None,
+    ):
+        self.input_ids = list(input_ids)
+        self.task_id = task_id
+        self.temperature = temperature
+        self.cfg_schedule = cfg_schedule if cfg_schedule is not None else CFGSchedule(cfg_weight)
+        self.cfg_weight = self.cfg_schedule.cfg_weight
+        self.image_token_num_per_image = image_token_num_per_image
+        self.seed = seed if seed is not None else random.getrandbits(63)
+        self.on_progress = on_progress
+        self.generation_id = f"gen-{task_id if task_id else 'sync'}-{int(time.time())}"
+
+        self.generated_tokens = torch.zeros((1, image_token_num_per_image), dtype=torch.int)
+        self.step = 0  # Number of image tokens sampled so far
+        self.position = len(self.input_ids)  # Position id of the next input token
+        self.rows = 2  # Batch rows in use: cond + uncond, or cond only after the CFG cutoff
+        self.last_progress_update = 0
+        self.generator = None  # Created on the model's device when admitted
+        self.submitted_at = None
+        self.profile_path = profile_path  # Chrome trace of the batch while this sequence runs
+        self.cancel_token = cancel_token
+
+        self.error = None
+        self._done = threading.Event()
+
+    @property
+    def finished(self):
+        return self.step >= self.image_token_num_per_image
+
+    @property
+    def cancel_reason(self):
+        """Why the sequence must stop early, or None."""
+        return self.cancel_token.reason if self.cancel_token is not None else None
+
+    @property
+    def guided(self):
+        """Whether the next token still needs the unconditional row."""
+        return self.cfg_schedule.guided(self.step, self.image_token_num_per_image)
+
+    @property
+    def current_cfg_weight(self):
+        """Guidance weight for the next token."""
+        return self.cfg_schedule.weight(self.step, self.image_token_num_per_image)
+
+    def wait(self, timeout=None):
+        """
+        Block until the sequence has left the batch and return its image tokens.
+        Re-raises any error raised while generating it.
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"Generation {self.generation_id} did not finish in time")
+        if self.error is not None:
+            raise self.error
+        return self.generated_tokens
+
+    def _complete(self, error=None):
+        self.error = error
+        self._done.set()
+
+
+class BatchScheduler:
+    """
+    Runs the image token decode loop for all in-flight requests at once.
+
+    Requests are submitted with ``submit`` from any thread. The scheduler thread
+    prefills newly arrived sequences, left pads their KV caches to the length of
+    the running batch and then advances every sequence by one token per forward
+    pass, so up to ``max_batch_size`` images share each step. The batch state
+    lives in a DecodeEngine with preallocated buffers.
+
+    With ``use_prefix_cache`` the KV entries of the shared template prefix and
+    of the unconditional row are reused across requests (see prefix_cache).
+    With ``compile_decode`` the decode step runs through torch.compile (see
+    decode_engine).
+    """
+
+    def __init__(self, mmgpt, vl_chat_processor, max_batch_size: int = 4, use_prefix_cache: bool = True,
+                 compile_decode: bool = False):
+        self.mmgpt = mmgpt
+        self.pad_id = vl_chat_processor.pad_id
+        self.device = next(mmgpt.parameters()).device
+        self.max_batch_size = max(1, max_batch_size)
+        self.prefix_cache = PrefixCache(mmgpt, vl_chat_processor) if use_prefix_cache else None
+
+        self._pending = collections.deque()
+        self._active = []
+        # Batched KV cache and step buffers
+        self.engine = DecodeEngine(mmgpt, self.max_batch_size, compile=compile_decode)
+        self._condition = threading.Condition()
+        self._thread = None
+        self._closed = False
+        self._step_seconds = None  # Moving average of one decode step
+        self._profiler = None
+        self._profiled = None  # Sequence the running profiler trace belongs to
+
+    def submit(self, sequence: GenerationSequence) -> GenerationSequence:
+        """Queue a sequence; it joins the batch at the next step boundary."""
+        sequence.submitted_at = time.perf_counter()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Batch scheduler is closed")
+            self._pending.append(sequence)
+            self._condition.notify()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+                self._thread.start()
+        return sequence
+
+    def close(self, timeout: float = None):
+        """
+        Refuse new sequences and stop the scheduler thread once the queued
+        and active ones are done, waiting up to ``timeout`` seconds for it.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def stats(self):
+        """Return a snapshot of the scheduler's queue and batch sizes."""
+        with self._condition:
+            return {
+                "pending": len(self._pending),
+                "active": len(self._active),
+                "max_batch_size": self.max_batch_size,
+                "tokens_per_second": self.tokens_per_second(),
+            }
+
+    def tokens_per_second(self):
+        """
+        Measured decode rate of a single sequence, or None before the first
+        step. Every active sequence advances by one token per step.
+        """
+        if not self._step_seconds:
+            return None
+        return 1.0 / self._step_seconds
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._active:
+                    if self._closed:
+                        return
+                    self._condition.wait()
+                joining = []
+                while self._pending and len(self._active) + len(joining) < self.max_batch_size:
+                    seq = self._pending.popleft()
+                    if seq.cancel_reason is not None:
+                        self._cancel(seq)
+                    else:
+                        joining.append(seq)
+
+            if joining:
+                self._admit(joining)
+            if self._active:
+                try:
+                    batch_size = len(self._active)
+                    step_start = time.perf_counter()
+                    self._step()
+                    elapsed = time.perf_counter() - step_start
+                    DECODE_STEP_SECONDS.labels(batch_size).observe(elapsed)
+                    if self._step_seconds is None:
+                        self._step_seconds = elapsed
+                    else:
+                        self._step_seconds = 0.9 * self._step_seconds + 0.1 * elapsed
+                except Exception as e:
+                    print(f"Batch decode step failed, aborting {len(self._active)} sequence(s): {e}")
+                    for seq in self._active:
+                        seq._complete(e)
+                    self._reset_batch()
+                    self._stop_profile()
+
+    @torch.inference_mode()
+    def _admit(self, joining):
+        """Prefill each joining sequence and merge its KV cache into the batch."""
+        if self._active:
+            layers, mask = self.engine.layers(), self.engine.attention_mask()
+        else:
+            layers, mask = None, None
+
+        admitted = []
+        for seq in joining:
+            STAGE_SECONDS.labels("batch_wait").observe(time.perf_counter() - seq.submitted_at)
+            if seq.profile_path and self._profiler is None:
+                self._start_profile(seq)
+            try:
+                with STAGE_SECONDS.labels("prefill").time():
+                    seq_layers, seq_mask = self._prefill(seq)
+            except Exception as e:
+                print(f"[{seq.generation_id}] Prefill failed: {e}")
+                seq._complete(e)
+                if seq is self._profiled:
+                    self._stop_profile()
+                continue
+
+            if seq.finished or seq.cancel_reason is not None:
+                if seq.finished:
+                    seq._complete()
+                else:
+                    self._cancel(seq)
+                if seq is self._profiled:
+                    self._stop_profile()
+                continue
+            if not seq.guided:
+                seq_layers, seq_mask = select_rows(seq_layers, seq_mask, [0])
+                seq.rows = 1
+
+            if layers is None:
+                layers, mask = seq_layers, seq_mask
+            else:
+                layers, mask = concat_rows(layers, mask, seq_layers, seq_mask)
+            admitted.append(seq)
+
+        if admitted:
+            self._active.extend(admitted)
+            self.engine.load(layers, mask, self._active)
+            BATCH_SIZE.set(len(self._active))
+            print(f"Batch now has {len(self._active)} active sequence(s)")
+
+    def _prefill(self, seq):
+        """Run the prompt through the model and sample the first image token."""
+        print(f"[{seq.generation_id}] Prefilling prompt ({len(seq.input_ids)} tokens)...")
+        seq.generator = torch.Generator(device=self.device).manual_seed(seq.seed)
+
+        prefilled = self.prefix_cache.prefill(seq.input_ids) if self.prefix_cache is not None else None
+        if prefilled is not None:
+            layers, last_hidden_state = prefilled
+        else:
+            input_ids = torch.LongTensor(seq.input_ids).to(self.device)
+
+            tokens = torch.zeros((2, len(input_ids)), dtype=torch.int).to(self.device)
+            tokens[0, :] = input_ids  # Conditional
+            tokens[1, :] = input_ids.clone()
+            tokens[1, 1:-1] = self.pad_id  # Unconditional
+
+            inputs_embeds = self.mmgpt.language_model.get_input_embeddings()(tokens)
+            outputs = self.mmgpt.language_model.model(inputs_embeds=inputs_embeds, use_cache=True)
+            layers, last_hidden_state = cache_layers(outputs.past_key_values), outputs.last_hidden_state[:, -1, :]
+
+        logits = self.mmgpt.gen_head(last_hidden_state)
+        self._record_tokens([seq], self.engine.sample(logits, [seq]))
+
+        attention_mask = torch.ones((2, len(seq.input_ids)), dtype=torch.long, device=self.device)
+        return layers, attention_mask
+
+    @torch.inference_mode()
+    def _step(self):
+        """Advance every active sequence by one image token."""
+        active = self._active
+        tokens = self.engine.step(active)
+        for seq in active:
+            seq.position += 1
+        self._record_tokens(active, tokens)
+
+        if self._profiled is not None and self._profiled.step > PROFILE_STEPS:
+            self._stop_profile()
+        if any(seq.finished or seq.cancel_reason is not None or (seq.rows == 2 and not seq.guided)
+               for seq in active):
+            self._retire()
+
+    def _record_tokens(self, sequences, tokens):
+        for seq, token in zip(sequences, tokens):
+            seq.generated_tokens[0, seq.step] = token
+            seq.step += 1
+            self._report_progress(seq)
+
+    def _report_progress(self, seq):
+        # Only report when the percentage has changed significantly
+        current_percentage = int(100 * (seq.step / seq.image_token_num_per_image))
+        if current_percentage > seq.last_progress_update + 4:  # Update every 5% progress
+            seq.last_progress_update = current_percentage
+            print(f"[{seq.generation_id}] Generating token {seq.step}/{seq.image_token_num_per_image}... "
+                  f"({current_percentage}%)")
+            if seq.on_progress is not None:
+                try:
+                    seq.on_progress(seq.step, seq.image_token_num_per_image)
+                except Exception as e:
+                    print(f"[{seq.generation_id}] Progress callback failed: {e}")
+
+    def _retire(self):
+        """
+        Remove finished and cancelled sequences from the batch and wake their
+        submitters, and drop the unconditional row of sequences past their CFG
+        cutoff.
+        """
+        leaving = [seq for seq in self._active if seq.finished or seq.cancel_reason is not None]
+        remaining = [seq for seq in self._active if seq not in leaving]
+        if remaining:
+            keep_rows = []
+            row = 0
+            for seq in self._active:
+                if seq not in leaving:
+                    keep_rows.append(row)  # Conditional
+                    if seq.rows == 2 and seq.guided:
+                        keep_rows.append(row + 1)  # Unconditional
+                row += seq.rows
+            layers, mask = select_rows(self.engine.layers(), self.engine.attention_mask(), keep_rows)
+            for seq in remaining:
+                seq.rows = 2 if seq.rows == 2 and seq.guided else 1
+            self._active = remaining
+            self.engine.load(layers, mask, self._active)
+            BATCH_SIZE.set(len(self._active))
+        else:
+            self._reset_batch()
+
+        if self._profiled in leaving:
+            self._stop_profile()
+        for seq in leaving:
+            if seq.finished:
+                seq._complete()
+            else:
+                self._cancel(seq)
+
+    def _cancel(self, seq):
+        reason = seq.cancel_reason
+        print(f"[{seq.generation_id}] Stopped at token {seq.step}/{seq.image_token_num_per_image}: {reason}")
+        seq._complete(GenerationCancelled(reason))
+
+    def _start_profile(self, seq):
+        """
+        Trace the scheduler thread (the whole batch) for the prefill and first
+        PROFILE_STEPS decode steps of ``seq``.
+        """
+        from torch.profiler import ProfilerActivity, profile
+
+        print(f"[{seq.generation_id}] Capturing profiler trace to {seq.profile_path}")
+        self._profiler = profile(activities=[ProfilerActivity.CPU], record_shapes=True)
+        self._profiler.__enter__()
+        self._profiled = seq
+
+    def _stop_profile(self):
+        if self._profiler is None:
+            return
+        profiler, seq = self._profiler, self._profiled
+        self._profiler, self._profiled = None, None
+        try:
+            profiler.__exit__(None, None, None)
+            profiler.export_chrome_trace(seq.profile_path)
+            print(f"[{seq.generation_id}] Profiler trace written to {seq.profile_path}")
+        except Exception as e:
+            print(f"[{seq.generation_id}] Could not write profiler trace: {e}")
+
+    def _reset_batch(self):
+        self._active = []
+        self.engine.load(None, None, [])
+        BATCH_SIZE.set(0)
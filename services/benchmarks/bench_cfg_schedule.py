@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Latency/quality comparison of classifier-free guidance schedules.
+
+Generates the same prompts with the same seeds under each schedule in
+cfg_schedule.py and compares them with constant guidance (the original
+behaviour): token loop time, speedup, token agreement, mean absolute pixel
+error and PSNR. Seeded sampling draws the same noise per token regardless of
+the schedule, so differences come from the guidance alone.
+
+Usage (from the services directory):
+  python benchmarks/bench_cfg_schedule.py
+  python benchmarks/bench_cfg_schedule.py --schedules constant cutoff_50 cosine_cutoff_75 --output-dir cfg_report
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from common import DEFAULT_PROMPTS, add_model_arguments, decode_image, encode_prompt, load_benchmark_model, psnr
+
+from batch_scheduler import BatchScheduler, GenerationSequence
+from cfg_schedule import CFGSchedule
+
+# Schedules by name, as CFGSchedule keyword arguments (cfg_weight comes from --cfg-weight)
+SCHEDULES = {
+    "constant": {},
+    "cutoff_75": {"cutoff": 0.75},
+    "cutoff_50": {"cutoff": 0.5},
+    "linear_cutoff_75": {"decay": "linear", "final_weight": 1.0, "cutoff": 0.75},
+    "cosine_cutoff_75": {"decay": "cosine", "final_weight": 1.0, "cutoff": 0.75},
+    "cosine_cutoff_50": {"decay": "cosine", "final_weight": 1.0, "cutoff": 0.5},
+}
+
+
+def run_schedule(mmgpt, vl_chat_processor, name, cfg_weight, prompts, seed, output_dir):
+    """Generate every prompt with one schedule and save images and timings."""
+    import PIL.Image
+
+    schedule = CFGSchedule(cfg_weight, **SCHEDULES[name])
+    scheduler = BatchScheduler(mmgpt, vl_chat_processor, max_batch_size=1)
+    schedule_dir = os.path.join(output_dir, name)
+    os.makedirs(schedule_dir, exist_ok=True)
+
+    images = []
+    for index, prompt in enumerate(prompts):
+        start = time.time()
+        sequence = scheduler.submit(GenerationSequence(
+            encode_prompt(vl_chat_processor, prompt), seed=seed + index, cfg_schedule=schedule
+        ))
+        tokens = sequence.wait()
+        token_seconds = time.time() - start
+        image = decode_image(mmgpt, tokens)
+
+        image_path = os.path.join(schedule_dir, f"image_{index}.png")
+        PIL.Image.fromarray(image).save(image_path)
+        images.append({
+            "prompt": prompt,
+            "seed": seed + index,
+            "tokens": tokens[0].tolist(),
+            "image_path": image_path,
+            "token_seconds": round(token_seconds, 3),
+            "ms_per_token": round(1000 * token_seconds / tokens.shape[1], 2),
+        })
+        print(f"[{name}] image {index}: {token_seconds:.1f}s")
+
+    return {
+        "schedule": schedule.describe(),
+        "guided_tokens": schedule.end(sequence.image_token_num_per_image),
+        "images": images,
+    }
+
+
+def compare(results, reference):
+    """Add latency and quality metrics against the reference schedule to every result."""
+    import PIL.Image
+
+    ref_images = results[reference]["images"]
+    for result in results.values():
+        for image, ref in zip(result["images"], ref_images):
+            a = np.asarray(PIL.Image.open(image["image_path"]))
+            b = np.asarray(PIL.Image.open(ref["image_path"]))
+            image["token_agreement"] = round(float(np.mean(np.array(image["tokens"]) == np.array(ref["tokens"]))), 4)
+            image["mean_abs_error"] = round(float(np.mean(np.abs(a.astype(np.float64) - b))), 2)
+            image["psnr_db"] = round(psnr(a, b), 2)
+
+        images = result["images"]
+        token_seconds = float(np.mean([i["token_seconds"] for i in images]))
+        ref_seconds = float(np.mean([i["token_seconds"] for i in ref_images]))
+        result["summary"] = {
+            "mean_token_seconds": round(token_seconds, 2),
+            "speedup": round(ref_seconds / token_seconds, 3),
+            "mean_token_agreement": round(float(np.mean([i["token_agreement"] for i in images])), 4),
+            "mean_abs_error": round(float(np.mean([i["mean_abs_error"] for i in images])), 2),
+            "mean_psnr_db": round(float(np.mean([i["psnr_db"] for i in images])), 2),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--schedules", nargs="+", default=list(SCHEDULES), choices=list(SCHEDULES))
+    parser.add_argument("--cfg-weight", type=float, default=5.0)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--prompts", nargs="+", default=DEFAULT_PROMPTS)
+    parser.add_argument("--output-dir", default="cfg_schedule_report")
+    add_model_arguments(parser)
+    args = parser.parse_args()
+
+    mmgpt, vl_chat_processor = load_benchmark_model(model=args.model, standin_size=args.standin_size)
+
+    names = list(dict.fromkeys(["constant"] + args.schedules))
+    results = {}
+    for name in names:
+        print(f"Running CFG schedule {name}...")
+        results[name] = run_schedule(
+            mmgpt, vl_chat_processor, name, args.cfg_weight, args.prompts, args.seed, args.output_dir
+        )
+
+    compare(results, "constant")
+    report_path = os.path.join(args.output_dir, "report.json")
+    with open(report_path, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"\n{'schedule':>18} {'guided':>7} {'s/image':>8} {'speedup':>8} {'tokens=':>8} {'PSNR':>7}")
+    for name, result in results.items():
+        s = result["summary"]
+        print(f"{name:>18} {result['guided_tokens']:>7} {s['mean_token_seconds']:>8} {s['speedup']:>8} "
+              f"{s['mean_token_agreement']:>8} {s['mean_psnr_db']:>7}")
+    print(f"Report written to {os.path.abspath(report_path)}")
+
+
+if __name__ == "__main__":
+    main()
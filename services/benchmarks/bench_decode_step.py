@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Per-step latency and allocation benchmark for the image token decode loop.
+
+Compares the original eager loop (dynamic past_key_values, torch.cat for the
+cond/uncond pair, softmax + multinomial) with DecodeEngine (preallocated KV
+cache, reusable step buffers, fused CFG/temperature/sampling), and with
+--compile also with the engine's torch.compile'd step. Compiling happens in
+the first steps of the compiled variants, which are not timed.
+
+Usage (from the services directory):
+  python benchmarks/bench_decode_step.py --steps 64
+  python benchmarks/bench_decode_step.py --steps 64 --output decode_step.json
+  python benchmarks/bench_decode_step.py --steps 64 --batch 4 --compile
+"""
+
+import argparse
+import json
+import os
+import statistics
+import time
+
+import torch
+
+from common import DEFAULT_PROMPTS, add_model_arguments, encode_prompt, load_benchmark_model
+
+from batch_scheduler import GenerationSequence
+from decode_engine import DecodeEngine
+from kv_cache import cache_layers
+
+PROMPT = DEFAULT_PROMPTS[0]
+# Untimed first steps of compiled variants: compiling for the batch's shapes
+COMPILE_WARMUP_STEPS = 2
+
+
+def prefill(mmgpt, vl_chat_processor, input_ids, copies=1):
+    """Prefill ``copies`` cond/uncond pairs; returns the model outputs."""
+    input_ids = torch.LongTensor(input_ids)
+    tokens = torch.zeros((2 * copies, len(input_ids)), dtype=torch.int)
+    for i in range(copies):
+        tokens[2 * i, :] = input_ids
+        tokens[2 * i + 1, :] = input_ids
+        tokens[2 * i + 1, 1:-1] = vl_chat_processor.pad_id
+    inputs_embeds = mmgpt.language_model.get_input_embeddings()(tokens)
+    return mmgpt.language_model.model(inputs_embeds=inputs_embeds, use_cache=True)
+
+
+def baseline_steps(mmgpt, vl_chat_processor, input_ids, steps, cfg_weight=5.0, temperature=1.0):
+    """
+    Generator running the original generate_cpu loop body one step at a time.
+    """
+    outputs = prefill(mmgpt, vl_chat_processor, input_ids)
+    next_token = torch.zeros((1, 1), dtype=torch.long)
+    for _ in range(steps):
+        next_token = torch.cat([next_token.unsqueeze(dim=1), next_token.unsqueeze(dim=1)], dim=1).view(-1)
+        inputs_embeds = mmgpt.prepare_gen_img_embeds(next_token).unsqueeze(dim=1)
+        outputs = mmgpt.language_model.model(
+            inputs_embeds=inputs_embeds,
+            use_cache=True,
+            past_key_values=outputs.past_key_values
+        )
+        logits = mmgpt.gen_head(outputs.last_hidden_state[:, -1, :])
+        logit_cond = logits[0:1, :]
+        logit_uncond = logits[1:2, :]
+        logits = logit_uncond + cfg_weight * (logit_cond - logit_uncond)
+        probs = torch.softmax(logits / temperature, dim=-1)
+        next_token = torch.multinomial(probs, num_samples=1)
+        yield
+
+
+def engine_steps(mmgpt, vl_chat_processor, input_ids, steps, batch=1, compile=False):
+    """Generator running DecodeEngine.step one step at a time."""
+    outputs = prefill(mmgpt, vl_chat_processor, input_ids, copies=batch)
+    sequences = []
+    for i in range(batch):
+        seq = GenerationSequence(input_ids, seed=i, image_token_num_per_image=steps + 1)
+        seq.generator = torch.Generator().manual_seed(seq.seed)
+        seq.step = 1
+        sequences.append(seq)
+
+    engine = DecodeEngine(mmgpt, max_sequences=batch, compile=compile)
+    attention_mask = torch.ones((2 * batch, len(input_ids)), dtype=torch.long)
+    engine.load(cache_layers(outputs.past_key_values), attention_mask, sequences)
+    for _ in range(steps):
+        engine.step(sequences)
+        yield
+
+
+def measure_latency(step_iter):
+    timings = []
+    while True:
+        start = time.perf_counter()
+        try:
+            next(step_iter)
+        except StopIteration:
+            break
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def measure_allocations(step_iter, steps):
+    """Return (allocating ops, allocated bytes) per step from the torch profiler."""
+    from torch.profiler import ProfilerActivity, profile
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        for _ in range(steps):
+            next(step_iter)
+    allocations = [e.cpu_memory_usage for e in prof.events() if e.cpu_memory_usage > 0]
+    return len(allocations) / steps, sum(allocations) / steps
+
+
+def summarize(timings):
+    timings_ms = sorted(t * 1000 for t in timings)
+    return {
+        "steps": len(timings_ms),
+        "mean_ms": round(statistics.mean(timings_ms), 3),
+        "p50_ms": round(timings_ms[len(timings_ms) // 2], 3),
+        "p95_ms": round(timings_ms[min(len(timings_ms) - 1, int(len(timings_ms) * 0.95))], 3),
+    }
+
+
+@torch.inference_mode()
+def run(mmgpt, vl_chat_processor, steps, profile_steps, batch, compile=False):
+    input_ids = encode_prompt(vl_chat_processor, PROMPT)
+    results = {}
+
+    variants = {
+        "baseline": lambda n: baseline_steps(mmgpt, vl_chat_processor, input_ids, n),
+        "engine": lambda n: engine_steps(mmgpt, vl_chat_processor, input_ids, n),
+    }
+    if batch > 1:
+        variants[f"engine_batch{batch}"] = lambda n: engine_steps(mmgpt, vl_chat_processor, input_ids, n, batch)
+    if compile:
+        variants["engine_compiled"] = lambda n: engine_steps(mmgpt, vl_chat_processor, input_ids, n, compile=True)
+        if batch > 1:
+            variants[f"engine_compiled_batch{batch}"] = lambda n: engine_steps(
+                mmgpt, vl_chat_processor, input_ids, n, batch, compile=True
+            )
+
+    for name, make_steps in variants.items():
+        print(f"Benchmarking {name} ({steps} steps)...")
+        warmup_steps = COMPILE_WARMUP_STEPS if "compiled" in name else 0
+        step_iter = make_steps(warmup_steps + steps)
+        for _ in range(warmup_steps):
+            next(step_iter)
+        summary = summarize(measure_latency(step_iter))
+
+        step_iter = make_steps(warmup_steps + profile_steps + 1)
+        for _ in range(warmup_steps + 1):  # The first step may allocate buffers
+            next(step_iter)
+        ops, nbytes = measure_allocations(step_iter, profile_steps)
+        summary["allocating_ops_per_step"] = round(ops, 1)
+        summary["allocated_bytes_per_step"] = int(nbytes)
+        results[name] = summary
+
+    baseline_mean = results["baseline"]["mean_ms"]
+    for name, summary in results.items():
+        summary["speedup_vs_baseline"] = round(baseline_mean / summary["mean_ms"], 3)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--steps", type=int, default=64, help="decode steps to time per variant")
+    parser.add_argument("--profile-steps", type=int, default=8, help="decode steps to profile for allocations")
+    parser.add_argument("--batch", type=int, default=1, help="also benchmark the engine with this many sequences")
+    parser.add_argument("--compile", action="store_true", help="also benchmark the torch.compile'd engine step")
+    parser.add_argument("--output", help="write the results as JSON to this path")
+    add_model_arguments(parser)
+    args = parser.parse_args()
+
+    mmgpt, vl_chat_processor = load_benchmark_model(model=args.model, standin_size=args.standin_size)
+    results = run(mmgpt, vl_chat_processor, args.steps, args.profile_steps, args.batch, args.compile)
+
+    for name, summary in results.items():
+        print(f"{name:>16}: {summary}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {os.path.abspath(args.output)}")
+
+
+if __name__ == "__main__":
+    main()
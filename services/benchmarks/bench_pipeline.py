@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of the image generation pipeline.
+
+Times every stage the service runs for an image: prompt prefill (with and
+without the prefix cache), per-token decode latency at batch 1 and at the
+batch size, VQ decoding (decode_code), progressive preview rendering,
+image encoding (JPEG, WebP and PNG) and saving, and the throughput of
+generating several images concurrently through the batch scheduler.
+Results are written as JSON together with the commit, torch version and
+thread count, so runs can be compared across commits.
+
+Runs offline on CPU against the stand-in model by default; pass --model janus
+to benchmark the real model when it is available.
+
+Usage (from the services directory):
+  python benchmarks/bench_pipeline.py --output pipeline.json
+  python benchmarks/bench_pipeline.py --output new.json --compare pipeline.json
+  python benchmarks/bench_pipeline.py --model janus --images 4 --output janus.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+
+import torch
+
+from bench_decode_step import engine_steps, measure_latency, summarize
+from common import DEFAULT_PROMPTS, SERVICES_DIR, add_model_arguments, decode_image, encode_prompt, load_benchmark_model
+
+from batch_scheduler import BatchScheduler, GenerationSequence
+from image_store import IMAGE_FORMATS, encode_image
+from kv_cache import cache_layers
+from pipeline import PipelineStage
+from preview import render_preview
+from prefix_cache import PrefixCache
+
+
+def timed(fn, repeats):
+    """Run fn ``repeats`` times and summarize the timings."""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    summary = summarize(timings)
+    summary["repeats"] = summary.pop("steps")
+    return summary
+
+
+@torch.inference_mode()
+def bench_prefill(mmgpt, vl_chat_processor, input_ids, repeats):
+    """Prefill of the cond/uncond pair, from scratch and through the prefix cache."""
+    def full_prefill():
+        tokens = torch.LongTensor([input_ids, input_ids])
+        tokens[1, 1:-1] = vl_chat_processor.pad_id
+        outputs = mmgpt.language_model.model(
+            inputs_embeds=mmgpt.language_model.get_input_embeddings()(tokens), use_cache=True
+        )
+        cache_layers(outputs.past_key_values)
+
+    prefix_cache = PrefixCache(mmgpt, vl_chat_processor)
+    prefix_cache.prefill(input_ids)  # Computes the shared prefix once
+    return {
+        "prompt_tokens": len(input_ids),
+        "full": timed(full_prefill, repeats),
+        "prefix_cache": timed(lambda: prefix_cache.prefill(input_ids), repeats),
+    }
+
+
+@torch.inference_mode()
+def bench_decode(mmgpt, vl_chat_processor, input_ids, steps, batch):
+    """Per-token latency of the decode engine at batch 1 and at ``batch``."""
+    results = {"batch_1": summarize(measure_latency(engine_steps(mmgpt, vl_chat_processor, input_ids, steps)))}
+    if batch > 1:
+        timings = measure_latency(engine_steps(mmgpt, vl_chat_processor, input_ids, steps, batch))
+        results[f"batch_{batch}"] = summarize(timings)
+        results[f"batch_{batch}"]["tokens_per_second"] = round(batch / (sum(timings) / len(timings)), 1)
+    results["batch_1"]["tokens_per_second"] = round(1000 / results["batch_1"]["mean_ms"], 1)
+    return results
+
+
+def bench_decode_code(mmgpt, repeats, image_token_num=576):
+    """VQ decoding of one image's tokens."""
+    tokens = torch.randint(0, 16384, (1, image_token_num), dtype=torch.int)
+    return timed(lambda: decode_image(mmgpt, tokens), repeats)
+
+
+def bench_preview(mmgpt, repeats, image_token_num=576):
+    """Rendering one progressive preview of a half sampled image, at the service's default size."""
+    tokens = torch.randint(0, 16384, (1, image_token_num), dtype=torch.int)
+    step = image_token_num // 2
+    result = timed(lambda: render_preview(mmgpt, tokens, step), repeats)
+    result["bytes"] = len(render_preview(mmgpt, tokens, step))
+    return result
+
+
+def bench_encode(mmgpt, repeats, output_dir):
+    """Encoding in memory in every output format and saving to disk of one decoded image."""
+    import PIL.Image
+
+    image = PIL.Image.fromarray(decode_image(mmgpt, torch.randint(0, 16384, (1, 576), dtype=torch.int)))
+    path = os.path.join(output_dir, "encode_benchmark.jpg")
+    results = {
+        f"encode_{image_format}": timed(lambda: encode_image(image, image_format), repeats)
+        for image_format in IMAGE_FORMATS
+    }
+    for image_format in IMAGE_FORMATS:
+        results[f"encode_{image_format}"]["bytes"] = len(encode_image(image, image_format))
+    results["save_jpeg"] = timed(lambda: image.save(path), repeats)
+    return results
+
+
+def bench_end_to_end(mmgpt, vl_chat_processor, prompts, images, batch, output_dir, seed):
+    """
+    Generate ``images`` images concurrently through the batch scheduler, then
+    VQ decode and save them on pipeline stages as the service does.
+    """
+    import PIL.Image
+
+    scheduler = BatchScheduler(mmgpt, vl_chat_processor, max_batch_size=batch)
+    decode_stage = PipelineStage(
+        "bench_decode", lambda tokens: [decode_image(mmgpt, item) for item in tokens], max_queued=batch
+    )
+    save_stage = PipelineStage(
+        "bench_save", lambda items: [PIL.Image.fromarray(image).save(path) for image, path in items],
+        workers=2, max_queued=batch
+    )
+    latencies = [None] * images
+
+    def generate(index):
+        start = time.perf_counter()
+        sequence = scheduler.submit(GenerationSequence(
+            encode_prompt(vl_chat_processor, prompts[index % len(prompts)]), seed=seed + index
+        ))
+        image = decode_stage.submit(sequence.wait()).result()
+        save_stage.submit((image, os.path.join(output_dir, f"end_to_end_{index}.jpg"))).result()
+        latencies[index] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=generate, args=(index,)) for index in range(images)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    summary = summarize(latencies)
+    del summary["steps"]
+    summary.update({
+        "images": images,
+        "max_batch_size": batch,
+        "total_seconds": round(elapsed, 3),
+        "images_per_minute": round(60 * images / elapsed, 2),
+    })
+    return summary
+
+
+def environment(args):
+    """Describe what was benchmarked, to tell runs apart."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=SERVICES_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": time.time(),
+        "model": args.model if args.model == "janus" else f"standin-{args.standin_size}",
+        "torch": torch.__version__,
+        "threads": torch.get_num_threads(),
+        "machine": platform.machine(),
+        "python": platform.python_version(),
+    }
+
+
+def flatten(results, prefix=""):
+    """Map "stage.metric" names to the mean latencies in a result tree."""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif key == "mean_ms":
+            flat[prefix[:-1]] = value
+    return flat
+
+
+def print_comparison(results, baseline):
+    """Print the mean latency of every stage against a previous run."""
+    current, previous = flatten(results["stages"]), flatten(baseline["stages"])
+    print(f"\nCompared with {baseline['environment'].get('commit')} ({baseline['environment'].get('model')}):")
+    for name, mean_ms in current.items():
+        if name in previous and previous[name]:
+            change = 100 * (mean_ms - previous[name]) / previous[name]
+            print(f"  {name:<36} {previous[name]:>10.3f} -> {mean_ms:>10.3f} ms ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_model_arguments(parser, default="standin")
+    parser.add_argument("--steps", type=int, default=64, help="decode steps to time")
+    parser.add_argument("--batch", type=int, default=4, help="batch size for decode and end-to-end runs")
+    parser.add_argument("--images", type=int, default=4, help="images to generate end to end (0 to skip)")
+    parser.add_argument("--repeats", type=int, default=5, help="repetitions of the prefill/decode_code/encode timings")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", help="write the results as JSON to this path")
+    parser.add_argument("--compare", help="previous results JSON to compare against")
+    args = parser.parse_args()
+
+    load_start = time.perf_counter()
+    mmgpt, vl_chat_processor = load_benchmark_model(model=args.model, standin_size=args.standin_size)
+    load_seconds = time.perf_counter() - load_start
+    input_ids = encode_prompt(vl_chat_processor, DEFAULT_PROMPTS[0])
+
+    stages = {}
+    with tempfile.TemporaryDirectory() as output_dir:
+        print("Benchmarking prefill...")
+        stages["prefill"] = bench_prefill(mmgpt, vl_chat_processor, input_ids, args.repeats)
+        print("Benchmarking per-token decode...")
+        stages["decode_step"] = bench_decode(mmgpt, vl_chat_processor, input_ids, args.steps, args.batch)
+        print("Benchmarking decode_code...")
+        stages["decode_code"] = bench_decode_code(mmgpt, args.repeats)
+        print("Benchmarking preview rendering...")
+        stages["preview"] = bench_preview(mmgpt, args.repeats)
+        print("Benchmarking image encoding...")
+        stages["image"] = bench_encode(mmgpt, args.repeats, output_dir)
+        if args.images:
+            print(f"Benchmarking end to end ({args.images} images)...")
+            stages["end_to_end"] = bench_end_to_end(
+                mmgpt, vl_chat_processor, DEFAULT_PROMPTS, args.images, args.batch, output_dir, args.seed
+            )
+
+    results = {
+        "environment": environment(args),
+        "load_seconds": round(load_seconds, 2),
+        "stages": stages,
+    }
+    print(json.dumps(results, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(results, json.load(f))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {os.path.abspath(args.output)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Helpers shared by the benchmark scripts.
+"""
+
+import math
+import os
+import sys
+
+import numpy as np
+import torch
+
+SERVICES_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if SERVICES_DIR not in sys.path:
+    sys.path.insert(0, SERVICES_DIR)
+
+from metrics import resident_memory_bytes  # noqa: E402,F401  (re-exported for the benchmarks)
+from pipeline import pixels_from_decoded  # noqa: E402
+
+DEFAULT_PROMPTS = [
+    "A detailed technical drawing of a drone with propellers and a camera",
+    "Exploded view of a quadcopter frame with four brushless motors",
+    "A flight controller board mounted on a carbon fiber drone frame",
+]
+
+
+def load_benchmark_model(precision=None, vision_precision=None, model="janus", standin_size="tiny"):
+    """
+    Load the model and processor the same way the service does, or the
+    randomly initialised stand-in from standin.py with ``model="standin"``.
+    """
+    if model == "standin":
+        from precision import apply_precision
+        from standin import load_standin_model
+
+        mmgpt, vl_chat_processor = load_standin_model(standin_size)
+        precision, vision_precision = precision or "fp32", vision_precision or "fp32"
+        if precision != "fp32" or vision_precision != "fp32":
+            mmgpt = apply_precision(mmgpt, precision, vision_precision)
+        return mmgpt, vl_chat_processor
+
+    import server
+
+    server.load_model(precision=precision, vision_precision=vision_precision)
+    return server.vl_gpt, server.vl_chat_processor
+
+
+def add_model_arguments(parser, default="janus"):
+    """Add the --model/--standin-size options understood by load_benchmark_model."""
+    parser.add_argument("--model", choices=["janus", "standin"], default=default,
+                        help="benchmark the real Janus model or the offline stand-in")
+    parser.add_argument("--standin-size", default="tiny", help="stand-in size, see standin.STANDIN_SIZES")
+
+
+def encode_prompt(vl_chat_processor, prompt):
+    """Tokenize a user prompt with the generation template, like generate_picture."""
+    conversation = [
+        {"role": "User", "content": prompt},
+        {"role": "Assistant", "content": ""},
+    ]
+    sft_format = vl_chat_processor.apply_sft_template_for_multi_turn_prompts(
+        conversations=conversation,
+        sft_format=vl_chat_processor.sft_format,
+        system_prompt="",
+    )
+    return vl_chat_processor.tokenizer.encode(sft_format + vl_chat_processor.image_start_tag)
+
+
+@torch.inference_mode()
+def decode_image(mmgpt, generated_tokens, img_size=384, patch_size=16):
+    """Decode image tokens to a (img_size, img_size, 3) uint8 array."""
+    dec = mmgpt.gen_vision_model.decode_code(
+        generated_tokens.to(dtype=torch.int),
+        shape=[generated_tokens.shape[0], 8, img_size // patch_size, img_size // patch_size]
+    )
+    return pixels_from_decoded(dec)[0]
+
+
+def psnr(a, b):
+    """Peak signal-to-noise ratio in dB between two uint8 images."""
+    mse = float(np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2))
+    return float("inf") if mse == 0 else 10 * math.log10(255 ** 2 / mse)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Quality/latency comparison of the precision modes in precision.py.
+
+Each mode is run in a fresh subprocess (so resident memory is measured
+independently) and generates the same prompts with the same fixed seeds.
+Images are compared against the reference mode (fp32 by default) by token
+agreement, mean absolute pixel error and PSNR.
+
+Usage (from the services directory):
+  python benchmarks/compare_precision.py --modes fp32 bf16 int8 --output-dir precision_report
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from common import (
+    DEFAULT_PROMPTS, add_model_arguments, decode_image, encode_prompt, load_benchmark_model, psnr,
+    resident_memory_bytes,
+)
+
+
+def run_mode(mode, vision_precision, prompts, seed, output_dir, model="janus", standin_size="tiny"):
+    """Generate every prompt with one precision mode and save images and timings."""
+    import PIL.Image
+
+    from batch_scheduler import BatchScheduler, GenerationSequence
+    from precision import model_memory_bytes
+
+    load_start = time.time()
+    mmgpt, vl_chat_processor = load_benchmark_model(
+        precision=mode, vision_precision=vision_precision, model=model, standin_size=standin_size
+    )
+    load_seconds = time.time() - load_start
+
+    scheduler = BatchScheduler(mmgpt, vl_chat_processor, max_batch_size=1)
+    mode_dir = os.path.join(output_dir, mode)
+    os.makedirs(mode_dir, exist_ok=True)
+
+    images = []
+    for index, prompt in enumerate(prompts):
+        start = time.time()
+        sequence = scheduler.submit(GenerationSequence(encode_prompt(vl_chat_processor, prompt), seed=seed + index))
+        tokens = sequence.wait()
+        token_seconds = time.time() - start
+        image = decode_image(mmgpt, tokens)
+        total_seconds = time.time() - start
+
+        image_path = os.path.join(mode_dir, f"image_{index}.png")
+        PIL.Image.fromarray(image).save(image_path)
+        images.append({
+            "prompt": prompt,
+            "seed": seed + index,
+            "tokens": tokens[0].tolist(),
+            "image_path": image_path,
+            "token_seconds": round(token_seconds, 3),
+            "total_seconds": round(total_seconds, 3),
+            "ms_per_token": round(1000 * token_seconds / tokens.shape[1], 2),
+        })
+        print(f"[{mode}] image {index}: {total_seconds:.1f}s")
+
+    result = {
+        "mode": mode,
+        "vision_precision": vision_precision,
+        "load_seconds": round(load_seconds, 2),
+        "weight_bytes": model_memory_bytes(mmgpt),
+        "resident_bytes": resident_memory_bytes(),
+        "images": images,
+    }
+    with open(os.path.join(mode_dir, "result.json"), "w") as f:
+        json.dump(result, f, indent=2)
+
+
+def compare(results, reference):
+    """Add quality metrics against the reference mode to every result."""
+    import PIL.Image
+
+    ref_images = results[reference]["images"]
+    for result in results.values():
+        for image, ref in zip(result["images"], ref_images):
+            a = np.asarray(PIL.Image.open(image["image_path"]))
+            b = np.asarray(PIL.Image.open(ref["image_path"]))
+            agreement = np.mean(np.array(image["tokens"]) == np.array(ref["tokens"]))
+            image["token_agreement"] = round(float(agreement), 4)
+            image["mean_abs_error"] = round(float(np.mean(np.abs(a.astype(np.float64) - b))), 2)
+            image["psnr_db"] = round(psnr(a, b), 2)
+
+        images = result["images"]
+        result["summary"] = {
+            "mean_ms_per_token": round(float(np.mean([i["ms_per_token"] for i in images])), 2),
+            "mean_total_seconds": round(float(np.mean([i["total_seconds"] for i in images])), 2),
+            "mean_token_agreement": round(float(np.mean([i["token_agreement"] for i in images])), 4),
+            "mean_psnr_db": round(float(np.mean([i["psnr_db"] for i in images])), 2),
+            "weight_gib": round(result["weight_bytes"] / 2**30, 2),
+            "resident_gib": round(result["resident_bytes"] / 2**30, 2) if result["resident_bytes"] else None,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="+", default=["fp32", "bf16", "int8"])
+    parser.add_argument("--vision-precision", default="fp32")
+    parser.add_argument("--reference", default="fp32", help="mode the others are compared against")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--prompts", nargs="+", default=DEFAULT_PROMPTS)
+    parser.add_argument("--output-dir", default="precision_report")
+    parser.add_argument("--run-mode", help=argparse.SUPPRESS)
+    add_model_arguments(parser)
+    args = parser.parse_args()
+
+    if args.run_mode:
+        run_mode(args.run_mode, args.vision_precision, args.prompts, args.seed, args.output_dir,
+                 args.model, args.standin_size)
+        return
+
+    modes = list(dict.fromkeys([args.reference] + args.modes))
+    results = {}
+    for mode in modes:
+        print(f"Running precision mode {mode}...")
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--run-mode", mode,
+             "--vision-precision", args.vision_precision, "--seed", str(args.seed),
+             "--output-dir", args.output_dir, "--model", args.model, "--standin-size", args.standin_size,
+             "--prompts", *args.prompts],
+            check=True,
+        )
+        with open(os.path.join(args.output_dir, mode, "result.json")) as f:
+            results[mode] = json.load(f)
+
+    compare(results, args.reference)
+    report_path = os.path.join(args.output_dir, "report.json")
+    with open(report_path, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"\n{'mode':>6} {'ms/token':>9} {'s/image':>8} {'tokens=':>8} {'PSNR':>7} {'weights':>8} {'RSS':>7}")
+    for mode, result in results.items():
+        s = result["summary"]
+        print(f"{mode:>6} {s['mean_ms_per_token']:>9} {s['mean_total_seconds']:>8} "
+              f"{s['mean_token_agreement']:>8} {s['mean_psnr_db']:>7} {s['weight_gib']:>7}G {s['resident_gib']}G")
+    print(f"Report written to {os.path.abspath(report_path)}")
+
+
+if __name__ == "__main__":
+    main()
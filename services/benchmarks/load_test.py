@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+"""
+Load generator for the image generation service.
+
+Replays a prompt corpus against a running service and reports how it
+behaves under concurrent load: end-to-end latency percentiles, time to
+first progress, throughput, errors and 429 rejections, and how many
+/progress polls the clients sent. Requests go either through the
+synchronous path (POST /generate with "async": false, waiting for the
+image) or the async flow (POST /generate, poll /progress, GET /result).
+
+Requests arrive at --rate per second (Poisson by default), with at most
+--concurrency in flight; latencies are measured from each request's
+scheduled arrival, so time spent waiting for a free client counts. With
+--rate 0, --concurrency clients send back to back.
+
+With --local the service is started on a free local port, serving the
+stand-in model by default, so the test runs offline; JANUS_* variables
+(JANUS_MAX_BATCH_SIZE, JANUS_QUEUE_DEPTH, ...) are passed on to it. Its
+working directory, with the service log and generated images, is removed
+afterwards unless --keep-workdir is given or the run failed.
+
+Usage (from the services directory):
+  python benchmarks/load_test.py --local --requests 32 --rate 2 --output load.json
+  python benchmarks/load_test.py --local --mode sync --concurrency 8 --requests 16
+  python benchmarks/load_test.py --url http://localhost:9999 --prompts prompts.txt --duration 600
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from common import DEFAULT_PROMPTS, add_model_arguments
+
+TERMINAL_STATUSES = ("completed", "failed", "cancelled")
+
+
+def read_prompts(path):
+    """
+    Read a prompt corpus: one prompt per line, or JSON lines with a
+    "prompt" field. Blank lines are skipped.
+    """
+    prompts = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                line = json.loads(line)["prompt"]
+            prompts.append(line)
+    if not prompts:
+        raise ValueError(f"No prompts in {path}")
+    return prompts
+
+
+def percentiles(values):
+    """Mean, p50, p95 and p99 in milliseconds of a list of seconds, or None if empty."""
+    if not values:
+        return None
+    values_ms = sorted(value * 1000 for value in values)
+
+    def at(fraction):
+        return round(values_ms[min(len(values_ms) - 1, int(len(values_ms) * fraction))], 1)
+
+    return {
+        "count": len(values_ms),
+        "mean_ms": round(sum(values_ms) / len(values_ms), 1),
+        "p50_ms": at(0.50),
+        "p95_ms": at(0.95),
+        "p99_ms": at(0.99),
+        "max_ms": round(values_ms[-1], 1),
+    }
+
+
+class ServiceClient:
+    """HTTP client keeping one persistent connection per thread."""
+
+    def __init__(self, base_url: str, timeout: float):
+        parsed = urllib.parse.urlsplit(base_url)
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        self.https = parsed.scheme == "https"
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection_class = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            connection = connection_class(self.host, self.port, timeout=self.timeout)
+            self._local.connection = connection
+        return connection
+
+    def request(self, method: str, path: str, body=None):
+        """Send a request and return (status, headers, body bytes)."""
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                connection.request(method, path, body=data, headers=headers)
+                response = connection.getresponse()
+                return response.status, response.headers, response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # The server closed an idle keep-alive connection; retry once on a new one
+                connection.close()
+                self._local.connection = None
+                if attempt:
+                    raise
+            except Exception:
+                connection.close()
+                self._local.connection = None
+                raise
+
+
+def generate_sync(client, prompt, options):
+    """One synchronous /generate; returns the request's record."""
+    record = {"mode": "sync", "polls": 0, "http_requests": 1}
+    status, headers, body = client.request("POST", "/generate", {"prompt": prompt, "async": False, **options})
+    record["status_code"] = status
+    if status == 200:
+        record["outcome"] = "ok"
+        record["bytes"] = len(body)
+    elif status == 429:
+        record["outcome"] = "rejected"
+        record["retry_after"] = headers.get("Retry-After")
+    else:
+        record["outcome"] = "error"
+        record["error"] = body[:200].decode("utf-8", "replace")
+    return record
+
+
+def generate_async(client, prompt, options, poll_interval, timeout, started):
+    """
+    One async generation: submit, poll /progress until the task is done and
+    fetch /result. Returns the request's record.
+    """
+    record = {"mode": "async", "polls": 0, "http_requests": 1}
+    status, headers, body = client.request("POST", "/generate", {"prompt": prompt, **options})
+    record["status_code"] = status
+    if status == 429:
+        record["outcome"] = "rejected"
+        record["retry_after"] = headers.get("Retry-After")
+        return record
+    if status != 200:
+        record["outcome"] = "error"
+        record["error"] = body[:200].decode("utf-8", "replace")
+        return record
+
+    submitted = json.loads(body)
+    task_id = submitted["task_id"]
+    record["task_id"] = task_id
+    record["cache"] = submitted.get("cache")
+    while True:
+        if time.perf_counter() - started > timeout:
+            record["outcome"] = "timeout"
+            return record
+        time.sleep(poll_interval)
+        status, _, body = client.request("GET", f"/progress/{task_id}")
+        record["polls"] += 1
+        record["http_requests"] += 1
+        if status != 200:
+            record["outcome"] = "error"
+            record["error"] = f"/progress answered {status}"
+            return record
+        progress = json.loads(body)
+        if "first_progress_seconds" not in record and (
+                progress.get("tokens_generated") or progress.get("status") in TERMINAL_STATUSES):
+            record["first_progress_seconds"] = time.perf_counter() - started
+        if progress.get("status") in TERMINAL_STATUSES:
+            break
+
+    if progress["status"] != "completed":
+        record["outcome"] = "error"
+        record["error"] = f"task {progress['status']}: {progress.get('message') or progress.get('error')}"
+        return record
+    status, _, body = client.request("GET", f"/result/{task_id}")
+    record["http_requests"] += 1
+    if status != 200:
+        record["outcome"] = "error"
+        record["error"] = f"/result answered {status}"
+        return record
+    record["outcome"] = "ok"
+    record["bytes"] = len(body)
+    return record
+
+
+def run_load(client, prompts, mode, requests, duration, rate, arrival, concurrency, options,
+             poll_interval, timeout, seed):
+    """
+    Send the load and return (records, wall seconds). Requests are sent until
+    ``requests`` have been sent or ``duration`` seconds have passed.
+    """
+    rng = random.Random(seed)
+    records = []
+    records_lock = threading.Lock()
+
+    def send(index, scheduled):
+        started = time.perf_counter()
+        prompt = prompts[index % len(prompts)]
+        try:
+            if mode == "sync":
+                record = generate_sync(client, prompt, options)
+            else:
+                record = generate_async(client, prompt, options, poll_interval, timeout, scheduled)
+        except Exception as e:
+            record = {"mode": mode, "outcome": "error", "error": f"{type(e).__name__}: {e}", "polls": 0,
+                      "http_requests": 1}
+        finished = time.perf_counter()
+        record.update({
+            "index": index,
+            "start_delay_seconds": started - scheduled,
+            "latency_seconds": finished - scheduled,
+        })
+        with records_lock:
+            records.append(record)
+
+    start = time.perf_counter()
+    deadline = start + duration if duration else None
+    with ThreadPoolExecutor(concurrency, thread_name_prefix="load-client") as executor:
+        if rate > 0:
+            scheduled = start
+            index = 0
+            while (requests is None or index < requests) and (deadline is None or scheduled < deadline):
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(send, index, scheduled)
+                index += 1
+                scheduled += rng.expovariate(rate) if arrival == "poisson" else 1.0 / rate
+        else:
+            counter = iter(range(sys.maxsize if requests is None else requests))
+            counter_lock = threading.Lock()
+
+            def closed_loop_client():
+                while deadline is None or time.perf_counter() < deadline:
+                    with counter_lock:
+                        index = next(counter, None)
+                    if index is None:
+                        return
+                    send(index, time.perf_counter())
+
+            for _ in range(concurrency):
+                executor.submit(closed_loop_client)
+    return sorted(records, key=lambda record: record["index"]), time.perf_counter() - start
+
+
+def summarize_load(records, wall_seconds):
+    """Aggregate the per-request records into the report's summary."""
+    outcomes = {}
+    for record in records:
+        outcomes[record["outcome"]] = outcomes.get(record["outcome"], 0) + 1
+    succeeded = [record for record in records if record["outcome"] == "ok"]
+    polls = sum(record["polls"] for record in records)
+    return {
+        "requests": len(records),
+        "outcomes": outcomes,
+        "rejected_429": sum(1 for record in records if record.get("status_code") == 429),
+        "errors": outcomes.get("error", 0) + outcomes.get("timeout", 0),
+        "wall_seconds": round(wall_seconds, 2),
+        "throughput_images_per_minute": round(60 * len(succeeded) / wall_seconds, 2) if wall_seconds else None,
+        "latency": percentiles([record["latency_seconds"] for record in succeeded]),
+        "first_progress": percentiles([
+            record["first_progress_seconds"] for record in succeeded if "first_progress_seconds" in record
+        ]),
+        "start_delay": percentiles([record["start_delay_seconds"] for record in records]),
+        "poll_requests": polls,
+        "polls_per_image": round(polls / len(succeeded), 1) if succeeded else None,
+        "http_requests": sum(record["http_requests"] for record in records),
+    }
+
+
+def print_summary(summary):
+    print(f"\n{summary['requests']} request(s) in {summary['wall_seconds']}s: {summary['outcomes']}")
+    print(f"  throughput:       {summary['throughput_images_per_minute']} images/minute")
+    for name in ("latency", "first_progress", "start_delay"):
+        stats = summary[name]
+        if stats:
+            print(f"  {name + ':':<17} p50 {stats['p50_ms']:>10.1f} ms  p95 {stats['p95_ms']:>10.1f} ms  "
+                  f"p99 {stats['p99_ms']:>10.1f} ms")
+    print(f"  429 rejections:   {summary['rejected_429']}")
+    print(f"  errors:           {summary['errors']}")
+    print(f"  /progress polls:  {summary['poll_requests']} ({summary['polls_per_image']} per image), "
+          f"{summary['http_requests']} HTTP requests in total")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(client, process, timeout):
+    """Wait until a started service answers /ready with 200."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The local service exited with code {process.returncode}")
+        try:
+            if client.request("GET", "/ready")[0] == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"The local service was not ready after {timeout}s")
+
+
+def start_local_service(args, workdir):
+    """
+    Start the service on a free local port in a subprocess working in
+    ``workdir``; returns (process, base URL, log path).
+    """
+    port = free_port()
+    log_path = os.path.join(workdir, "service.log")
+    env = dict(os.environ, JANUS_HOST="127.0.0.1", JANUS_PORT=str(port))
+    command = [sys.executable, os.path.abspath(__file__), "--serve-local", args.server,
+               "--model", args.model, "--standin-size", args.standin_size]
+    with open(log_path, "w") as log:
+        process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return process, f"http://127.0.0.1:{port}", log_path
+
+
+def stop_local_service(process, timeout=30):
+    process.terminate()
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def serve_local(server_kind, model, standin_size):
+    """Body of the --local subprocess: serve the chosen model on JANUS_HOST:JANUS_PORT."""
+    import server
+
+    if model == "standin":
+        from standin import load_standin_model
+
+        server.vl_gpt, server.vl_chat_processor = load_standin_model(standin_size)
+    if server_kind == "async":
+        import async_server
+
+        async_server.main()
+    else:
+        server.start_backend()
+        server.app.run(host=os.environ["JANUS_HOST"], port=int(os.environ["JANUS_PORT"]), threaded=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:9999", help="service to load")
+    parser.add_argument("--local", action="store_true",
+                        help="start a local service for the test instead of using --url")
+    parser.add_argument("--server", choices=["async", "dev"], default="async",
+                        help="with --local: serve with async_server.py or the Flask development server")
+    add_model_arguments(parser, default="standin")
+    parser.add_argument("--mode", choices=["async", "sync"], default="async",
+                        help="async: /generate then poll /progress and fetch /result; sync: wait on /generate")
+    parser.add_argument("--prompts", help="prompt corpus, one prompt (or JSON object with \"prompt\") per line")
+    parser.add_argument("--requests", type=int, default=16, help="requests to send (0 for no limit)")
+    parser.add_argument("--duration", type=float, default=0, help="stop sending after this many seconds (0: no limit)")
+    parser.add_argument("--rate", type=float, default=1.0,
+                        help="arrivals per second; 0 sends back to back from --concurrency clients")
+    parser.add_argument("--arrival", choices=["poisson", "uniform"], default="poisson",
+                        help="distribution of the time between arrivals")
+    parser.add_argument("--concurrency", type=int, default=16, help="most requests in flight at once")
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="seconds between /progress polls")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds before a request is counted as timed out")
+    parser.add_argument("--cache", action="store_true",
+                        help="allow result cache hits (by default every request asks for a fresh image)")
+    parser.add_argument("--image-format", help="\"format\" to request, e.g. webp")
+    parser.add_argument("--startup-timeout", type=float, default=600, help="seconds to wait for a --local service")
+    parser.add_argument("--keep-workdir", action="store_true",
+                        help="keep the --local service's working directory (log and images)")
+    parser.add_argument("--seed", type=int, default=1234, help="seed of the arrival times")
+    parser.add_argument("--output", help="write the report as JSON to this path")
+    parser.add_argument("--serve-local", choices=["async", "dev"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_local:
+        serve_local(args.serve_local, args.model, args.standin_size)
+        return
+    if args.requests == 0 and not args.duration:
+        parser.error("--requests 0 needs a --duration")
+
+    prompts = read_prompts(args.prompts) if args.prompts else DEFAULT_PROMPTS
+    options = {"cache": args.cache}
+    if args.image_format:
+        options["format"] = args.image_format
+
+    process = None
+    workdir = tempfile.mkdtemp(prefix="janus-load-") if args.local else None
+    base_url = args.url
+    if args.local:
+        process, base_url, log_path = start_local_service(args, workdir)
+        print(f"Starting a local service with the {args.model} model on {base_url} (log: {log_path})...")
+    client = ServiceClient(base_url, timeout=args.timeout)
+    failed = True
+    try:
+        if process is not None:
+            wait_ready(client, process, args.startup_timeout)
+            print("Local service ready ✅")
+        limit = f"{args.requests} request(s)" if args.requests else f"{args.duration}s"
+        pace = f"{args.rate}/s {args.arrival} arrivals" if args.rate > 0 else "back to back"
+        print(f"Sending {limit} ({args.mode}, {pace}, concurrency {args.concurrency}) to {base_url}...")
+        records, wall_seconds = run_load(
+            client, prompts, args.mode, args.requests or None, args.duration, args.rate, args.arrival,
+            args.concurrency, options, args.poll_interval, args.timeout, args.seed
+        )
+        failed = False
+    finally:
+        if process is not None:
+            stop_local_service(process)
+        if workdir is not None:
+            if args.keep_workdir or failed:
+                print(f"Local service files kept in {workdir}")
+            else:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    summary = summarize_load(records, wall_seconds)
+    print_summary(summary)
+    if args.output:
+        report = {
+            "config": {
+                "url": "local" if args.local else args.url,
+                "model": (args.model if args.model == "janus" else f"standin-{args.standin_size}")
+                if args.local else None,
+                "mode": args.mode,
+                "requests": args.requests,
+                "duration": args.duration,
+                "rate": args.rate,
+                "arrival": args.arrival,
+                "concurrency": args.concurrency,
+                "poll_interval": args.poll_interval,
+                "prompts": len(prompts),
+                "options": options,
+                "timestamp": time.time(),
+            },
+            "summary": summary,
+            "requests": records,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {os.path.abspath(args.output)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Small randomly initialised stand-in for the Janus model and processor.
+
+It exposes the parts of ``MultiModalityCausalLM`` and ``VLChatProcessor`` the
+service uses (``language_model``, ``gen_head``, ``prepare_gen_img_embeds``,
+``gen_vision_model.decode_code``, the chat template, tokenizer and
+``pad_id``) with the same tensor shapes and image vocabulary, so the
+generation pipeline can be benchmarked on a CPU-only machine without network
+access or the 1.3B checkpoint. Absolute timings are not those of Janus; use
+them to compare commits against each other.
+"""
+
+import torch
+from torch import nn
+from transformers import LlamaConfig, LlamaForCausalLM
+
+# Language model sizes; "janus" matches the shapes of Janus-1.3B
+STANDIN_SIZES = {
+    "tiny": {"hidden_size": 128, "intermediate_size": 344, "num_hidden_layers": 2, "num_attention_heads": 4},
+    "small": {"hidden_size": 512, "intermediate_size": 1376, "num_hidden_layers": 6, "num_attention_heads": 8},
+    "janus": {"hidden_size": 2048, "intermediate_size": 5632, "num_hidden_layers": 24, "num_attention_heads": 16},
+}
+
+# Image token vocabulary and VQ code dimension of Janus' generation tokenizer
+IMAGE_TOKEN_VOCAB = 16384
+IMAGE_CODE_DIM = 8
+
+
+class StandInTokenizer:
+    """Byte level tokenizer with a begin-of-sentence token, like Janus' Llama tokenizer."""
+
+    bos_id = 0
+
+    def encode(self, text):
+        return [self.bos_id] + [2 + b for b in text.encode("utf-8")]
+
+
+class StandInProcessor:
+    """Chat template, tokenizer and pad id of VLChatProcessor."""
+
+    sft_format = "deepseek"
+    image_start_tag = "<begin_of_image>"
+    pad_id = 1
+
+    def __init__(self):
+        self.tokenizer = StandInTokenizer()
+
+    def apply_sft_template_for_multi_turn_prompts(self, conversations, sft_format="deepseek", system_prompt=""):
+        text = f"{system_prompt}\n\n" if system_prompt else ""
+        for message in conversations:
+            text += f"<|{message['role']}|>: {message['content']}"
+            text += "\n\n" if message["content"] else ""
+        return text
+
+
+class StandInVisionDecoder(nn.Module):
+    """VQ decoder mapping (B, 576) image tokens to (B, 3, 384, 384) images in [-1, 1]."""
+
+    def __init__(self, channels: int = 32, upsamples: int = 4):
+        super().__init__()
+        self.codebook = nn.Embedding(IMAGE_TOKEN_VOCAB, IMAGE_CODE_DIM)
+        layers = [nn.Conv2d(IMAGE_CODE_DIM, channels, 3, padding=1)]
+        for _ in range(upsamples):
+            layers += [nn.Upsample(scale_factor=2), nn.Conv2d(channels, channels, 3, padding=1), nn.SiLU()]
+        layers.append(nn.Conv2d(channels, 3, 3, padding=1))
+        self.decoder = nn.Sequential(*layers)
+
+    def decode_code(self, code_b, shape):
+        batch, channels, height, width = shape
+        quant = self.codebook(code_b.long()).view(batch, height, width, channels).permute(0, 3, 1, 2)
+        return torch.tanh(self.decoder(quant))
+
+
+class StandInMultiModalityCausalLM(nn.Module):
+    """Generation path of MultiModalityCausalLM with random weights."""
+
+    def __init__(self, size: str = "tiny", text_vocab: int = 258):
+        super().__init__()
+        if size not in STANDIN_SIZES:
+            raise ValueError(f"Unknown stand-in size '{size}', expected one of {tuple(STANDIN_SIZES)}")
+        dims = STANDIN_SIZES[size]
+        config = LlamaConfig(
+            vocab_size=text_vocab,
+            num_key_value_heads=dims["num_attention_heads"],
+            max_position_embeddings=4096,
+            **dims,
+        )
+        config._attn_implementation = "eager"
+        hidden = dims["hidden_size"]
+
+        self.language_model = LlamaForCausalLM(config)
+        self.gen_embed = nn.Embedding(IMAGE_TOKEN_VOCAB, IMAGE_CODE_DIM)
+        self.gen_aligner = nn.Sequential(nn.Linear(IMAGE_CODE_DIM, hidden), nn.GELU(), nn.Linear(hidden, hidden))
+        self.gen_head = nn.Sequential(nn.Linear(hidden, hidden), nn.GELU(), nn.Linear(hidden, IMAGE_TOKEN_VOCAB))
+        self.gen_vision_model = StandInVisionDecoder()
+
+    def prepare_gen_img_embeds(self, image_ids):
+        return self.gen_aligner(self.gen_embed(image_ids))
+
+
+def load_standin_model(size: str = "tiny", seed: int = 0):
+    """Build a stand-in model (in eval mode) and processor with reproducible weights."""
+    torch.manual_seed(seed)
+    return StandInMultiModalityCausalLM(size).eval(), StandInProcessor()
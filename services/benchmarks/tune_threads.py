@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Thread and core layout autotuner for CPU inference.
+
+Measures image token throughput of the decode step (a DecodeEngine step over
+a full batch, as the batch scheduler runs it) for:
+
+  1. one process across intra-op thread counts, and
+  2. the physical cores split into N worker processes x T threads each,
+     unpinned and pinned to disjoint cores or to NUMA nodes.
+
+Every layout runs in processes forked from the one that loaded the model,
+like ProcessWorkerPool's workers, all stepping at the same time. The layout
+with the most images per hour is saved as this host type's profile in the
+tuning file, which server.py applies at startup (see cpu_tuning). Profiles of
+other host types in the file are kept, so one file can serve every machine
+type.
+
+Usage (from the services directory):
+  python benchmarks/tune_threads.py
+  python benchmarks/tune_threads.py --steps 32 --pin none cores --output tuning.json
+  python benchmarks/tune_threads.py --model standin --standin-size small --dry-run
+"""
+
+import argparse
+import multiprocessing
+import os
+import queue
+import time
+
+import torch
+
+from bench_decode_step import engine_steps
+from common import DEFAULT_PROMPTS, SERVICES_DIR, add_model_arguments, encode_prompt, load_benchmark_model
+
+from cpu_tuning import (
+    PIN_CORES, PIN_MODES, PIN_NONE, PIN_NUMA, apply_thread_settings, cpu_topology, host_signature, save_tuning,
+    worker_cpu_sets,
+)
+
+IMAGE_TOKENS = 576
+
+
+def _run_worker(mmgpt, vl_chat_processor, input_ids, batch, steps, warmup_steps, threads, interop_threads, cpus,
+                barrier, results):
+    """Body of a measuring process: warm up, wait for the others, time ``steps`` decode steps."""
+    apply_thread_settings(threads, interop_threads, cpus)
+    with torch.inference_mode():
+        step_iter = engine_steps(mmgpt, vl_chat_processor, input_ids, warmup_steps + steps, batch)
+        for _ in range(warmup_steps):  # The first step also runs the prefill
+            next(step_iter)
+        barrier.wait()
+        start = time.perf_counter()
+        for _ in step_iter:
+            pass
+        results.put((batch * steps, time.perf_counter() - start))
+
+
+def measure_layout(mmgpt, vl_chat_processor, input_ids, workers, threads, cpu_sets, batch, steps,
+                   warmup_steps=4, interop_threads=1):
+    """
+    Run ``workers`` processes with ``threads`` intra-op threads each, decoding
+    ``batch`` sequences per process concurrently. Returns the aggregate token
+    rate, the images per hour it amounts to and the mean step latency, or
+    None if a process failed.
+    """
+    context = multiprocessing.get_context("fork")
+    barrier = context.Barrier(workers)
+    results = context.Queue()
+    processes = [
+        context.Process(
+            target=_run_worker,
+            args=(mmgpt, vl_chat_processor, input_ids, batch, steps, warmup_steps, threads, interop_threads,
+                  cpu_sets[index] if cpu_sets else None, barrier, results),
+            daemon=True,
+        )
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    measured = []
+    while len(measured) < workers:
+        try:
+            measured.append(results.get(timeout=1.0))
+        except queue.Empty:
+            if any(process.exitcode not in (None, 0) for process in processes):
+                break
+    for process in processes:
+        if len(measured) < workers:
+            process.terminate()
+        process.join()
+    if len(measured) < workers:
+        return None
+
+    tokens_per_second = sum(tokens / seconds for tokens, seconds in measured)
+    step_seconds = sum(seconds for _, seconds in measured) / len(measured) / steps
+    return {
+        "tokens_per_second": round(tokens_per_second, 2),
+        "images_per_hour": round(tokens_per_second * 3600 / IMAGE_TOKENS, 1),
+        "step_ms": round(step_seconds * 1000, 3),
+        "seconds_per_image": round(step_seconds * IMAGE_TOKENS, 2),
+    }
+
+
+def candidate_layouts(topology, max_workers, pin_modes):
+    """
+    Yield (workers, threads, pin) layouts: thread counts for a single process,
+    then every even split of the physical cores over 2..max_workers processes.
+    """
+    cores = len(topology["cores"])
+    logical = len(topology["cpus"])
+    thread_counts = sorted({1, cores, logical} | {2 ** i for i in range(1, logical.bit_length()) if 2 ** i < logical})
+    for threads in thread_counts:
+        yield 1, threads, PIN_NONE
+
+    for workers in range(2, min(max_workers, cores) + 1):
+        if cores % workers:
+            continue
+        for pin in pin_modes:
+            if pin == PIN_NUMA and (len(topology["numa_nodes"]) < 2 or workers % len(topology["numa_nodes"])):
+                continue
+            threads = cores // workers
+            if pin == PIN_NUMA:
+                # Workers sharing a node split its cores
+                threads = max(1, cores // len(topology["numa_nodes"]) // (workers // len(topology["numa_nodes"])))
+            yield workers, threads, pin
+
+
+def tune(mmgpt, vl_chat_processor, batch, steps, max_workers, pin_modes, interop_threads=1):
+    """Measure every candidate layout; returns the measurements, best first."""
+    topology = cpu_topology()
+    print(f"Host: {host_signature(topology)} ({topology['sockets']} socket(s))")
+    input_ids = encode_prompt(vl_chat_processor, DEFAULT_PROMPTS[0])
+
+    measurements = []
+    for workers, threads, pin in candidate_layouts(topology, max_workers, pin_modes):
+        cpu_sets = worker_cpu_sets(topology, workers, pin)
+        if pin != PIN_NONE and cpu_sets is None:
+            continue
+        result = measure_layout(mmgpt, vl_chat_processor, input_ids, workers, threads, cpu_sets, batch, steps,
+                                interop_threads=interop_threads)
+        if result is None:
+            print(f"⚠️ Measuring {workers} worker(s) x {threads} thread(s), pin {pin} failed, skipping it")
+            continue
+        result.update({"workers": workers, "threads": threads, "pin": pin})
+        measurements.append(result)
+        print(f"{workers:>3} worker(s) x {threads:>3} thread(s), pin {pin:>5}: "
+              f"{result['images_per_hour']:>10} images/hour, {result['step_ms']} ms/step")
+    measurements.sort(key=lambda result: result["images_per_hour"], reverse=True)
+    return measurements
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--steps", type=int, default=32, help="decode steps to time per layout")
+    parser.add_argument("--batch", type=int, default=int(os.environ.get("JANUS_MAX_BATCH_SIZE", "4")),
+                        help="sequences decoded together per process (the service's max batch size)")
+    parser.add_argument("--max-workers", type=int, default=8, help="most worker processes to try")
+    parser.add_argument("--pin", nargs="+", choices=PIN_MODES, default=[PIN_NONE, PIN_CORES, PIN_NUMA],
+                        help="pinning modes to try for multi-process layouts")
+    parser.add_argument("--interop-threads", type=int, default=1, help="torch inter-op threads per process")
+    parser.add_argument("--output", default=os.path.join(SERVICES_DIR, "tuning.json"),
+                        help="tuning file to save this host type's profile in")
+    parser.add_argument("--dry-run", action="store_true", help="only print the measurements")
+    add_model_arguments(parser)
+    args = parser.parse_args()
+
+    mmgpt, vl_chat_processor = load_benchmark_model(model=args.model, standin_size=args.standin_size)
+    measurements = tune(mmgpt, vl_chat_processor, args.batch, args.steps, args.max_workers, args.pin,
+                        args.interop_threads)
+    if not measurements:
+        raise SystemExit("❌ No layout could be measured (see the warnings above); no tuning profile written")
+    best = measurements[0]
+    print(f"Best layout: {best['workers']} worker(s) x {best['threads']} thread(s), pin {best['pin']}, "
+          f"{best['images_per_hour']} images/hour")
+    if args.dry_run:
+        return
+
+    save_tuning(args.output, {
+        # A single process generates in the server process itself
+        "worker_processes": best["workers"] if best["workers"] > 1 else 0,
+        "threads_per_worker": best["threads"],
+        "interop_threads": args.interop_threads,
+        "pin": best["pin"],
+        "batch_size": args.batch,
+        "images_per_hour": best["images_per_hour"],
+        "model": args.model if args.model != "standin" else f"standin:{args.standin_size}",
+        "measured_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "measurements": measurements,
+    })
+    print(f"Tuning profile saved to {os.path.abspath(args.output)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Cancellation and deadlines of generation requests.
+
+A generation holds a CancelToken that the batch scheduler checks before every
+decode step, so a cancelled sequence, or one past its deadline, leaves the
+batch at the next step boundary instead of running all of its image tokens,
+and its submitter gets GenerationCancelled.
+
+Tokens are registered by key (task id, or a job id for synchronous requests)
+in a CancelRegistry. A cancel that arrives before the generation registered
+its token, e.g. while a worker thread is picking the job up or in another
+worker process, is remembered and applied when the token is registered.
+"""
+
+import collections
+import threading
+import time
+
+# Why a generation was stopped
+CANCELLED = "cancelled"
+DEADLINE_EXCEEDED = "deadline_exceeded"
+CLIENT_DISCONNECTED = "client_disconnected"
+
+
+class GenerationCancelled(Exception):
+    """Raised to the submitter of a cancelled generation."""
+
+    def __init__(self, reason=CANCELLED):
+        super().__init__(f"Generation stopped: {reason}")
+        self.reason = reason
+
+
+class CancelToken:
+    """Cancellation flag of one generation, with an optional deadline (epoch seconds)."""
+
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self._reason = None
+
+    def cancel(self, reason=CANCELLED):
+        if self._reason is None:
+            self._reason = reason
+
+    @property
+    def reason(self):
+        """Why the generation should stop, or None while it may continue."""
+        if self._reason is None and self.deadline is not None and time.time() > self.deadline:
+            self._reason = DEADLINE_EXCEEDED
+        return self._reason
+
+    def check(self):
+        """Raise GenerationCancelled if the generation should stop."""
+        reason = self.reason
+        if reason is not None:
+            raise GenerationCancelled(reason)
+
+
+class CancelRegistry:
+    """Tokens of running generations by key, and recent cancels of unknown keys."""
+
+    def __init__(self, remember: int = 1024):
+        self.remember = remember
+        self._tokens = {}
+        self._early = collections.OrderedDict()  # key -> reason, oldest first
+        self._lock = threading.Lock()
+
+    def register(self, key, deadline=None) -> CancelToken:
+        """Create the token of the generation identified by ``key``."""
+        token = CancelToken(deadline)
+        if key is None:
+            return token
+        with self._lock:
+            reason = self._early.pop(key, None)
+            if reason is not None:
+                token.cancel(reason)
+            self._tokens[key] = token
+        return token
+
+    def unregister(self, key):
+        if key is None:
+            return
+        with self._lock:
+            self._tokens.pop(key, None)
+
+    def cancel(self, key, reason=CANCELLED):
+        """
+        Cancel the generation identified by ``key``. Returns whether it was
+        running; otherwise the cancel applies once it registers.
+        """
+        with self._lock:
+            token = self._tokens.get(key)
+            if token is None:
+                self._early[key] = reason
+                while len(self._early) > self.remember:
+                    self._early.popitem(last=False)
+                return False
+        token.cancel(reason)
+        return True
+
+
+def is_cancellation(error) -> bool:
+    """Whether an error (possibly relayed from a worker process) is a cancellation."""
+    return isinstance(error, GenerationCancelled) or getattr(error, "kind", None) == GenerationCancelled.__name__
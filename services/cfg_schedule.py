@@ -0,0 +1,98 @@
+"""
+Classifier-free guidance schedules for the image token loop.
+
+Every decode step normally runs a conditional and an unconditional row and
+mixes their logits with a constant ``cfg_weight``, doubling the compute of the
+whole image. The global layout of the image is fixed by the early tokens, so
+guidance can be weakened later on and the unconditional row dropped entirely
+after a cutoff, running the rest of the image at one row per sequence.
+"""
+
+import math
+
+CFG_DECAYS = ("constant", "linear", "cosine")
+
+
+class CFGSchedule:
+    """
+    Guidance weight as a function of the index of the image token being sampled.
+
+    The weight starts at ``cfg_weight`` and, unless ``decay`` is "constant",
+    moves towards ``final_weight`` until the cutoff (or the last token without
+    one). From the cutoff on, given as a token index (``cutoff_step``) or a
+    fraction of the image (``cutoff``), tokens are sampled from the conditional
+    logits alone and the unconditional row is no longer computed.
+    """
+
+    def __init__(self, cfg_weight: float = 5.0, decay: str = "constant", final_weight: float = 1.0,
+                 cutoff=None, cutoff_step=None):
+        if decay not in CFG_DECAYS:
+            raise ValueError(f"Unknown CFG decay '{decay}', expected one of {CFG_DECAYS}")
+        if cutoff is not None and not 0.0 <= cutoff <= 1.0:
+            raise ValueError(f"CFG cutoff must be a fraction between 0 and 1, got {cutoff}")
+        if cutoff_step is not None and cutoff_step < 0:
+            raise ValueError(f"CFG cutoff step must not be negative, got {cutoff_step}")
+        self.cfg_weight = float(cfg_weight)
+        self.decay = decay
+        self.final_weight = float(final_weight)
+        self.cutoff = None if cutoff is None else float(cutoff)
+        self.cutoff_step = None if cutoff_step is None else int(cutoff_step)
+
+    @property
+    def constant(self):
+        """True if the weight never changes before the cutoff."""
+        return self.decay == "constant"
+
+    @property
+    def is_default(self):
+        """True for the original constant, never cut off guidance."""
+        return self.constant and self.cutoff is None and self.cutoff_step is None
+
+    def end(self, total: int) -> int:
+        """Index of the first token sampled without the unconditional row."""
+        end = total
+        if self.cutoff is not None:
+            end = min(end, int(round(self.cutoff * total)))
+        if self.cutoff_step is not None:
+            end = min(end, self.cutoff_step)
+        return end
+
+    def guided(self, step: int, total: int) -> bool:
+        """Whether token ``step`` is sampled with the unconditional row."""
+        return step < self.end(total)
+
+    def weight(self, step: int, total: int) -> float:
+        """Guidance weight for token ``step`` (1.0 is the conditional logits alone)."""
+        end = self.end(total)
+        if step >= end:
+            return 1.0
+        if self.constant:
+            return self.cfg_weight
+        progress = step / end
+        if self.decay == "linear":
+            return self.cfg_weight + (self.final_weight - self.cfg_weight) * progress
+        return self.final_weight + (self.cfg_weight - self.final_weight) * 0.5 * (1 + math.cos(math.pi * progress))
+
+    def describe(self) -> dict:
+        """JSON-serialisable description, for cache keys and task records."""
+        return {
+            "cfg_weight": self.cfg_weight,
+            "decay": self.decay,
+            "final_weight": self.final_weight,
+            "cutoff": self.cutoff,
+            "cutoff_step": self.cutoff_step,
+        }
+
+    @classmethod
+    def from_request(cls, data: dict, cfg_weight: float):
+        """Build a schedule from the ``cfg_*`` fields of a /generate request."""
+        return cls(
+            cfg_weight=cfg_weight,
+            decay=data.get("cfg_decay", "constant"),
+            final_weight=float(data.get("cfg_final_weight", 1.0)),
+            cutoff=float(data["cfg_cutoff"]) if data.get("cfg_cutoff") is not None else None,
+            cutoff_step=int(data["cfg_cutoff_step"]) if data.get("cfg_cutoff_step") is not None else None,
+        )
+
+    def __repr__(self):
+        return f"CFGSchedule({', '.join(f'{k}={v!r}' for k, v in self.describe().items())})"
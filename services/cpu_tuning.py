@@ -0,0 +1,192 @@
+"""
+CPU thread and core layout of the generation service.
+
+torch defaults to one intra-op thread per logical CPU. For the small matmuls
+of a decode step that scales badly on large and multi-socket machines and
+oversubscribes the cores once several worker processes run. The layout with
+the best throughput (worker processes x threads per worker, optionally each
+worker pinned to its own cores or NUMA node) is measured per host type by
+benchmarks/tune_threads.py and saved as a profile in a tuning file, which
+the server applies at startup.
+
+A tuning file holds one profile per host type, keyed by host_signature(), so
+the same file can be deployed to every machine type that was tuned.
+"""
+
+import glob
+import json
+import os
+
+TUNING_FORMAT_VERSION = 1
+
+# How worker processes are pinned to CPUs
+PIN_NONE = "none"
+PIN_CORES = "cores"  # Disjoint sets of physical cores per worker
+PIN_NUMA = "numa"  # Workers spread over NUMA nodes, sharing their node's cores
+PIN_MODES = (PIN_NONE, PIN_CORES, PIN_NUMA)
+
+
+def _parse_cpu_list(text: str):
+    """Parse a kernel CPU list such as "0-3,8,10-11"."""
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        cpus.extend(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+def _read(path: str):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cpu_topology():
+    """
+    Describe the CPUs this process may run on: logical CPUs, CPUs grouped by
+    physical core (hyperthread siblings together), NUMA nodes and sockets.
+    Falls back to one node of independent CPUs where /sys is not available.
+    """
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    allowed = set(cpus)
+
+    cores = {}  # (package, core id) -> logical CPUs
+    packages = set()
+    for cpu in cpus:
+        package = _read(f"/sys/devices/system/cpu/cpu{cpu}/topology/physical_package_id")
+        core = _read(f"/sys/devices/system/cpu/cpu{cpu}/topology/core_id")
+        key = (package, core) if core is not None else (None, cpu)
+        cores.setdefault(key, []).append(cpu)
+        packages.add(package)
+
+    nodes = []
+    for path in sorted(glob.glob("/sys/devices/system/node/node[0-9]*/cpulist"),
+                       key=lambda p: int(p.split("/node")[-1].split("/")[0])):
+        node_cpus = [cpu for cpu in _parse_cpu_list(_read(path) or "") if cpu in allowed]
+        if node_cpus:
+            nodes.append(node_cpus)
+    if not nodes:
+        nodes = [cpus]
+
+    return {
+        "cpus": cpus,
+        "cores": sorted(cores.values()),
+        "numa_nodes": nodes,
+        "sockets": max(1, len(packages - {None})),
+    }
+
+
+def cpu_model() -> str:
+    """Name of the processor model, from /proc/cpuinfo where available."""
+    info = _read("/proc/cpuinfo") or ""
+    for line in info.splitlines():
+        if line.startswith("model name"):
+            return line.partition(":")[2].strip()
+    import platform
+    return platform.processor() or platform.machine() or "unknown"
+
+
+def host_signature(topology=None) -> str:
+    """Identify the host type a tuning profile applies to."""
+    topology = topology or cpu_topology()
+    return (f"{cpu_model()}|{len(topology['cpus'])} cpus|{len(topology['cores'])} cores"
+            f"|{len(topology['numa_nodes'])} nodes")
+
+
+def worker_cpu_sets(topology, num_workers: int, pin: str):
+    """
+    Split the CPUs over ``num_workers`` worker processes. Returns one CPU list
+    per worker, or None when workers are not pinned.
+
+    With PIN_CORES every worker gets a disjoint, contiguous slice of physical
+    cores (with their hyperthread siblings). With PIN_NUMA workers are
+    assigned to NUMA nodes round-robin and share their node's CPUs, so each
+    worker's memory stays local to its node.
+    """
+    if pin == PIN_NONE or num_workers < 1:
+        return None
+    if pin == PIN_NUMA:
+        nodes = topology["numa_nodes"]
+        return [list(nodes[index % len(nodes)]) for index in range(num_workers)]
+    if pin == PIN_CORES:
+        # Cores in node order so slices do not straddle nodes when they divide evenly
+        order = {cpu: index for index, node in enumerate(topology["numa_nodes"]) for cpu in node}
+        cores = sorted(topology["cores"], key=lambda core: (order.get(core[0], 0), core[0]))
+        if len(cores) < num_workers:
+            return None
+        per_worker = len(cores) // num_workers
+        return [
+            [cpu for core in cores[index * per_worker:(index + 1) * per_worker] for cpu in core]
+            for index in range(num_workers)
+        ]
+    raise ValueError(f"Unknown pin mode '{pin}', expected one of {', '.join(PIN_MODES)}")
+
+
+def read_tuning(path: str, signature: str = None, model: str = None):
+    """
+    Return the tuning profile for this host type (or ``signature``) from the
+    tuning file at ``path``, or None if there is none. With ``model`` (as
+    written by tune_threads: "janus" or "standin:<size>"), a profile measured
+    on another model is ignored, since the best layout depends on the model.
+    """
+    try:
+        with open(path) as f:
+            tuning = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"⚠️ Could not read the tuning file {path}: {e}")
+        return None
+    if tuning.get("format_version") != TUNING_FORMAT_VERSION:
+        print(f"⚠️ Tuning file {path} has an unsupported format, ignoring it")
+        return None
+    profile = tuning.get("hosts", {}).get(signature or host_signature())
+    if profile is not None and model is not None and profile.get("model", model) != model:
+        print(f"⚠️ The tuning profile in {path} was measured on the {profile['model']} model, "
+              f"not {model}; ignoring it")
+        return None
+    return profile
+
+
+def save_tuning(path: str, profile, signature: str = None):
+    """Add or replace the profile of this host type in the tuning file at ``path``."""
+    try:
+        with open(path) as f:
+            tuning = json.load(f)
+        if tuning.get("format_version") != TUNING_FORMAT_VERSION:
+            tuning = None
+    except (OSError, ValueError):
+        tuning = None
+    tuning = tuning or {"format_version": TUNING_FORMAT_VERSION, "hosts": {}}
+    tuning["hosts"][signature or host_signature()] = profile
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(tuning, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def apply_thread_settings(threads=None, interop_threads=None, cpus=None):
+    """
+    Configure the current process: pin it to ``cpus`` and set torch's
+    intra-op and inter-op thread counts. The inter-op count can only be set
+    before torch runs any parallel work, so a late call keeps the default.
+    """
+    import torch
+
+    if cpus and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, cpus)
+        except OSError as e:
+            print(f"⚠️ Could not pin process {os.getpid()} to CPUs {cpus}: {e}")
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            pass
@@ -0,0 +1,392 @@
+"""
+Allocation-free decode engine for the image token loop.
+
+The straightforward loop grows ``past_key_values`` with ``torch.cat`` on every
+step (re-copying the whole cache), duplicates the sampled token into the
+cond/uncond pair with another ``torch.cat`` and runs a full-vocabulary softmax
+and a separate CFG mix. Over ~576 sequential steps that overhead adds up on CPU.
+
+``DecodeEngine`` keeps the batch's KV cache in buffers preallocated for the
+prompt plus every remaining image token, writes each step's keys and values in
+place, reuses fixed buffers for the attention mask, position ids and sampled
+tokens, and fuses CFG, temperature and sampling into one pass using the
+Gumbel-max trick (``argmax(logits / T - log(E))`` with ``E ~ Exp(1)`` samples
+from ``softmax(logits / T)`` without normalising it).
+
+With ``compile`` the model part of the step (image token embedding, language
+model and gen_head) runs through torch.compile instead of eagerly, cutting
+the Python dispatch and kernel launch overhead of its hundreds of small ops.
+To keep shapes fixed from step to step the KV cache is then a StaticKVCache:
+attention spans the cache up to the next multiple of SPAN_GRANULARITY
+positions, the ones not written yet masked out by a 4D attention mask, so
+shapes only change when sequences join or leave the batch or the span grows.
+A graph is compiled per shape (dynamic shapes compile to much slower CPU
+code), those of batches of guided sequences ahead of time when the cache is
+allocated. If compiling fails the engine runs eagerly instead.
+"""
+
+import time
+
+import torch
+from transformers import DynamicCache
+
+# Preallocated cache lengths are rounded up to a multiple of this
+CAPACITY_GRANULARITY = 64
+# Smallest StaticKVCache: Janus' 576 image tokens after a prompt of up to 192
+# tokens, so the compiled step keeps its shapes across ordinary requests
+STATIC_MIN_CAPACITY = 768
+# Attention span steps of a StaticKVCache; each span is a compiled shape
+SPAN_GRANULARITY = 256
+
+
+class PreallocatedKVCache(DynamicCache):
+    """
+    KV cache backed by buffers of a fixed capacity.
+
+    ``update`` copies the new keys/values into the buffers and returns views
+    of the filled part, so no per-step allocation or copy of the existing
+    cache is needed.
+    """
+
+    def __init__(self, num_layers, max_rows, num_heads, capacity, head_dim, dtype, device):
+        super().__init__()
+        shape = (max_rows, num_heads, capacity, head_dim)
+        self.key_buffers = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+        self.value_buffers = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+        self.num_layers = num_layers
+        self.max_rows = max_rows
+        self.capacity = capacity
+        self.rows = 0
+        self.length = 0
+
+    def update(self, key_states, value_states, layer_idx, *args, **kwargs):
+        start = self.length
+        end = start + key_states.shape[2]
+        if end > self.capacity:
+            raise RuntimeError(f"KV cache capacity exceeded ({end} > {self.capacity})")
+
+        keys = self.key_buffers[layer_idx][:self.rows]
+        values = self.value_buffers[layer_idx][:self.rows]
+        keys[:, :, start:end] = key_states
+        values[:, :, start:end] = value_states
+        if layer_idx == self.num_layers - 1:
+            # Every layer of this forward pass has written its positions
+            self.length = end
+        return keys[:, :, :end], values[:, :, :end]
+
+    def get_seq_length(self, layer_idx=0):
+        return self.length
+
+    def get_max_length(self):
+        return None
+
+    def get_mask_sizes(self, query_length, layer_idx=0):
+        if isinstance(query_length, torch.Tensor):
+            # Older signature passes cache_position
+            query_length = query_length.shape[0]
+        return self.length + query_length, 0
+
+    def layers_view(self):
+        """Return the filled part of the cache as (key, value) tensors per layer."""
+        return [
+            (k[:self.rows, :, :self.length], v[:self.rows, :, :self.length])
+            for k, v in zip(self.key_buffers, self.value_buffers)
+        ]
+
+    def load(self, layers, length):
+        """Replace the cache contents with ``layers`` (each (rows, heads, length, dim))."""
+        rows = layers[0][0].shape[0]
+        for layer_idx, (k, v) in enumerate(layers):
+            self.key_buffers[layer_idx][:rows, :, :length] = k
+            self.value_buffers[layer_idx][:rows, :, :length] = v
+        self.rows = rows
+        self.length = length
+
+
+class StaticKVCache(PreallocatedKVCache):
+    """
+    PreallocatedKVCache with fixed shapes for compiled decode steps.
+
+    ``update`` writes the new keys/values at the position held in the
+    ``write_position`` tensor and returns the first ``span`` positions of the
+    buffers, so the compiled graph depends on neither the written position
+    nor the cache length. The caller sets ``span``, masks out the positions
+    not written yet and advances ``length`` after each step.
+    """
+
+    def __init__(self, num_layers, max_rows, num_heads, capacity, head_dim, dtype, device):
+        super().__init__(num_layers, max_rows, num_heads, capacity, head_dim, dtype, device)
+        self.write_position = torch.zeros((1,), dtype=torch.long, device=device)
+        self.span = capacity
+
+    def update(self, key_states, value_states, layer_idx, *args, **kwargs):
+        keys = self.key_buffers[layer_idx][:self.rows]
+        values = self.value_buffers[layer_idx][:self.rows]
+        keys.index_copy_(2, self.write_position, key_states)
+        values.index_copy_(2, self.write_position, value_states)
+        return keys[:, :, :self.span], values[:, :, :self.span]
+
+    def get_mask_sizes(self, query_length, layer_idx=0):
+        return self.span, 0
+
+    def span_for(self, length):
+        """Attention span of a step writing position ``length``."""
+        return min(self.capacity, -(-(length + 1) // SPAN_GRANULARITY) * SPAN_GRANULARITY)
+
+
+def fused_cfg_sample(logits, cond_rows, uncond_rows, cfg_weight, temperature, generators, noise, work, out):
+    """
+    Mix conditional/unconditional logits, apply temperature and sample one
+    token per sequence in place.
+
+    ``logits`` holds the batch rows (rows, vocab); ``cond_rows`` and
+    ``uncond_rows`` (S,) give each sequence's rows in it. A sequence without
+    guidance passes its conditional row as both. ``cfg_weight`` and
+    ``temperature`` are (S, 1). ``noise`` and ``work`` are (S, vocab) float
+    scratch buffers and the sampled ids are written to ``out`` (S,). Each row's
+    noise comes from its own generator so sampling stays reproducible per
+    sequence.
+    """
+    if logits.dtype != work.dtype:
+        logits = logits.to(work.dtype)
+
+    # uncond + w * (cond - uncond) == lerp(uncond, cond, w); noise holds the
+    # conditional logits until it is refilled below
+    torch.index_select(logits, 0, uncond_rows, out=work)
+    torch.index_select(logits, 0, cond_rows, out=noise)
+    work.lerp_(noise, cfg_weight)
+    work.div_(temperature)
+
+    for row, generator in enumerate(generators):
+        noise[row].exponential_(generator=generator)
+    noise.log_()
+    work.sub_(noise)
+    torch.argmax(work, dim=-1, out=out)
+    return out
+
+
+class DecodeEngine:
+    """
+    Owns the batched decode state (KV cache, attention mask, position ids,
+    sampling parameters and last sampled tokens) in preallocated buffers.
+
+    Rows are laid out per sequence: its conditional row, followed by its
+    unconditional row while it still uses guidance (``seq.rows`` is 2). The
+    batch is replaced with ``load`` whenever sequences join or leave or drop
+    their unconditional row; in between, ``step`` advances every sequence by
+    one token without allocating new state.
+
+    With ``compile`` the model part of the step runs through torch.compile
+    on a StaticKVCache (see the module docstring).
+    """
+
+    def __init__(self, mmgpt, max_sequences: int, compile: bool = False):
+        self.mmgpt = mmgpt
+        self.device = next(mmgpt.parameters()).device
+        self.max_sequences = max_sequences
+        self.max_rows = 2 * max_sequences
+
+        self.cache = None
+        self.sequences = 0
+        self.rows = 0
+        self._attention_mask = None
+        self._position_ids = torch.zeros((self.max_rows, 1), dtype=torch.long, device=self.device)
+        self._row_tokens = torch.zeros((self.max_rows,), dtype=torch.long, device=self.device)
+        self._row_sequence = torch.zeros((self.max_rows,), dtype=torch.long, device=self.device)
+        self._cond_rows = torch.zeros((max_sequences,), dtype=torch.long, device=self.device)
+        self._uncond_rows = torch.zeros((max_sequences,), dtype=torch.long, device=self.device)
+        self._scheduled = []  # Indices of sequences whose guidance weight changes per step
+        self._cfg_weight = torch.zeros((max_sequences, 1), dtype=torch.float32, device=self.device)
+        self._temperature = torch.ones((max_sequences, 1), dtype=torch.float32, device=self.device)
+        self._tokens = torch.zeros((max_sequences,), dtype=torch.long, device=self.device)
+        self._noise = None
+        self._work = None
+        self._attention_bias = None  # (rows, 1, 1, capacity) additive mask of a StaticKVCache
+        self._compiled = None
+        if compile:
+            try:
+                self._compiled = torch.compile(self._model_logits, dynamic=False)
+            except Exception as e:
+                print(f"⚠️ torch.compile is not available, decoding eagerly: {e}")
+        self.compile = self._compiled is not None
+
+    def layers(self):
+        """Current cache contents as per-layer (key, value) views."""
+        return self.cache.layers_view() if self.cache is not None else None
+
+    def attention_mask(self):
+        """Current attention mask view, (rows, cache length)."""
+        return self._attention_mask[:self.rows, :self.cache.length] if self.cache is not None else None
+
+    def load(self, layers, attention_mask, sequences):
+        """
+        Replace the batch with ``sequences`` whose merged KV cache is ``layers``.
+
+        Buffers are (re)allocated if they cannot hold the prompt plus every
+        remaining token of the longest running sequence.
+        """
+        self.sequences = len(sequences)
+        self.rows = sum(seq.rows for seq in sequences)
+        if not sequences:
+            return
+
+        length = attention_mask.shape[1]
+        remaining = max(seq.image_token_num_per_image - seq.step for seq in sequences)
+        self._ensure_capacity(layers, length + remaining)
+
+        self.cache.load(layers, length)
+        self._attention_mask[:self.rows, :length] = attention_mask
+        if self._attention_bias is not None:
+            self._attention_mask[:self.rows, length:] = 0
+            bias = self._attention_bias[:self.rows, 0, 0]
+            bias.fill_(torch.finfo(bias.dtype).min)
+            bias.masked_fill_(self._attention_mask[:self.rows].bool(), 0)
+        row = 0
+        for index, seq in enumerate(sequences):
+            self._position_ids[row:row + seq.rows] = seq.position
+            self._row_sequence[row:row + seq.rows] = index
+            self._cond_rows[index] = row
+            self._uncond_rows[index] = row + 1 if seq.rows == 2 else row
+            self._cfg_weight[index] = seq.current_cfg_weight
+            self._temperature[index] = max(seq.temperature, 1e-5)
+            self._tokens[index] = int(seq.generated_tokens[0, seq.step - 1])
+            row += seq.rows
+        self._scheduled = [index for index, seq in enumerate(sequences) if not seq.cfg_schedule.constant]
+
+    def step(self, sequences):
+        """
+        Run one decode step for every sequence (in the order they were loaded)
+        and return the sampled tokens as a list, in sequence order.
+        """
+        rows, count = self.rows, self.sequences
+        length = self.cache.length
+
+        for index in self._scheduled:
+            self._cfg_weight[index] = sequences[index].current_cfg_weight
+
+        # Feed the last sampled token to every row of its sequence
+        torch.index_select(self._tokens[:count], 0, self._row_sequence[:rows], out=self._row_tokens[:rows])
+
+        self._attention_mask[:rows, length] = 1
+        if self._attention_bias is not None:
+            self.cache.write_position.fill_(length)
+            self.cache.span = self.cache.span_for(length)
+            self._attention_bias[:rows, :, :, length] = 0
+            logits = self._static_logits(rows)
+            self.cache.length = length + 1
+        else:
+            logits = self._model_logits(
+                self._row_tokens[:rows], self._attention_mask[:rows, :length + 1], self._position_ids[:rows], self.cache
+            )
+        self._position_ids[:rows] += 1
+
+        if self._work is None or self._work.shape[1] != logits.shape[-1]:
+            self._noise = torch.empty((self.max_sequences, logits.shape[-1]), dtype=torch.float32, device=self.device)
+            self._work = torch.empty_like(self._noise)
+        fused_cfg_sample(
+            logits,
+            self._cond_rows[:count],
+            self._uncond_rows[:count],
+            self._cfg_weight[:count],
+            self._temperature[:count],
+            [seq.generator for seq in sequences],
+            self._noise[:count],
+            self._work[:count],
+            self._tokens[:count],
+        )
+        return self._tokens[:count].tolist()
+
+    def _model_logits(self, row_tokens, attention_mask, position_ids, cache):
+        """Image token logits of the next position of every row."""
+        inputs_embeds = self.mmgpt.prepare_gen_img_embeds(row_tokens).unsqueeze(dim=1)
+        outputs = self.mmgpt.language_model.model(
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=cache,
+            use_cache=True,
+        )
+        return self.mmgpt.gen_head(outputs.last_hidden_state[:, -1, :])
+
+    def _static_logits(self, rows):
+        """_model_logits on the StaticKVCache, compiled unless compiling failed."""
+        args = (
+            self._row_tokens[:rows], self._attention_bias[:rows, :, :, :self.cache.span], self._position_ids[:rows],
+            self.cache,
+        )
+        if self._compiled is not None:
+            try:
+                return self._compiled(*args)
+            except Exception as e:
+                # Writing the step's keys and values again is harmless
+                print(f"⚠️ Compiled decode step failed, decoding eagerly from now on: {e}")
+                self._compiled = None
+        return self._model_logits(*args)
+
+    def _precompile(self):
+        """
+        Compile the step for every attention span of batches of 1 to
+        max_sequences guided sequences, with dummy steps on the empty cache.
+        """
+        start = time.perf_counter()
+        spans = sorted({self.cache.span_for(length) for length in range(self.cache.capacity)})
+        print(f"Compiling the decode step for {self.max_sequences * len(spans)} batch shapes...")
+        # One graph per batch rows and attention span. The limit is per thread,
+        # and this runs on the thread stepping the engine
+        for name in ("recompile_limit", "cache_size_limit"):
+            if hasattr(torch._dynamo.config, name):
+                limit = max(getattr(torch._dynamo.config, name), 2 * self.max_rows * len(spans))
+                setattr(torch._dynamo.config, name, limit)
+        for rows in range(2, self.max_rows + 1, 2):
+            for span in spans:
+                if self._compiled is None:
+                    return
+                self.cache.rows, self.cache.span = rows, span
+                self.cache.write_position.fill_(span - 1)
+                self._static_logits(rows)
+        self.cache.rows = 0
+        print(f"Decode step compiled in {time.perf_counter() - start:.1f}s")
+
+    def sample(self, logits, sequences):
+        """
+        Sample one token per sequence from prefill logits (cond/uncond pairs),
+        outside the batch.
+        """
+        count = len(sequences)
+        vocab = logits.shape[-1]
+        out = torch.zeros((count,), dtype=torch.long, device=self.device)
+        cond_rows = torch.arange(0, 2 * count, 2, device=self.device)
+        fused_cfg_sample(
+            logits,
+            cond_rows,
+            cond_rows + 1,
+            logits.new_tensor([[seq.current_cfg_weight] for seq in sequences], dtype=torch.float32),
+            logits.new_tensor([[max(seq.temperature, 1e-5)] for seq in sequences], dtype=torch.float32),
+            [seq.generator for seq in sequences],
+            torch.empty((count, vocab), dtype=torch.float32, device=self.device),
+            torch.empty((count, vocab), dtype=torch.float32, device=self.device),
+            out,
+        )
+        return out.tolist()
+
+    def _ensure_capacity(self, layers, required):
+        key = layers[0][0]
+        num_heads, head_dim = key.shape[1], key.shape[3]
+        if (
+            self.cache is not None
+            and self.cache.capacity >= required
+            and self.cache.key_buffers[0].dtype == key.dtype
+        ):
+            return
+
+        capacity = -(-required // CAPACITY_GRANULARITY) * CAPACITY_GRANULARITY
+        cache_type = PreallocatedKVCache
+        if self.compile:
+            capacity = max(capacity, STATIC_MIN_CAPACITY)
+            cache_type = StaticKVCache
+        print(f"Allocating decode buffers: {self.max_rows} rows x {capacity} positions")
+        self.cache = cache_type(len(layers), self.max_rows, num_heads, capacity, head_dim, key.dtype, key.device)
+        self._attention_mask = torch.zeros((self.max_rows, capacity), dtype=torch.long, device=self.device)
+        if self.compile:
+            self._attention_bias = torch.zeros((self.max_rows, 1, 1, capacity), dtype=key.dtype, device=self.device)
+            self._precompile()
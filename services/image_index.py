@@ -0,0 +1,229 @@
+"""
+Index of the generated images in ``generated_samples`` with a retention policy.
+
+Every stored image is recorded with its metadata (task id, prompt hash,
+user and project id, size, creation time) in creation order, overall and
+per project, so the latest image (of a project) is found without listing the
+folder. A background thread deletes the oldest images once they exceed the
+configured age, count or total size and saves the index to a JSON file
+so it survives restarts; files written while the index was not saved are
+picked up from the folder at startup.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+
+ImageRecord = collections.namedtuple(
+    "ImageRecord", ["name", "size", "created", "task_id", "prompt_hash", "user_id", "project_id"]
+)
+
+
+def prompt_hash(prompt: str) -> str:
+    """Short stable hash identifying a prompt without storing it."""
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+
+
+class ImageIndex:
+    """
+    Creation-ordered records of the image files in ``directory`` whose names
+    start with ``prefix``. max_age (seconds), max_count and max_bytes bound
+    what is kept; 0 or None disables a bound. ``on_remove`` is called with the
+    name of every image the retention policy deletes. The index is saved to
+    ``index_path``, by default ``index.json`` in ``directory``; keep it out of
+    a directory that is served publicly.
+    """
+
+    def __init__(self, directory: str, prefix: str, extensions, max_age=None, max_count=None, max_bytes=None,
+                 on_remove=None, index_path: str = None):
+        self.directory = directory
+        self.prefix = prefix
+        self.extensions = tuple(extensions)
+        self.max_age = max_age
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.on_remove = on_remove
+        self.index_path = index_path or os.path.join(directory, "index.json")
+        self.removed = 0
+
+        self._records = collections.OrderedDict()  # name -> ImageRecord, oldest first
+        self._by_project = {}  # project id -> OrderedDict of names, oldest first
+        self._total_bytes = 0
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def add(self, name: str, size: int, task_id=None, prompt=None, user_id=None, project_id=None, created=None):
+        """
+        Record a stored image as the newest one. An image that is already
+        indexed (the same bytes) keeps the metadata the new record lacks.
+        """
+        record = ImageRecord(
+            name, int(size), created if created is not None else time.time(), task_id,
+            prompt_hash(prompt) if prompt else None,
+            str(user_id) if user_id is not None else None,
+            str(project_id) if project_id is not None else None,
+        )
+        with self._lock:
+            previous = self._records.get(name)
+            if previous is not None:
+                record = record._replace(**{
+                    field: getattr(previous, field)
+                    for field in ("task_id", "prompt_hash", "user_id", "project_id")
+                    if getattr(record, field) is None
+                })
+                self._discard(name)
+            self._insert(record)
+            self._dirty = True
+        return record
+
+    def latest(self, project_id=None):
+        """Return the newest ImageRecord, of ``project_id`` if given, or None."""
+        with self._lock:
+            if project_id is None:
+                names = self._records
+            else:
+                names = self._by_project.get(str(project_id))
+            if not names:
+                return None
+            return self._records[next(reversed(names))]
+
+    def get(self, name: str):
+        with self._lock:
+            return self._records.get(name)
+
+    def stats(self):
+        """Return the number and total size of indexed images and the retention bounds."""
+        with self._lock:
+            return {
+                "images": len(self._records),
+                "bytes": self._total_bytes,
+                "projects": len(self._by_project),
+                "removed": self.removed,
+                "max_age": self.max_age,
+                "max_count": self.max_count,
+                "max_bytes": self.max_bytes,
+            }
+
+    def collect(self, now=None):
+        """
+        Delete the oldest images beyond the retention bounds. Returns the
+        names of the deleted images.
+        """
+        now = now if now is not None else time.time()
+        expired = []
+        with self._lock:
+            while self._records:
+                name, record = next(iter(self._records.items()))
+                if not (
+                    (self.max_age and now - record.created > self.max_age)
+                    or (self.max_count and len(self._records) > self.max_count)
+                    or (self.max_bytes and self._total_bytes > self.max_bytes)
+                ):
+                    break
+                self._discard(name)
+                expired.append(name)
+            if expired:
+                self._dirty = True
+                self.removed += len(expired)
+
+        for name in expired:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            if self.on_remove is not None:
+                self.on_remove(name)
+        if expired:
+            print(f"Retention policy removed {len(expired)} generated image(s)")
+        return expired
+
+    def save(self):
+        """Write the index to disk if it changed since the last save."""
+        with self._lock:
+            if not self._dirty:
+                return
+            records = [record._asdict() for record in self._records.values()]
+            self._dirty = False
+        tmp_path = f"{self.index_path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(records, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            self._dirty = True
+            print(f"Could not save the image index: {e}")
+
+    def start(self, interval: float = 300.0):
+        """Run the retention policy and save the index every ``interval`` seconds."""
+        def _loop():
+            while not self._stop.wait(interval):
+                try:
+                    self.collect()
+                    self.save()
+                except Exception as e:
+                    print(f"❌ Image retention pass failed: {e}")
+
+        self.collect()
+        self._thread = threading.Thread(target=_loop, name="image-index-gc", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop.set()
+        self.save()
+
+    def _insert(self, record):
+        self._records[record.name] = record
+        self._total_bytes += record.size
+        if record.project_id is not None:
+            self._by_project.setdefault(record.project_id, collections.OrderedDict())[record.name] = None
+
+    def _discard(self, name):
+        record = self._records.pop(name, None)
+        if record is None:
+            return
+        self._total_bytes -= record.size
+        if record.project_id is not None:
+            names = self._by_project[record.project_id]
+            names.pop(name, None)
+            if not names:
+                del self._by_project[record.project_id]
+
+    def _load(self):
+        records = {}
+        try:
+            with open(self.index_path) as f:
+                for fields in json.load(f):
+                    record = ImageRecord(**fields)
+                    records[record.name] = record
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError) as e:
+            print(f"Could not read the image index, rebuilding it: {e}")
+
+        # Reconcile with the folder: forget deleted files, add unindexed ones
+        found = {}
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith(self.prefix) and entry.name.rpartition(".")[2] in self.extensions:
+                found[entry.name] = entry
+        for name, entry in found.items():
+            if name not in records:
+                stat = entry.stat()
+                records[name] = ImageRecord(name, stat.st_size, stat.st_mtime, None, None, None, None)
+                self._dirty = True
+        if len(records) != len(found):
+            self._dirty = True
+
+        for record in sorted(records.values(), key=lambda record: record.created):
+            if record.name in found:
+                self._insert(record)
+        if self._records:
+            print(f"Indexed {len(self._records)} generated images ({self._total_bytes} bytes)")
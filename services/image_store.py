@@ -0,0 +1,218 @@
+"""
+Store of generated images: encoded bytes kept in memory and written to disk
+in the background.
+
+Images are named after a hash of their encoded bytes, so two images finished
+in the same second never overwrite each other and an identical image is only
+stored once. The most recently used images stay in a size-bounded in-memory
+cache and are served from there without touching the disk; the hash doubles
+as the HTTP ETag. Files are written by a background thread so generation
+threads do not wait for the disk, and entries stay pinned in memory until
+their file exists.
+"""
+
+import collections
+import hashlib
+import io
+import os
+import queue
+import re
+import threading
+import time
+
+from metrics import STAGE_SECONDS
+
+# Output formats by request name: PIL format, file extension and mimetype
+IMAGE_FORMATS = {
+    "jpeg": ("JPEG", "jpg", "image/jpeg"),
+    "webp": ("WEBP", "webp", "image/webp"),
+    "png": ("PNG", "png", "image/png"),
+}
+DEFAULT_IMAGE_FORMAT = "jpeg"
+
+MIMETYPES = {extension: mimetype for _, extension, mimetype in IMAGE_FORMATS.values()}
+
+# Names of the image files: the prefix, a hex content hash (a timestamp for
+# images of older versions) and the extension of an output format
+IMAGE_NAME = re.compile(r"[0-9a-f]+\.(?:" + "|".join(re.escape(extension) for extension in MIMETYPES) + r")")
+
+StoredImage = collections.namedtuple("StoredImage", ["name", "path", "data", "mimetype", "etag"])
+
+
+def validate_format(image_format, quality=None):
+    """
+    Normalize a requested output format and quality, raising ValueError for
+    unknown formats or qualities outside 1-100.
+    """
+    image_format = (image_format or DEFAULT_IMAGE_FORMAT).lower()
+    if image_format == "jpg":
+        image_format = "jpeg"
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f"Unknown image format '{image_format}', expected one of {', '.join(IMAGE_FORMATS)}")
+    if quality is not None:
+        quality = int(quality)
+        if not 1 <= quality <= 100:
+            raise ValueError("quality must be between 1 and 100")
+    return image_format, quality
+
+
+def encode_image(image, image_format=DEFAULT_IMAGE_FORMAT, quality=None):
+    """
+    Encode a PIL image. quality applies to JPEG and WebP; None keeps PIL's default.
+    """
+    pil_format = IMAGE_FORMATS[image_format][0]
+    options = {"quality": quality} if quality is not None and image_format != "png" else {}
+    buffer = io.BytesIO()
+    image.save(buffer, format=pil_format, **options)
+    return buffer.getvalue()
+
+
+class ImageStore:
+    """
+    Content-addressed image files under ``directory`` with an LRU of their
+    bytes in memory, bounded by ``max_bytes`` (pinned unwritten images excepted).
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 128 * 1024 * 1024, prefix: str = "generated_image_"):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = collections.OrderedDict()  # name -> StoredImage, oldest first
+        self._total_bytes = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._start_writer()
+        # Threads do not survive a fork; worker processes need their own writer
+        os.register_at_fork(after_in_child=self._start_writer)
+
+    def _start_writer(self):
+        self._pending = {}  # name -> Event set once the file is written
+        self._lock = threading.Lock()
+        self._writes = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="image-store-writer", daemon=True)
+        self._writer.start()
+
+    def put(self, data: bytes, extension: str = "jpg", wait: bool = False) -> StoredImage:
+        """
+        Add encoded image bytes and schedule writing them to disk. With
+        ``wait`` the file exists when this returns, e.g. for other processes.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        name = f"{self.prefix}{digest[:32]}.{extension}"
+        image = StoredImage(name, self._path(name), data, MIMETYPES.get(extension, "application/octet-stream"), digest)
+
+        with self._lock:
+            if name in self._entries:
+                self._entries.move_to_end(name)
+                written = self._pending.get(name)
+            else:
+                self._remember(image)
+                written = None
+                if not os.path.exists(image.path):
+                    written = self._pending[name] = threading.Event()
+                    self._writes.put(image)
+            self._evict()
+
+        if wait and written is not None:
+            written.wait()
+        return image
+
+    def is_image_name(self, name: str) -> bool:
+        """Whether ``name`` is the name of an image file of this store."""
+        return name.startswith(self.prefix) and IMAGE_NAME.fullmatch(name[len(self.prefix):]) is not None
+
+    def get(self, name: str):
+        """Return the StoredImage called ``name``, from memory or disk, or None."""
+        if not name or os.path.basename(name) != name or name.startswith("."):
+            return None
+        with self._lock:
+            image = self._entries.get(name)
+            if image is not None:
+                self._entries.move_to_end(name)
+                self.hits += 1
+                return image
+            self.misses += 1
+
+        # Written by another process, by an earlier run or evicted from memory
+        path = self._path(name)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        extension = name.rpartition(".")[2]
+        image = StoredImage(
+            name, path, data, MIMETYPES.get(extension, "application/octet-stream"), hashlib.sha256(data).hexdigest()
+        )
+        with self._lock:
+            if name not in self._entries:
+                self._remember(image)
+                self._evict()
+        return image
+
+    def discard(self, name: str):
+        """Drop an image from memory, e.g. once its file was deleted."""
+        with self._lock:
+            image = self._entries.pop(name, None)
+            if image is not None:
+                self._total_bytes -= len(image.data)
+
+    def flush(self, timeout=None):
+        """Wait until every scheduled file has been written. Returns False on timeout."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            pending = list(self._pending.values())
+        for written in pending:
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            if not written.wait(remaining):
+                return False
+        return True
+
+    def stats(self):
+        """Return the cache size, hit/miss counters and the number of unwritten images."""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "pending_writes": len(self._pending),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _remember(self, image):
+        self._entries[image.name] = image
+        self._total_bytes += len(image.data)
+
+    def _evict(self):
+        if self._total_bytes <= self.max_bytes:
+            return
+        for name in list(self._entries):
+            if self._total_bytes <= self.max_bytes:
+                break
+            if name in self._pending:
+                continue  # Only on disk once written
+            self._total_bytes -= len(self._entries.pop(name).data)
+
+    def _write_loop(self):
+        while True:
+            image = self._writes.get()
+            tmp_path = f"{image.path}.tmp"
+            try:
+                with STAGE_SECONDS.labels("file_write").time():
+                    with open(tmp_path, "wb") as f:
+                        f.write(image.data)
+                    os.replace(tmp_path, image.path)
+            except OSError as e:
+                print(f"❌ Could not write image {image.name}: {e}")
+            with self._lock:
+                written = self._pending.pop(image.name, None)
+                self._evict()
+            if written is not None:
+                written.set()
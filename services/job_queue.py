@@ -0,0 +1,239 @@
+"""
+Bounded priority job queue served by a fixed pool of worker threads.
+
+``/generate`` used to start a new thread per request and answer 429 whenever
+another generation was running. Jobs now wait in a queue of configurable depth
+and a fixed set of workers feeds them to the generation pipeline, interactive
+jobs first. Only a full queue is rejected, together with an estimate of when to
+retry.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+import uuid
+
+from cancellation import GenerationCancelled, is_cancellation
+from metrics import GENERATIONS, QUEUE_WAIT_SECONDS
+
+# Priority levels, lower values are served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+PRIORITIES = {
+    "interactive": PRIORITY_INTERACTIVE,
+    "background": PRIORITY_BACKGROUND,
+}
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the queue is at its maximum depth."""
+
+    def __init__(self, depth, retry_after=None):
+        super().__init__(f"Generation queue is full ({depth} jobs waiting)")
+        self.depth = depth
+        self.retry_after = retry_after
+
+
+class GenerationJob:
+    """
+    A unit of work waiting for (or being processed by) a queue worker. A job
+    generating several images carries all of their tasks in ``task_ids``;
+    ``task_id`` is its first.
+    """
+
+    def __init__(self, args=(), kwargs=None, task_id=None, priority=PRIORITY_INTERACTIVE, handler=None,
+                 task_ids=None):
+        self.task_id = task_id or (task_ids[0] if task_ids else None)
+        self.task_ids = tuple(task_ids) if task_ids else ((task_id,) if task_id else ())
+        self.job_id = self.task_id or str(uuid.uuid4())
+        self.handler = handler  # Overrides the queue's handler
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.priority = priority
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.result = None
+        self.error = None
+        self.waiters = 0  # Synchronous requests waiting for the result
+        self._done = threading.Event()
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+
+    def wait(self, timeout=None):
+        """Block until a worker has processed the job and return its result."""
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"Job {self.job_id} did not finish in time")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def done(self):
+        return self._done.is_set()
+
+    def add_done_callback(self, callback):
+        """
+        Call ``callback(job)`` once the job is done, from the thread finishing
+        it, or right away if it already is.
+        """
+        with self._callbacks_lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _finish(self):
+        with self._callbacks_lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                print(f"Done callback of job {self.job_id} failed: {e}")
+
+
+class JobQueue:
+    """
+    Priority queue of generation jobs with a fixed number of worker threads.
+
+    Each worker calls ``handler(*job.args, **job.kwargs)``, or the job's own
+    handler if it has one, for one job at a time. Jobs with the same priority
+    are served in submission order.
+    """
+
+    def __init__(self, handler, max_depth: int = 32, num_workers: int = 4):
+        self.handler = handler
+        self.max_depth = max(1, max_depth)
+        self.num_workers = max(1, num_workers)
+
+        self._heap = []
+        self._counter = itertools.count()
+        self._running = {}
+        lock = threading.RLock()
+        self._condition = threading.Condition(lock)  # Wakes workers for queued jobs
+        self._idle = threading.Condition(lock)  # Wakes join() for finished or removed jobs
+        self._job_seconds = None  # Moving average of job durations
+
+        self._workers = []
+        for index in range(self.num_workers):
+            worker = threading.Thread(target=self._work, name=f"generation-worker-{index}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, job: GenerationJob) -> GenerationJob:
+        """Queue a job, raising QueueFullError if the queue is at capacity."""
+        with self._condition:
+            if len(self._heap) >= self.max_depth:
+                raise QueueFullError(len(self._heap), retry_after=self._estimate_wait(0))
+            heapq.heappush(self._heap, (job.priority, next(self._counter), job))
+            self._condition.notify()
+        return job
+
+    def position(self, job_id):
+        """
+        Return the number of jobs that will be served before ``job_id`` (a job
+        id or the id of one of a job's tasks), or None if the job is not
+        waiting in the queue.
+        """
+        with self._condition:
+            for position, (_, _, job) in enumerate(sorted(self._heap)):
+                if job.job_id == job_id or job_id in job.task_ids:
+                    return position
+        return None
+
+    def cancel(self, job_id, reason=None):
+        """
+        Remove a job that is still waiting from the queue; its waiters get
+        GenerationCancelled. Returns the job, or None if it is not waiting.
+        """
+        with self._condition:
+            for index, (_, _, job) in enumerate(self._heap):
+                if job.job_id == job_id:
+                    break
+            else:
+                return None
+            self._heap[index] = self._heap[-1]
+            self._heap.pop()
+            heapq.heapify(self._heap)
+            GENERATIONS.labels("cancelled").inc()
+            # join() may be waiting for this job
+            self._idle.notify_all()
+        job.error = GenerationCancelled(reason) if reason else GenerationCancelled()
+        job._finish()
+        return job
+
+    def estimate_wait(self, position):
+        """Estimate the seconds until the job at ``position`` starts running."""
+        with self._condition:
+            return self._estimate_wait(position)
+
+    def join(self, timeout=None):
+        """
+        Wait until no job is queued or running. Returns False if that did not
+        happen within ``timeout`` seconds.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._heap or self._running:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def stats(self):
+        """Return a snapshot of queue depth and worker utilisation."""
+        with self._condition:
+            return {
+                "queued": len(self._heap),
+                "running": len(self._running),
+                "max_depth": self.max_depth,
+                "workers": self.num_workers,
+                "avg_job_seconds": self._job_seconds,
+            }
+
+    def _estimate_wait(self, position):
+        if self._job_seconds is None:
+            return None
+        # Jobs ahead of this one are served num_workers at a time
+        rounds = position // self.num_workers
+        if len(self._running) >= self.num_workers:
+            rounds += 1
+        return rounds * self._job_seconds
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._heap:
+                    self._condition.wait()
+                _, _, job = heapq.heappop(self._heap)
+                job.started_at = time.time()
+                self._running[job.job_id] = job
+            QUEUE_WAIT_SECONDS.observe(job.started_at - job.submitted_at)
+
+            try:
+                job.result = (job.handler or self.handler)(*job.args, **job.kwargs)
+            except Exception as e:
+                if not is_cancellation(e):
+                    print(f"Job {job.job_id} failed: {e}")
+                job.error = e
+            finally:
+                elapsed = time.time() - job.started_at
+                with self._condition:
+                    self._running.pop(job.job_id, None)
+                    if job.error is None:
+                        outcome = "completed"
+                    elif is_cancellation(job.error):
+                        outcome = "cancelled"
+                    else:
+                        outcome = "failed"
+                    GENERATIONS.labels(outcome).inc()
+                    if job.error is None:
+                        if self._job_seconds is None:
+                            self._job_seconds = elapsed
+                        else:
+                            self._job_seconds = 0.8 * self._job_seconds + 0.2 * elapsed
+                    self._idle.notify_all()
+                job._finish()
@@ -0,0 +1,83 @@
+"""
+Helpers for manipulating transformer KV caches as plain per-layer tensors.
+
+The batch scheduler needs to merge and split the caches of independent
+sequences (left padding them to a common length) whenever a request joins or
+leaves the running batch. transformers has changed its cache representation
+several times (legacy tuples, DynamicCache with key_cache/value_cache lists,
+DynamicCache with layer objects), so everything here goes through
+``cache_layers`` / ``build_cache`` to stay version agnostic.
+"""
+
+import torch
+
+
+def cache_layers(past_key_values):
+    """
+    Return the cache as a list of (key, value) tensors, one pair per layer.
+    Each tensor has shape (batch, heads, seq_len, head_dim).
+    """
+    if hasattr(past_key_values, "layers"):
+        return [(layer.keys, layer.values) for layer in past_key_values.layers]
+    if hasattr(past_key_values, "key_cache"):
+        return list(zip(past_key_values.key_cache, past_key_values.value_cache))
+    return [(k, v) for k, v in past_key_values]
+
+
+def build_cache(layers):
+    """Wrap a list of (key, value) tensors in the cache type the model expects."""
+    from transformers import DynamicCache
+
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(tuple(layers))
+    return DynamicCache(layers)
+
+
+def left_pad(layers, attention_mask, length):
+    """
+    Left pad every layer (and the matching attention mask) with zeros up to
+    ``length`` positions. Padded positions are masked out so they never
+    contribute to attention.
+    """
+    current = attention_mask.shape[1]
+    if current >= length:
+        return layers, attention_mask
+
+    pad = length - current
+    padded = []
+    for k, v in layers:
+        k_pad = k.new_zeros((k.shape[0], k.shape[1], pad, k.shape[3]))
+        v_pad = v.new_zeros((v.shape[0], v.shape[1], pad, v.shape[3]))
+        padded.append((torch.cat([k_pad, k], dim=2), torch.cat([v_pad, v], dim=2)))
+    mask_pad = attention_mask.new_zeros((attention_mask.shape[0], pad))
+    return padded, torch.cat([mask_pad, attention_mask], dim=1)
+
+
+def concat_rows(layers_a, mask_a, layers_b, mask_b):
+    """Concatenate two caches along the batch dimension, padding the shorter one."""
+    length = max(mask_a.shape[1], mask_b.shape[1])
+    layers_a, mask_a = left_pad(layers_a, mask_a, length)
+    layers_b, mask_b = left_pad(layers_b, mask_b, length)
+    layers = [
+        (torch.cat([ka, kb], dim=0), torch.cat([va, vb], dim=0))
+        for (ka, va), (kb, vb) in zip(layers_a, layers_b)
+    ]
+    return layers, torch.cat([mask_a, mask_b], dim=0)
+
+
+def select_rows(layers, attention_mask, rows):
+    """
+    Keep only the given batch rows and drop leading positions that are padding
+    for every remaining row, so a long finished prompt does not keep the whole
+    batch padded.
+    """
+    index = torch.as_tensor(rows, dtype=torch.long, device=attention_mask.device)
+    attention_mask = attention_mask.index_select(0, index)
+    layers = [(k.index_select(0, index), v.index_select(0, index)) for k, v in layers]
+
+    used = attention_mask.any(dim=0).nonzero()
+    start = int(used[0]) if len(used) else attention_mask.shape[1]
+    if start > 0:
+        attention_mask = attention_mask[:, start:]
+        layers = [(k[:, :, start:], v[:, :, start:]) for k, v in layers]
+    return layers, attention_mask
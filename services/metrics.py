@@ -0,0 +1,313 @@
+"""
+Minimal Prometheus metrics: counters, gauges and histograms rendered in the
+text exposition format for the ``/metrics`` endpoint.
+
+Kept dependency free on purpose; the service only needs a handful of metric
+types and no push gateway or multiprocess file store. Worker processes (see
+worker_pool) send ``snapshot()`` to the parent, which merges them with
+``merge`` so ``/metrics`` covers every process.
+"""
+
+import bisect
+import math
+import threading
+import time
+
+# Seconds; covers ~1ms per-token steps up to multi-minute generations
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0,
+)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def labels(self, *values):
+        """Return the child metric for one combination of label values."""
+        values = tuple(str(v) for v in values)
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+        return _Child(self, values)
+
+    def snapshot(self):
+        with self._lock:
+            return {values: self._copy(state) for values, state in self._values.items()}
+
+    def _copy(self, state):
+        return state
+
+
+class _Child:
+    def __init__(self, metric, values):
+        self._metric = metric
+        self._values = values
+
+    def __getattr__(self, name):
+        method = getattr(self._metric, name)
+        return lambda *args, **kwargs: method(*args, _labels=self._values, **kwargs)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, _labels=()):
+        with self._lock:
+            self._values[_labels] = self._values.get(_labels, 0) + amount
+
+    def samples(self, states):
+        for values, value in states.items():
+            yield self.name + "_total", _format_labels(self.labelnames, values), value
+
+
+class Gauge(_Metric):
+    """Gauge set explicitly or computed on scrape by ``set_function``."""
+
+    kind = "gauge"
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        super().__init__(registry, name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value, _labels=()):
+        with self._lock:
+            self._values[_labels] = value
+
+    def inc(self, amount=1, _labels=()):
+        with self._lock:
+            self._values[_labels] = self._values.get(_labels, 0) + amount
+
+    def dec(self, amount=1, _labels=()):
+        self.inc(-amount, _labels=_labels)
+
+    def set_function(self, function):
+        self._function = function
+
+    def snapshot(self):
+        if self._function is not None:
+            try:
+                value = self._function()
+            except Exception:
+                value = None
+            return {(): value} if value is not None else {}
+        return super().snapshot()
+
+    def samples(self, states):
+        for values, value in states.items():
+            yield self.name, _format_labels(self.labelnames, values), value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, _labels=()):
+        with self._lock:
+            state = self._values.get(_labels)
+            if state is None:
+                state = self._values[_labels] = [[0] * len(self.buckets), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, _labels=()):
+        """Context manager observing the duration of its block."""
+        return _Timer(lambda seconds: self.observe(seconds, _labels=_labels))
+
+    def _copy(self, state):
+        return [list(state[0]), state[1], state[2]]
+
+    def samples(self, states):
+        for values, (counts, total, count) in states.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, values, [("le", _format_value(bound))])
+                yield self.name + "_bucket", labels, cumulative
+            labels = _format_labels(self.labelnames, values)
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, count
+
+
+class _Timer:
+    def __init__(self, record):
+        self._record = record
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self._start
+        self._record(self.seconds)
+        return False
+
+
+class InstrumentedLock:
+    """Lock that records how long callers wait to acquire it."""
+
+    def __init__(self, wait_histogram, lock=None):
+        self._lock = lock if lock is not None else threading.Lock()
+        self._wait = wait_histogram
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        self._wait.observe(time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._external = {}  # Snapshots of other processes by source id
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+
+    def snapshot(self):
+        """
+        State of this process' counters, histograms and explicitly set gauges,
+        picklable for merging elsewhere. Merged gauges are summed.
+        """
+        return {
+            name: metric.snapshot()
+            for name, metric in self._metrics.items()
+            if metric.kind != "gauge" or metric._function is None
+        }
+
+    def merge(self, source, snapshot):
+        """Replace the last snapshot received from another process."""
+        with self._lock:
+            self._external[source] = snapshot
+
+    def forget(self, source):
+        with self._lock:
+            self._external.pop(source, None)
+
+    def reset(self):
+        """Clear every recorded value, e.g. in a freshly forked worker process."""
+        with self._lock:
+            self._external.clear()
+            for metric in self._metrics.values():
+                with metric._lock:
+                    metric._values.clear()
+
+    def render(self):
+        """Render every metric in the Prometheus text format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+            external = list(self._external.values())
+
+        lines = []
+        for metric in metrics:
+            states = metric.snapshot()
+            for snapshot in external:
+                for values, state in snapshot.get(metric.name, {}).items():
+                    states[values] = _combine(states.get(values), state)
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples(states):
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _combine(state, other):
+    if state is None:
+        return other
+    if isinstance(state, list):
+        return [[a + b for a, b in zip(state[0], other[0])], state[1] + other[1], state[2] + other[2]]
+    return state + other
+
+
+def resident_memory_bytes():
+    """Current resident set size of this process, or None if unavailable."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+REGISTRY = Registry()
+
+# Service metrics, shared by the modules that record them
+STAGE_SECONDS = Histogram(
+    REGISTRY, "janus_stage_seconds", "Time spent in each stage of generating an image", ["stage"]
+)
+DECODE_STEP_SECONDS = Histogram(
+    REGISTRY, "janus_decode_step_seconds", "Time of one batched image token decode step", ["batch_size"]
+)
+LOCK_WAIT_SECONDS = Histogram(
+    REGISTRY, "janus_lock_wait_seconds", "Time spent waiting to acquire a service lock", ["lock"],
+    buckets=(0.00001, 0.0001, 0.001, 0.01, 0.1, 1.0, 10.0),
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    REGISTRY, "janus_queue_wait_seconds", "Time a generation job waited for a worker"
+)
+GENERATIONS = Counter(
+    REGISTRY, "janus_generations", "Finished generation jobs by outcome", ["outcome"]
+)
+QUEUED_JOBS = Gauge(REGISTRY, "janus_queue_depth", "Generation jobs waiting for a worker")
+ACTIVE_JOBS = Gauge(REGISTRY, "janus_active_jobs", "Generation jobs being processed")
+BATCH_SIZE = Gauge(REGISTRY, "janus_batch_size", "Sequences in the decode batch")
+TASKS = Gauge(REGISTRY, "janus_tasks", "Task records held for progress polling")
+TASKS_EVICTED = Counter(
+    REGISTRY, "janus_tasks_evicted", "Finished task records evicted from the task store", ["reason"]
+)
+MODEL_LOAD_SECONDS = Gauge(REGISTRY, "janus_model_load_seconds", "Time the last model load took")
+MODEL_RESIDENT = Gauge(REGISTRY, "janus_model_resident", "1 while the model is loaded, 0 once freed as idle")
+MODEL_EVENTS = Counter(REGISTRY, "janus_model_events", "Model loads and idle evictions", ["event"])
+MODEL_EVENT_SECONDS = Histogram(
+    REGISTRY, "janus_model_event_seconds", "Time taken to load or free the model", ["event"]
+)
+STARTUP_SECONDS = Gauge(
+    REGISTRY, "janus_startup_seconds", "Seconds from process start to each startup phase", ["phase"]
+)
+STORED_IMAGES = Gauge(REGISTRY, "janus_stored_images", "Generated images kept in generated_samples")
+STORED_IMAGE_BYTES = Gauge(REGISTRY, "janus_stored_image_bytes", "Total size of the kept generated images")
+RESIDENT_MEMORY = Gauge(REGISTRY, "janus_resident_memory_bytes", "Resident set size of the service process")
+RESIDENT_MEMORY.set_function(resident_memory_bytes)
@@ -0,0 +1,88 @@
+"""
+Idle eviction of the loaded model.
+
+The model used to stay resident from startup until the process exited,
+even on boxes that sit idle for hours. ModelResidency frees it once no
+generation has used it for ``idle_seconds`` and loads it again when the
+next one arrives.
+
+Generations hold the model through ``use()`` for as long as they run, so
+it is never freed under one. Loading and freeing happen under ``lock``:
+a generation that arrives while the model is being (re)loaded waits for
+the load to finish and never sees a half-loaded model.
+"""
+
+import contextlib
+import os
+import threading
+import time
+
+
+class ModelResidency:
+    """
+    Calls ``load()`` when a user needs the model and ``is_loaded()`` is
+    false, and ``unload()`` once it has been unused for ``idle_seconds``
+    (never with ``idle_seconds`` 0). ``lock`` is reentrant, so ``load``
+    and ``unload`` may take it again.
+    """
+
+    def __init__(self, load, unload, is_loaded, idle_seconds: float = 0):
+        self.load = load
+        self.unload = unload
+        self.is_loaded = is_loaded
+        self.idle_seconds = idle_seconds
+        self._watching = False
+        self._reset()
+        # Threads and lock owners do not survive a fork; worker processes
+        # track their own use of the model
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _reset(self):
+        self.lock = threading.RLock()
+        self.users = 0
+        self.last_used = time.monotonic()
+
+    def _after_fork(self):
+        self._reset()
+        if self._watching:
+            self._start_thread()
+
+    def start(self):
+        """Start freeing the model when idle, if an idle timeout is set."""
+        if self.idle_seconds > 0 and not self._watching:
+            self._watching = True
+            self._start_thread()
+
+    def _start_thread(self):
+        self._thread = threading.Thread(target=self._watch, name="model-residency", daemon=True)
+        self._thread.start()
+
+    @contextlib.contextmanager
+    def use(self):
+        """Hold the model for the duration of the block, loading it first if needed."""
+        with self.lock:
+            if not self.is_loaded():
+                self.load()
+            self.users += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.users -= 1
+                self.last_used = time.monotonic()
+
+    def idle_for(self) -> float:
+        """Seconds since the model was last used, 0 while it is in use."""
+        return 0.0 if self.users else time.monotonic() - self.last_used
+
+    def _watch(self):
+        interval = min(60.0, max(1.0, self.idle_seconds / 4))
+        while True:
+            time.sleep(interval)
+            with self.lock:
+                if self.users or not self.is_loaded() or self.idle_for() < self.idle_seconds:
+                    continue
+                try:
+                    self.unload()
+                except Exception as e:
+                    print(f"⚠️ Freeing the idle model failed: {e}")
@@ -0,0 +1,98 @@
+"""
+Stages turning sampled image tokens into stored images.
+
+Token sampling runs on the batch scheduler's thread and never waits for the
+rest of an image's work: once a sequence's tokens are sampled, its slot in
+the batch goes to the next job. The tokens then go through two more stages,
+each with its own executor and a bounded queue in front of it:
+
+- VQ decode: one thread running decode_code over the tokens of every image
+  waiting for it at once, so decodes neither run one image at a time nor
+  oversubscribe the cores next to the decode steps;
+- encode/persist: threads encoding the pixels and adding them to the
+  image store.
+
+Submitting to a full queue blocks, so a backlog of post-processing holds
+back the job queue's workers instead of piling up decoded images in memory.
+"""
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+from metrics import STAGE_SECONDS
+
+
+def pixels_from_decoded(dec):
+    """
+    Turn decode_code output, (N, 3, H, W) in [-1, 1], into (N, H, W, 3)
+    uint8 pixels. The scaling happens in place and the layout change and
+    uint8 conversion in a single copy, so no intermediate arrays are made.
+    """
+    with torch.inference_mode():
+        dec = dec.to(device="cpu", dtype=torch.float32)
+        dec.add_(1).div_(2).mul_(255).clamp_(0, 255)
+        pixels = torch.empty((dec.shape[0], dec.shape[2], dec.shape[3], dec.shape[1]), dtype=torch.uint8)
+        pixels.copy_(dec.permute(0, 2, 3, 1))
+    return pixels.numpy()
+
+
+class PipelineStage:
+    """
+    Executor threads calling ``handler(items)`` for items submitted to a
+    bounded queue. Up to ``max_batch`` items already waiting are handed over
+    together; the handler returns one result per item.
+    """
+
+    def __init__(self, name: str, handler, workers: int = 1, max_queued: int = 8, max_batch: int = 1):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_batch = max_batch
+        self._start_threads()
+        # Threads do not survive a fork; worker processes need their own executors
+        os.register_at_fork(after_in_child=self._start_threads)
+
+    def _start_threads(self):
+        self._queue = queue.Queue(maxsize=self.max_queued)
+        self._threads = [
+            threading.Thread(target=self._work, name=f"{self.name}-{index}", daemon=True)
+            for index in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, item) -> Future:
+        """Queue an item, waiting while the queue is full; returns a Future of its result."""
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    def queued(self) -> int:
+        return self._queue.qsize()
+
+    def _work(self):
+        wait_seconds = STAGE_SECONDS.labels(f"{self.name}_wait")
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            now = time.perf_counter()
+            for _, _, submitted in batch:
+                wait_seconds.observe(now - submitted)
+            try:
+                results = self.handler([item for item, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
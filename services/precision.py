@@ -0,0 +1,69 @@
+"""
+Reduced-precision inference modes for the Janus model on CPU.
+
+fp32 Janus-1.3B needs 5+ GB of resident memory per process and runs at fp32
+matmul throughput. The modes below shrink the parts that run the 576-step token
+loop while leaving ``gen_vision_model`` (the VQ decoder, run once per image) at
+its own, by default full, precision:
+
+  fp32  everything in float32 (the original behaviour)
+  bf16  bfloat16 weights for everything but the vision decoder
+  int8  dynamic int8 quantization of the nn.Linear layers of the language
+        model and gen_head; activations and embeddings stay float32
+"""
+
+import torch
+from torch import nn
+
+PRECISION_MODES = ("fp32", "bf16", "int8")
+
+VISION_DTYPES = {
+    "fp32": torch.float32,
+    "bf16": torch.bfloat16,
+}
+
+# Modules that only take part in image generation once per image
+VISION_MODULES = ("gen_vision_model",)
+
+
+def apply_precision(model, precision: str = "fp32", vision_precision: str = "fp32"):
+    """
+    Convert a float32 model in place to the given precision mode and return it.
+    """
+    if precision not in PRECISION_MODES:
+        raise ValueError(f"Unknown precision mode '{precision}', expected one of {PRECISION_MODES}")
+    if vision_precision not in VISION_DTYPES:
+        raise ValueError(f"Unknown vision precision '{vision_precision}', expected one of {tuple(VISION_DTYPES)}")
+
+    if precision == "bf16":
+        for name, module in model.named_children():
+            if name not in VISION_MODULES:
+                module.to(torch.bfloat16)
+    elif precision == "int8":
+        model.language_model = torch.ao.quantization.quantize_dynamic(
+            model.language_model, {nn.Linear}, dtype=torch.qint8
+        )
+        model.gen_head = torch.ao.quantization.quantize_dynamic(
+            model.gen_head, {nn.Linear}, dtype=torch.qint8
+        )
+
+    for name in VISION_MODULES:
+        module = getattr(model, name, None)
+        if module is not None:
+            module.to(VISION_DTYPES[vision_precision])
+    return model
+
+
+def model_memory_bytes(model):
+    """Approximate bytes held by the model's parameters, buffers and packed int8 weights."""
+    total = 0
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        total += tensor.numel() * tensor.element_size()
+    for module in model.modules():
+        packed = getattr(module, "_packed_params", None)
+        if packed is not None and hasattr(packed, "_weight_bias"):
+            weight, bias = packed._weight_bias()
+            total += weight.numel() * weight.element_size()
+            if bias is not None:
+                total += bias.numel() * bias.element_size()
+    return total
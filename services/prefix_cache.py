@@ -0,0 +1,146 @@
+"""
+Reusable KV cache for the parts of a generation prompt shared across requests.
+
+Every prompt is ``apply_sft_template_for_multi_turn_prompts`` output followed by
+``image_start_tag``, so the conditional row always starts with the same template
+tokens. The unconditional row is the first token, a run of ``pad_id`` and the
+last token, which only depends on the prompt length. Causal attention means the
+KV entries of a prefix never depend on what follows it, so both can be computed
+once and reused, leaving only the prompt specific suffix (plus a single token on
+the unconditional row) to prefill per request.
+"""
+
+import torch
+
+from kv_cache import build_cache, cache_layers
+
+# Pad run length is grown in steps of this many tokens to avoid re-extending
+# it for every slightly longer prompt
+PAD_RUN_GRANULARITY = 32
+
+
+def shared_template_prefix(vl_chat_processor):
+    """
+    Return the token ids every tokenized generation prompt starts with.
+
+    Found by rendering the template around two different user prompts and
+    keeping their common leading tokens.
+    """
+    def render(content):
+        conversation = [
+            {"role": "User", "content": content},
+            {"role": "Assistant", "content": ""},
+        ]
+        sft_format = vl_chat_processor.apply_sft_template_for_multi_turn_prompts(
+            conversations=conversation,
+            sft_format=vl_chat_processor.sft_format,
+            system_prompt="",
+        )
+        return vl_chat_processor.tokenizer.encode(sft_format + vl_chat_processor.image_start_tag)
+
+    first, second = render("A"), render("Z")
+    length = 0
+    while length < min(len(first), len(second)) and first[length] == second[length]:
+        length += 1
+    # The last shared token could merge with the prompt text when tokenized,
+    # leave it to the per-request suffix
+    return first[:max(0, length - 1)]
+
+
+class PrefixCache:
+    """
+    Holds precomputed KV entries for the shared template prefix (conditional
+    row) and for the padding run of the unconditional row.
+
+    Not thread safe: it is only used from the batch scheduler thread.
+    """
+
+    def __init__(self, mmgpt, vl_chat_processor):
+        self.mmgpt = mmgpt
+        self.pad_id = vl_chat_processor.pad_id
+        self.device = next(mmgpt.parameters()).device
+        self.prefix_ids = shared_template_prefix(vl_chat_processor)
+
+        self._prefix_layers = None
+        self._pad_run_layers = None
+        self._pad_run_first_id = None
+        self._pad_run_length = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    @torch.inference_mode()
+    def prefill(self, input_ids):
+        """
+        Prefill the conditional and unconditional rows for ``input_ids``.
+
+        Returns ``(layers, last_hidden_state)`` for the two rows, or None when
+        the prompt does not start with the cached prefix and has to be
+        prefilled from scratch.
+        """
+        prefix_length = len(self.prefix_ids)
+        if (
+            prefix_length == 0
+            or len(input_ids) <= prefix_length
+            or list(input_ids[:prefix_length]) != self.prefix_ids
+        ):
+            self.misses += 1
+            return None
+        self.hits += 1
+
+        cond_layers, cond_hidden = self._prefill_conditional(input_ids)
+        uncond_layers, uncond_hidden = self._prefill_unconditional(input_ids)
+
+        layers = [
+            (torch.cat([kc, ku], dim=0), torch.cat([vc, vu], dim=0))
+            for (kc, vc), (ku, vu) in zip(cond_layers, uncond_layers)
+        ]
+        return layers, torch.cat([cond_hidden, uncond_hidden], dim=0)
+
+    def _prefill_conditional(self, input_ids):
+        if self._prefix_layers is None:
+            print(f"Computing shared prompt prefix cache ({len(self.prefix_ids)} tokens)...")
+            self._prefix_layers, _ = self._forward(self.prefix_ids, None)
+
+        suffix = input_ids[len(self.prefix_ids):]
+        return self._forward(suffix, self._prefix_layers)
+
+    def _prefill_unconditional(self, input_ids):
+        # The unconditional row is [first, pad, ..., pad, last]; everything but
+        # the last token is a prefix of the pad run
+        run_length = len(input_ids) - 1
+        if self._pad_run_first_id != input_ids[0] or self._pad_run_length < run_length:
+            self._extend_pad_run(input_ids[0], run_length)
+
+        past = [(k[:, :, :run_length], v[:, :, :run_length]) for k, v in self._pad_run_layers]
+        return self._forward([input_ids[-1]], past)
+
+    def _extend_pad_run(self, first_id, run_length):
+        target = -(-run_length // PAD_RUN_GRANULARITY) * PAD_RUN_GRANULARITY
+        if self._pad_run_first_id != first_id:
+            self._pad_run_layers = None
+            self._pad_run_length = 0
+            self._pad_run_first_id = first_id
+
+        if self._pad_run_layers is None:
+            tokens = [first_id] + [self.pad_id] * (target - 1)
+        else:
+            tokens = [self.pad_id] * (target - self._pad_run_length)
+
+        print(f"Extending unconditional pad run cache to {target} tokens...")
+        self._pad_run_layers, _ = self._forward(tokens, self._pad_run_layers)
+        self._pad_run_length = target
+
+    def _forward(self, token_ids, past_layers):
+        """
+        Run one row of tokens through the model on top of ``past_layers``.
+        Returns the resulting cache layers and the last hidden state.
+        """
+        tokens = torch.tensor([token_ids], dtype=torch.long, device=self.device)
+        inputs_embeds = self.mmgpt.language_model.get_input_embeddings()(tokens)
+        outputs = self.mmgpt.language_model.model(
+            inputs_embeds=inputs_embeds,
+            past_key_values=build_cache(past_layers) if past_layers is not None else None,
+            use_cache=True,
+        )
+        return cache_layers(outputs.past_key_values), outputs.last_hidden_state[:, -1, :]
@@ -0,0 +1,140 @@
+"""
+Progressive previews of images that are still being generated.
+
+Janus samples the 24x24 grid of image tokens in raster order, so a partially
+sampled grid already shows the top of the image. Every few dozen tokens the
+grid is decoded with the positions not sampled yet filled with a placeholder
+code (the code sampled most often so far, which reads as the image's
+dominant colour), downscaled and encoded as a small low quality JPEG.
+
+Decoding costs about as much as the final decode_code of the image, so
+previews are opt-in per request and rendered by a background thread: the
+batch scheduler only hands over a copy of the tokens and never waits for a
+render. A task with a render still pending only keeps its newest request,
+so a slow renderer skips previews instead of falling behind.
+"""
+
+import collections
+import os
+import threading
+import time
+
+import PIL.Image
+import torch
+
+from image_store import StoredImage, encode_image
+from metrics import STAGE_SECONDS
+from pipeline import pixels_from_decoded
+
+
+def fill_placeholder(tokens, step: int):
+    """
+    Return a copy of (1, N) image tokens whose positions from ``step`` on
+    hold the code sampled most often in the first ``step`` positions.
+    """
+    filled = tokens.clone()
+    if step < filled.shape[1]:
+        sampled = filled[0, :step].long()
+        filled[0, step:] = int(torch.bincount(sampled).argmax()) if step > 0 else 0
+    return filled
+
+
+def render_preview(mmgpt, tokens, step: int, size: int = 192, quality: int = 60,
+                   img_size: int = 384, patch_size: int = 16) -> bytes:
+    """Decode the first ``step`` of (1, N) image tokens into a JPEG of ``size`` pixels."""
+    with torch.inference_mode():
+        dec = mmgpt.gen_vision_model.decode_code(
+            fill_placeholder(tokens, step).to(dtype=torch.int),
+            shape=[1, 8, img_size // patch_size, img_size // patch_size]
+        )
+    image = PIL.Image.fromarray(pixels_from_decoded(dec)[0])
+    if size and size < image.width:
+        image = image.resize((size, size), PIL.Image.BILINEAR)
+    return encode_image(image, "jpeg", quality)
+
+
+class PreviewRenderer:
+    """
+    Background thread calling ``render(tokens, step)`` for submitted previews
+    and ``on_preview(key, data, step, seconds)`` with the encoded bytes and
+    the total render time of the key so far.
+    """
+
+    def __init__(self, render, on_preview):
+        self.render = render
+        self.on_preview = on_preview
+        self.rendered = 0
+        self.skipped = 0
+        self._start_thread()
+        # Threads do not survive a fork; worker processes need their own renderer
+        os.register_at_fork(after_in_child=self._start_thread)
+
+    def _start_thread(self):
+        self._pending = collections.OrderedDict()  # key -> (tokens, step), oldest first
+        self._seconds = {}  # key -> total render seconds
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._render_loop, name="preview-renderer", daemon=True)
+        self._thread.start()
+
+    def submit(self, key, tokens, step: int):
+        """Queue a preview of the first ``step`` tokens, replacing a pending one of the same key."""
+        tokens = tokens.clone()
+        with self._condition:
+            if key in self._pending:
+                self.skipped += 1
+            self._pending[key] = (tokens, step)
+            self._seconds.setdefault(key, 0.0)
+            self._condition.notify()
+
+    def discard(self, key):
+        """Drop the pending preview of a finished generation; returns its total render seconds."""
+        with self._condition:
+            self._pending.pop(key, None)
+            return self._seconds.pop(key, 0.0)
+
+    def _render_loop(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                key, (tokens, step) = self._pending.popitem(last=False)
+            start = time.perf_counter()
+            try:
+                with STAGE_SECONDS.labels("preview").time():
+                    data = self.render(tokens, step)
+            except Exception as e:
+                print(f"⚠️ Rendering the preview of {key} failed: {e}")
+                continue
+            with self._condition:
+                if key not in self._seconds:
+                    continue  # Finished while rendering
+                self._seconds[key] += time.perf_counter() - start
+                seconds = self._seconds[key]
+                self.rendered += 1
+            self.on_preview(key, data, step, seconds)
+
+
+class PreviewStore:
+    """Latest preview of each task, for at most ``max_entries`` tasks (least recently updated dropped first)."""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()  # task id -> StoredImage
+        self._lock = threading.Lock()
+
+    def put(self, task_id, data: bytes, step: int) -> StoredImage:
+        image = StoredImage(f"preview_{task_id}_{step}.jpg", None, data, "image/jpeg", f"{task_id}-{step}")
+        with self._lock:
+            self._entries.pop(task_id, None)
+            self._entries[task_id] = image
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return image
+
+    def get(self, task_id):
+        with self._lock:
+            return self._entries.get(task_id)
+
+    def discard(self, task_id):
+        with self._lock:
+            self._entries.pop(task_id, None)
@@ -0,0 +1,146 @@
+"""
+Content-addressed cache of generated images.
+
+The assembly UI requests the same part and step illustrations over and over.
+Results are stored on disk (``service_state/result_cache``) keyed on everything
+that determines the output (prompt, sampling parameters, seed and model id) and
+evicted least-recently-used once the cache exceeds its size budget.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import threading
+
+from image_store import MIMETYPES
+
+
+class ResultCache:
+    """
+    Size-bounded LRU of image files on disk.
+
+    The LRU order is kept in memory and rebuilt from file modification times
+    at startup, so the cache survives restarts.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 512 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = collections.OrderedDict()  # key -> (file name, size in bytes), oldest first
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    @staticmethod
+    def key(prompt: str, cfg_weight: float, temperature: float, seed, model_id: str, cfg_schedule=None,
+            image_format=None) -> str:
+        """
+        Return the cache key for a generation request. ``cfg_schedule`` is the
+        description of a non-default guidance schedule and ``image_format`` of a
+        non-default output format and quality, if any.
+        """
+        fields = [prompt, float(cfg_weight), float(temperature), seed, model_id]
+        if cfg_schedule is not None:
+            fields.append(cfg_schedule)
+        if image_format is not None:
+            fields.append(image_format)
+        payload = json.dumps(fields, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        """Return the path of the cached image for ``key``, or None on a miss."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            path = self._path(self._entries[key][0])
+            if not os.path.exists(path):
+                # Removed behind our back, forget about it
+                self._total_bytes -= self._entries.pop(key)[1]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+        # Persist the access time so the LRU order survives restarts
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    def put(self, key: str, data: bytes, extension: str = "jpg"):
+        """Store an encoded image in the cache and evict old entries if needed."""
+        name = f"{key}.{extension}"
+        path = self._path(name)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        size = len(data)
+
+        with self._lock:
+            if key in self._entries:
+                previous, previous_size = self._entries.pop(key)
+                self._total_bytes -= previous_size
+                if previous != name:
+                    self._remove(previous)
+            self._entries[key] = (name, size)
+            self._total_bytes += size
+            self._evict()
+        return path
+
+    def stats(self):
+        """Return hit/miss counters and the current cache size."""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _remove(self, name: str):
+        try:
+            os.remove(self._path(name))
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            key, (name, size) = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            self._remove(name)
+            print(f"Evicted cached image {key[:12]} ({size} bytes)")
+
+    def _load(self):
+        files = []
+        for name in os.listdir(self.directory):
+            key, _, extension = name.partition(".")
+            if extension not in MIMETYPES:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, key, name, stat.st_size))
+
+        for _, key, name, size in sorted(files):
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (name, size)
+            self._total_bytes += size
+        self._evict()
+        if files:
+            print(f"Loaded {len(self._entries)} cached images ({self._total_bytes} bytes)")
@@ -1,20 +1,115 @@
-import os
 import time
+# Measured before the heavy imports below, for the startup timings
+PROCESS_START = time.time()
+
+import atexit
+import collections
+import ctypes
+import fcntl
+import functools
+import gc
+import os
+import io
+import json
+import queue
+import select
+import socket
 import PIL.Image
 import torch
-import numpy as np
 import uuid
-from flask import Flask, request, send_file, jsonify
+import zipfile
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
-from transformers import AutoModelForCausalLM, AutoConfig
-from janus.models import MultiModalityCausalLM, VLChatProcessor
+from typing import TYPE_CHECKING
+from cancellation import (
+    CANCELLED, CLIENT_DISCONNECTED, DEADLINE_EXCEEDED, CancelRegistry, GenerationCancelled, is_cancellation,
+)
+from cfg_schedule import CFGSchedule
+from cpu_tuning import apply_thread_settings, cpu_topology, read_tuning, worker_cpu_sets
+from job_queue import GenerationJob, JobQueue, PRIORITIES, PRIORITY_INTERACTIVE, QueueFullError
+from result_cache import ResultCache
+from image_store import IMAGE_FORMATS, MIMETYPES, ImageStore, encode_image, validate_format
+from image_index import ImageIndex
+from precision import apply_precision, model_memory_bytes
+from pipeline import PipelineStage, pixels_from_decoded
+from preview import PreviewRenderer, PreviewStore, render_preview
+from worker_pool import ProcessWorkerPool
+from metrics import (
+    REGISTRY, ACTIVE_JOBS, LOCK_WAIT_SECONDS, MODEL_EVENT_SECONDS, MODEL_EVENTS, MODEL_LOAD_SECONDS, MODEL_RESIDENT,
+    QUEUED_JOBS, STAGE_SECONDS, STARTUP_SECONDS, STORED_IMAGE_BYTES, STORED_IMAGES, TASKS, InstrumentedLock,
+    resident_memory_bytes,
+)
+from model_residency import ModelResidency
+from snapshot import load_snapshot, read_metadata, save_snapshot
+from task_events import TaskEventBus
+from task_store import TERMINAL_STATUSES, open_task_store
 
-# Dictionary to store generation progress
-generation_tasks = {}
+# transformers, janus and the batch scheduler (which pulls in transformers)
+# take seconds to import; they are imported when the model is loaded so the
+# HTTP server comes up first
+if TYPE_CHECKING:
+    from janus.models import MultiModalityCausalLM, VLChatProcessor
 
-# Lock for thread safety when accessing the tasks dictionary
 import threading
-tasks_lock = threading.Lock()
+
+# Service metadata (image index, result cache, profiler traces, task
+# database) is kept in JANUS_STATE_DIR, apart from the publicly served
+# generated_samples folder
+STATE_FOLDER = os.environ.get("JANUS_STATE_DIR", "service_state")
+os.makedirs(STATE_FOLDER, exist_ok=True)
+
+# Progress records of the generation tasks (see task_store.py): kept in this
+# process by default, or with JANUS_TASK_STORE=sqlite in the JANUS_TASK_DB
+# database shared by every server process on the host. Finished tasks are
+# evicted after JANUS_TASK_TTL_SECONDS or, oldest first, beyond
+# JANUS_TASK_MAX_FINISHED of them.
+# Only the task records are shared: any process answers /progress, /status,
+# /events and /result, but cancelling, attaching identical requests, previews
+# and the image index stay with the process that accepted the task, so
+# DELETE /task/<id> on another process answers 409
+TASK_STORE = os.environ.get("JANUS_TASK_STORE", "memory")
+TASK_DB = os.environ.get("JANUS_TASK_DB", os.path.join(STATE_FOLDER, 'tasks.db'))
+TASK_TTL_SECONDS = float(os.environ.get("JANUS_TASK_TTL_SECONDS", "86400"))
+TASK_MAX_FINISHED = int(os.environ.get("JANUS_TASK_MAX_FINISHED", "10000"))
+task_store = open_task_store(
+    TASK_STORE, TASK_DB, ttl=TASK_TTL_SECONDS, max_finished=TASK_MAX_FINISHED,
+    lock=InstrumentedLock(LOCK_WAIT_SECONDS.labels("tasks"))
+)
+# Marks the records of the tasks this process accepted in a shared task store
+SERVER_ID = uuid.uuid4().hex
+TASK_OWNER = {"owner": SERVER_ID} if task_store.shared else {}
+
+# In worker processes task updates are forwarded to the parent process,
+# which owns the task store (see start_worker_pool)
+task_update_forwarder = None
+
+# Pushes every task update to the /events/<task_id> streams
+task_events = TaskEventBus()
+
+# Cancel tokens of the running generations, by task id (or a per-request key
+# for synchronous requests); in worker processes cancels arrive from the parent
+cancel_registry = CancelRegistry()
+
+def update_task(task_id, fields):
+    """
+    Merge fields into a task's progress record and publish the new state to
+    subscribers. Tasks without a record, e.g. evicted ones, are ignored. A
+    "preview_image" field goes to the preview store instead of the record.
+    """
+    if task_update_forwarder is not None:
+        task_update_forwarder(task_id, fields)
+        return
+    fields = dict(fields)
+    preview_image = fields.pop("preview_image", None)
+    # A preview rendered while the generation finished is dropped
+    snapshot = task_store.update(task_id, fields, unless_finished=preview_image is not None)
+    if snapshot is None:
+        return
+    if preview_image is not None:
+        preview_store.put(task_id, preview_image, fields["preview_step"])
+    elif fields.get("status") in TERMINAL_STATUSES:
+        preview_store.discard(task_id)
+    task_events.publish(task_id, snapshot)
 
 # Create needed directories
 os.makedirs('generated_samples', exist_ok=True)
@@ -30,22 +125,233 @@ app.config['GENERATED_FOLDER'] = os.path.join(os.getcwd(), 'generated_samples')
 vl_gpt = None
 vl_chat_processor = None
 
-def load_model():
+# Model served by this process; part of the result cache key
+MODEL_PATH = "deepseek-ai/Janus-1.3B"
+
+# CPU-ready snapshot to load instead of MODEL_PATH, written once with
+# `python snapshot.py --output DIR` (see snapshot.py)
+SNAPSHOT_PATH = os.environ.get("JANUS_SNAPSHOT")
+SNAPSHOT_METADATA = read_metadata(SNAPSHOT_PATH) if SNAPSHOT_PATH else None
+if SNAPSHOT_PATH and SNAPSHOT_METADATA is None:
+    print(f"⚠️ No model snapshot found in {SNAPSHOT_PATH}, loading {MODEL_PATH} instead")
+if SNAPSHOT_METADATA is not None:
+    MODEL_PATH = SNAPSHOT_METADATA.get("source") or MODEL_PATH
+
+# Inference precision: fp32, bf16 or int8 (see precision.py). The vision
+# decoder keeps its own precision, fp32 unless JANUS_VISION_PRECISION says
+# otherwise. A snapshot defaults to the precision it was prepared for
+_snapshot_defaults = SNAPSHOT_METADATA or {}
+PRECISION = os.environ.get("JANUS_PRECISION", _snapshot_defaults.get("precision", "fp32"))
+VISION_PRECISION = os.environ.get("JANUS_VISION_PRECISION", _snapshot_defaults.get("vision_precision", "fp32"))
+
+# Identifies the weights and precision producing an image, for the result cache
+MODEL_ID = f"{MODEL_PATH}:{PRECISION}:{VISION_PRECISION}"
+
+# Free the model after JANUS_IDLE_EVICT_MINUTES without generations (0, the
+# default, keeps it loaded) and load it again for the next one. Reloads map
+# the weights from a snapshot: JANUS_SNAPSHOT, or else the one written to
+# JANUS_RELOAD_SNAPSHOT before the first eviction (empty to reload with
+# from_pretrained instead). Not with JANUS_WORKER_PROCESSES: worker processes
+# share the parent's weights copy-on-write, so freeing them in a worker
+# releases nothing and every reload would make a private copy per worker
+IDLE_EVICT_SECONDS = float(os.environ.get("JANUS_IDLE_EVICT_MINUTES", "0")) * 60
+RELOAD_SNAPSHOT_PATH = os.environ.get("JANUS_RELOAD_SNAPSHOT", "model_snapshot")
+
+# Run a short generation after loading so the first request doesn't pay for
+# kernel selection and allocator warmup, enabled with JANUS_WARMUP=1
+WARMUP_ENABLED = os.environ.get("JANUS_WARMUP", "0") == "1"
+
+# Seconds from process start to each startup milestone, served by /ready
+STARTUP_TIMINGS = {"imports": None, "model_load": None, "warmup": None, "ready": None}
+model_ready = threading.Event()
+startup_error = None
+
+# Set while shutting down: /ready answers 503 and new generations are refused
+# while the queued and running ones finish (see async_server)
+draining = threading.Event()
+
+# Largest accepted request body
+MAX_REQUEST_BYTES = int(os.environ.get("JANUS_MAX_REQUEST_BYTES", str(1024 * 1024)))
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
+
+def record_startup(phase, seconds):
+    STARTUP_TIMINGS[phase] = round(seconds, 3)
+    STARTUP_SECONDS.labels(phase).set(seconds)
+
+record_startup("imports", time.time() - PROCESS_START)
+
+def load_model(precision=None, vision_precision=None):
     """
     Load and initialize the Janus model and processor.
     This is done lazily on first request to save memory when not in use.
+
+    precision and vision_precision default to JANUS_PRECISION and
+    JANUS_VISION_PRECISION. With a snapshot (JANUS_SNAPSHOT, or the one
+    written for reloads after an idle eviction) the prepared snapshot is
+    memory-mapped instead of running from_pretrained. Loads hold the
+    residency lock, so generations wait for a load in progress.
     """
     global vl_gpt, vl_chat_processor
-    
-    if vl_gpt is not None and vl_chat_processor is not None:
-        return  # Already loaded
-    
-    model_path = "deepseek-ai/Janus-1.3B"
+
+    with model_residency.lock:
+        if vl_gpt is not None and vl_chat_processor is not None:
+            return  # Already loaded
+
+        load_start = time.time()
+        precision = precision or PRECISION
+        vision_precision = vision_precision or VISION_PRECISION
+
+        if SNAPSHOT_METADATA is not None and (precision, vision_precision) == (
+                SNAPSHOT_METADATA["precision"], SNAPSHOT_METADATA["vision_precision"]):
+            print(f"Loading model snapshot from {SNAPSHOT_PATH}...")
+            vl_gpt, vl_chat_processor, _ = load_snapshot(SNAPSHOT_PATH)
+            source = "snapshot"
+        else:
+            if SNAPSHOT_METADATA is not None:
+                print(f"⚠️ Snapshot in {SNAPSHOT_PATH} was prepared for {SNAPSHOT_METADATA['precision']}, "
+                      f"not {precision}; loading {MODEL_PATH} instead")
+            vl_gpt, vl_chat_processor = load_pretrained(precision, vision_precision)
+            source = "pretrained"
+
+        seconds = time.time() - load_start
+        MODEL_LOAD_SECONDS.set(seconds)
+        record_model_event("load", seconds, source=source)
+        if STARTUP_TIMINGS["model_load"] is None:
+            record_startup("model_load", time.time() - PROCESS_START)
+        print(f"Model loaded successfully in {seconds:.1f}s from {source} "
+              f"({model_memory_bytes(vl_gpt) / 2**30:.2f} GiB of weights)")
+
+
+def reload_model():
+    """
+    Load the model again after an idle eviction, warmed up as at startup.
+    """
+    print("Model not loaded, loading it now...")
+    load_model()
+    if WARMUP_ENABLED or COMPILE_DECODE:
+        warmup_model()
+
+
+def unload_model():
+    """
+    Free the idle model (see model_residency), along with the batch scheduler
+    and its KV cache. The small processor stays loaded. A model loaded with
+    from_pretrained is first written as a snapshot for the reloads.
+    """
+    global vl_gpt, batch_scheduler
+
+    with model_residency.lock:
+        if vl_gpt is None:
+            return
+        evict_start = time.time()
+        save_reload_snapshot()
+        memory_before = resident_memory_bytes()
+        weight_bytes = model_memory_bytes(vl_gpt)
+        with scheduler_lock:
+            if batch_scheduler is not None:
+                batch_scheduler.close()
+                batch_scheduler = None
+        vl_gpt = None
+        gc.collect()
+        release_free_memory()
+        memory_after = resident_memory_bytes()
+        freed = max(0, memory_before - memory_after) if memory_before and memory_after else None
+
+        seconds = time.time() - evict_start
+        record_model_event("evict", seconds, idle_seconds=round(model_residency.idle_for()), freed_bytes=freed)
+        freed_text = f", {freed / 2**30:.2f} GiB of memory released" if freed is not None else ""
+        print(f"✅ Freed the model after {model_residency.idle_for() / 60:.1f} idle minutes in {seconds:.1f}s "
+              f"({weight_bytes / 2**30:.2f} GiB of weights{freed_text})")
+
+
+def save_reload_snapshot():
+    """
+    Write the model as a snapshot to JANUS_RELOAD_SNAPSHOT, unless it was
+    loaded from one, and reload from it from now on. Server processes using
+    the same path share the snapshot: whichever evicts first writes it.
+    """
+    global SNAPSHOT_PATH, SNAPSHOT_METADATA
+
+    if SNAPSHOT_METADATA is not None or not RELOAD_SNAPSHOT_PATH:
+        return
+    if "int8" in (PRECISION, VISION_PRECISION):
+        # Quantized weights can not be stored (see snapshot.py)
+        print("⚠️ int8 models reload with from_pretrained; write a snapshot with snapshot.py "
+              "and set JANUS_SNAPSHOT for faster reloads")
+        return
+    try:
+        with open(RELOAD_SNAPSHOT_PATH.rstrip("/") + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            metadata = read_metadata(RELOAD_SNAPSHOT_PATH)
+            if metadata is not None and (metadata.get("source"), metadata["precision"], metadata["vision_precision"]) != (
+                    MODEL_PATH, PRECISION, VISION_PRECISION):
+                print(f"⚠️ Replacing the snapshot in {RELOAD_SNAPSHOT_PATH}, written for another model or precision")
+                metadata = None
+            if metadata is None:
+                save_start = time.time()
+                metadata = save_snapshot(
+                    vl_gpt, vl_chat_processor, RELOAD_SNAPSHOT_PATH,
+                    precision=PRECISION, vision_precision=VISION_PRECISION, source=MODEL_PATH,
+                )
+                print(f"Wrote a model snapshot for reloads to {RELOAD_SNAPSHOT_PATH} in {time.time() - save_start:.1f}s")
+    except Exception as e:
+        print(f"⚠️ Could not write a model snapshot to {RELOAD_SNAPSHOT_PATH}, reloads use from_pretrained: {e}")
+        return
+    SNAPSHOT_PATH, SNAPSHOT_METADATA = RELOAD_SNAPSHOT_PATH, metadata
+
+
+def release_free_memory():
+    """Return freed heap memory to the OS; glibc otherwise keeps it for reuse."""
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+# Recent model loads and idle evictions of this process, served by /ready
+model_events = collections.deque(maxlen=20)
+
+def record_model_event(event, seconds, **details):
+    MODEL_EVENTS.labels(event).inc()
+    MODEL_EVENT_SECONDS.labels(event).observe(seconds)
+    model_events.append({"event": event, "time": time.time(), "seconds": round(seconds, 3), "pid": os.getpid(), **details})
+
+
+# Loads the model for the generations needing it and frees it once idle for
+# IDLE_EVICT_SECONDS, started by prepare_model()
+model_residency = ModelResidency(
+    load=reload_model,
+    unload=unload_model,
+    is_loaded=lambda: vl_gpt is not None and vl_chat_processor is not None,
+    idle_seconds=IDLE_EVICT_SECONDS,
+)
+MODEL_RESIDENT.set_function(lambda: int(vl_gpt is not None))
+
+def uses_model(function):
+    """
+    Run the decorated generation function holding the model, loading it
+    first if it was freed as idle (or is still loading).
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with model_residency.use():
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def load_pretrained(precision, vision_precision):
+    """
+    Load the model and processor from MODEL_PATH, patched for CPU inference.
+    """
+    from transformers import AutoModelForCausalLM, AutoConfig
+    from janus.models import VLChatProcessor
+
+    model_path = MODEL_PATH
     device = torch.device("cpu")
     dtype = torch.float32
-    
+
     print("Loading processor...")
-    vl_chat_processor = VLChatProcessor.from_pretrained(
+    processor = VLChatProcessor.from_pretrained(
         model_path,
         use_fast=True  # Use fast tokenizer
     )
@@ -60,37 +366,178 @@ def load_model():
     print("Configuration loaded and modified for CPU")
     
     print(f"Loading model to {device} with {dtype}...")
-    vl_gpt = AutoModelForCausalLM.from_pretrained(
+    model = AutoModelForCausalLM.from_pretrained(
         model_path,
         trust_remote_code=True,
         config=config,
         torch_dtype=dtype,
         low_cpu_mem_usage=True
     )
-    vl_gpt = vl_gpt.to(device).eval()
-    print("Model loaded successfully")
+    model = model.to(device).eval()
+
+    if precision != "fp32" or vision_precision != "fp32":
+        print(f"Converting model to {precision} (vision decoder: {vision_precision})...")
+        model = apply_precision(model, precision, vision_precision)
+    return model, processor
+
+
+def warmup_model(image_token_num: int = 16):
+    """
+    Run a short generation of two images and one VQ decode on the decode
+    stage so oneDNN primitives, the allocator, the scheduler and decode stage
+    threads and, with COMPILE_DECODE, the compiled decode step for changing
+    batch sizes are ready before the first request.
+    """
+    from batch_scheduler import GenerationSequence
+
+    start = time.time()
+    input_ids = vl_chat_processor.tokenizer.encode(apply_prompt_template(vl_chat_processor, "warmup"))
+    scheduler = get_batch_scheduler()
+    sequences = [
+        scheduler.submit(GenerationSequence(input_ids, image_token_num_per_image=image_token_num, seed=seed))
+        for seed in range(min(2, MAX_BATCH_SIZE))
+    ]
+    for sequence in sequences:
+        sequence.wait()
+    decode_stage.submit(torch.zeros((1, 576), dtype=torch.int)).result()
+    print(f"Model warmed up in {time.time() - start:.1f}s")
+
+
+def apply_prompt_template(processor, user_prompt: str):
+    """
+    Wrap a user prompt in the chat template, ending where the image tokens start.
+    """
+    conversation = [
+        {
+            "role": "User",
+            "content": user_prompt,
+        },
+        {"role": "Assistant", "content": ""},
+    ]
+    sft_format = processor.apply_sft_template_for_multi_turn_prompts(
+        conversations=conversation,
+        sft_format=processor.sft_format,
+        system_prompt="",
+    )
+    return sft_format + processor.image_start_tag
+
+
+def token_progress_callback(task_id):
+    """
+    Return the scheduler progress callback updating a task's record, if any.
+    """
+    def on_progress(step, total):
+        if task_id:
+            # Scale progress from 15% to 85% based on token generation
+            progress = 15 + int(70 * (step / total))
+            update_task(task_id, {
+                "status": "generating",
+                "progress": progress,
+                "message": f"Generating token {step}/{total}",
+                "timestamp": time.time(),
+                "tokens_generated": step,
+                "tokens_total": total
+            })
+    return on_progress
+
+
+def preview_progress_callback(task_id, sequence, every_tokens: int):
+    """
+    Return the scheduler progress callback of a task with previews: besides
+    updating its record, hand the tokens sampled so far to the preview
+    renderer every ``every_tokens`` tokens.
+    """
+    on_progress = token_progress_callback(task_id)
+    next_preview = [every_tokens]
+
+    def on_progress_with_preview(step, total):
+        on_progress(step, total)
+        if next_preview[0] <= step < total:
+            next_preview[0] = step + every_tokens
+            preview_renderer.submit(task_id, sequence.generated_tokens, step)
+    return on_progress_with_preview
+
+
+def publish_preview(task_id, data: bytes, step: int, seconds: float):
+    """Record a rendered preview on its task, see preview.py."""
+    update_task(task_id, {
+        "preview_image": data,
+        "preview_step": step,
+        "preview_url": f"/preview/{task_id}?step={step}",
+        "preview_seconds": round(seconds, 3)
+    })
+
+
+def decode_images(mmgpt, tokens, img_size: int = 384, patch_size: int = 16):
+    """
+    Decode (N, image tokens) with a single decode_code call into
+    (N, img_size, img_size, 3) uint8 pixels.
+    """
+    with STAGE_SECONDS.labels("decode_code").time(), torch.inference_mode():
+        dec = mmgpt.gen_vision_model.decode_code(
+            tokens.to(dtype=torch.int),
+            shape=[tokens.shape[0], 8, img_size // patch_size, img_size // patch_size]
+        )
+    with STAGE_SECONDS.labels("postprocess").time():
+        return pixels_from_decoded(dec)
+
+
+def decode_pending(token_batches):
+    """
+    Handler of the VQ decode stage: decode the (n, image tokens) of every
+    waiting item with one decode_images call and split the pixels by item.
+    """
+    pixels = decode_images(vl_gpt, torch.cat(token_batches))
+    results, row = [], 0
+    for tokens in token_batches:
+        results.append(pixels[row:row + tokens.shape[0]])
+        row += tokens.shape[0]
+    return results
+
+
+def store_image(pixels, image_format: str = None, quality: int = None):
+    """
+    Encode (H, W, 3) uint8 pixels, by default as JANUS_IMAGE_FORMAT and
+    JANUS_IMAGE_QUALITY, and add them to the image store.
+    """
+    if image_format is None:
+        image_format, quality = IMAGE_FORMAT, IMAGE_QUALITY
+    with STAGE_SECONDS.labels("image_encode").time():
+        data = encode_image(PIL.Image.fromarray(pixels), image_format, quality)
+    # The image is served from memory right away and written to disk in
+    # the background; worker processes wait for the file since the parent
+    # process serves it, and so does every process with a shared task store
+    # since any server process may be asked for it
+    return image_store.put(
+        data, IMAGE_FORMATS[image_format][1], wait=task_update_forwarder is not None or task_store.shared
+    )
 
 
 # Generation function that wraps the image creation process
-def generate_picture(user_prompt: str, task_id=None):
+@uses_model
+def generate_picture(user_prompt: str, task_id=None, seed=None,
+                     cfg_weight: float = 5.0, temperature: float = 1.0,
+                     cfg_schedule: CFGSchedule = None, profile: bool = False,
+                     image_format: str = None, quality: int = None,
+                     deadline: float = None, cancel_key=None, preview_every: int = None):
     """
     Generate an image based on the user prompt using the Janus model.
     Returns the path to the generated image.
     
     If task_id is provided, progress is tracked and can be queried.
+    A seed makes the sampled image reproducible. cfg_schedule, if given,
+    replaces the constant cfg_weight guidance. profile captures torch
+    profiler traces of the request (see PROFILING_ENABLED). Without an
+    image_format the image is encoded as JANUS_IMAGE_FORMAT/JANUS_IMAGE_QUALITY.
+
+    The generation can be cancelled through cancel_registry under cancel_key
+    (the task_id by default) and stops once the deadline (epoch seconds)
+    passes, raising GenerationCancelled. With preview_every, a preview of the
+    partial image is published on the task every preview_every tokens.
     """
-    global generation_tasks, vl_gpt, vl_chat_processor
-    
     # Get a reference to the device and processor first to avoid race conditions
     # This is critical for thread safety
     try:
-        # Ensure model is loaded BEFORE we do anything else
-        if vl_gpt is None or vl_chat_processor is None:
-            print("Model not loaded yet, loading now...")
-            load_model()
-            if vl_gpt is None or vl_chat_processor is None:
-                raise Exception("Failed to load model")
-        
         # Make thread-local references to the model
         current_model = vl_gpt
         current_processor = vl_chat_processor
@@ -103,54 +550,40 @@ def generate_picture(user_prompt: str, task_id=None):
     
     # Update task status if task_id provided
     if task_id:
-        with tasks_lock:
-            # We expect the task entry to already exist, but update it here to be safe
-            if task_id not in generation_tasks:
-                generation_tasks[task_id] = {}
-                
-            generation_tasks[task_id].update({
-                "status": "starting",
-                "progress": 0,
-                "message": "Starting image generation",
-                "timestamp": time.time(),
-                "prompt": user_prompt[:50] + "..." if len(user_prompt) > 50 else user_prompt
-            })
-    
-    # Build the conversation with user-provided prompt content
-    conversation = [
-        {
-            "role": "User",
-            "content": user_prompt,
-        },
-        {"role": "Assistant", "content": ""},
-    ]
+        update_task(task_id, {
+            "status": "starting",
+            "progress": 0,
+            "message": "Starting image generation",
+            "timestamp": time.time(),
+            "prompt": user_prompt[:50] + "..." if len(user_prompt) > 50 else user_prompt
+        })
     
     # Update task status
     if task_id:
-        with tasks_lock:
-            generation_tasks[task_id].update({
-                "status": "preparing",
-                "progress": 5,
-                "message": "Preparing prompt",
-                "timestamp": time.time()
-            })
+        update_task(task_id, {
+            "status": "preparing",
+            "progress": 5,
+            "message": "Preparing prompt",
+            "timestamp": time.time()
+        })
         
-    sft_format = current_processor.apply_sft_template_for_multi_turn_prompts(
-        conversations=conversation,
-        sft_format=current_processor.sft_format,
-        system_prompt="",
-    )
-    prompt = sft_format + current_processor.image_start_tag
+    with STAGE_SECONDS.labels("template").time():
+        prompt = apply_prompt_template(current_processor, user_prompt)
 
-    @torch.inference_mode()
     def generate_cpu(
-            mmgpt: MultiModalityCausalLM,
-            vl_chat_processor: VLChatProcessor,
+            mmgpt: "MultiModalityCausalLM",
+            vl_chat_processor: "VLChatProcessor",
             prompt: str,
             task_id=None,
             temperature: float = 1.0,
-            parallel_size: int = 1,  # Reduced for CPU
             cfg_weight: float = 5.0,
+            cfg_schedule: CFGSchedule = None,
+            seed=None,
+            profile: bool = False,
+            image_format: str = None,
+            quality: int = None,
+            cancel_token=None,
+            preview_every: int = None,
             image_token_num_per_image: int = 576,
             img_size: int = 384,
             patch_size: int = 16,
@@ -160,142 +593,618 @@ def generate_picture(user_prompt: str, task_id=None):
         print(f"[{generation_id}] Tokenizing input...")
         
         if task_id:
-            with tasks_lock:
-                generation_tasks[task_id].update({
-                    "status": "tokenizing",
-                    "progress": 10,
-                    "message": "Tokenizing input",
-                    "timestamp": time.time()
-                })
+            update_task(task_id, {
+                "status": "tokenizing",
+                "progress": 10,
+                "message": "Tokenizing input",
+                "timestamp": time.time()
+            })
             
-        input_ids = vl_chat_processor.tokenizer.encode(prompt)
-        input_ids = torch.LongTensor(input_ids).to(device)
+        with STAGE_SECONDS.labels("tokenize").time():
+            input_ids = vl_chat_processor.tokenizer.encode(prompt)
 
-        tokens = torch.zeros((2, len(input_ids)), dtype=torch.int).to(device)
-        tokens[0, :] = input_ids  # Conditional
-        tokens[1, :] = input_ids.clone()
-        tokens[1, 1:-1] = vl_chat_processor.pad_id  # Unconditional
+        profile_paths = []
+        if profile:
+            os.makedirs(PROFILE_FOLDER, exist_ok=True)
+            trace_name = f"{task_id or uuid.uuid4().hex}_{int(time.time())}"
+            profile_paths = [
+                os.path.join(PROFILE_FOLDER, f"{trace_name}_decode_loop.json"),
+                os.path.join(PROFILE_FOLDER, f"{trace_name}_postprocess.json"),
+            ]
 
         print(f"[{generation_id}] Generating image tokens...")
         if task_id:
-            with tasks_lock:
-                generation_tasks[task_id].update({
-                    "status": "generating",
-                    "progress": 15,
-                    "message": "Starting token generation",
-                    "timestamp": time.time()
-                })
-            
-        inputs_embeds = mmgpt.language_model.get_input_embeddings()(tokens)
-        generated_tokens = torch.zeros((1, image_token_num_per_image), dtype=torch.int).to(device)
-
-        outputs = None
-        last_progress_update = 0
-        
-        for i in range(image_token_num_per_image):
-            # Only update progress when the percentage has changed significantly
-            # This reduces the number of log messages and potential for confusion
-            current_percentage = int(100 * (i / image_token_num_per_image))
-            
-            if current_percentage > last_progress_update + 4:  # Update every 5% progress
-                last_progress_update = current_percentage
-                print(f"[{generation_id}] Generating token {i}/{image_token_num_per_image}... ({current_percentage}%)")
-                
-                if task_id:
-                    # Scale progress from 15% to 85% based on token generation
-                    progress = 15 + int(70 * (i / image_token_num_per_image))
-                    with tasks_lock:
-                        generation_tasks[task_id].update({
-                            "status": "generating",
-                            "progress": progress,
-                            "message": f"Generating token {i}/{image_token_num_per_image}",
-                            "timestamp": time.time()
-                        })
-
-            outputs = mmgpt.language_model.model(
-                inputs_embeds=inputs_embeds,
-                use_cache=True,
-                past_key_values=outputs.past_key_values if i != 0 else None
-            )
-            hidden_states = outputs.last_hidden_state
+            update_task(task_id, {
+                "status": "generating",
+                "progress": 15,
+                "message": "Waiting for a slot in the generation batch",
+                "timestamp": time.time()
+            })
 
-            logits = mmgpt.gen_head(hidden_states[:, -1, :])
-            logit_cond = logits[0:1, :]
-            logit_uncond = logits[1:2, :]
+        # Token generation runs on the shared batch scheduler so that concurrent
+        # requests are decoded together in one forward pass per step
+        from batch_scheduler import GenerationSequence
+        sequence = GenerationSequence(
+            input_ids,
+            task_id=task_id,
+            temperature=temperature,
+            cfg_weight=cfg_weight,
+            cfg_schedule=cfg_schedule,
+            image_token_num_per_image=image_token_num_per_image,
+            seed=seed,
+            on_progress=token_progress_callback(task_id),
+            profile_path=profile_paths[0] if profile else None,
+            cancel_token=cancel_token,
+        )
+        if task_id and preview_every:
+            sequence.on_progress = preview_progress_callback(task_id, sequence, preview_every)
+        get_batch_scheduler().submit(sequence)
+        try:
+            with STAGE_SECONDS.labels("token_generation").time():
+                generated_tokens = sequence.wait()
+        finally:
+            preview_seconds = preview_renderer.discard(task_id) if task_id and preview_every else None
 
-            logits = logit_uncond + cfg_weight * (logit_cond - logit_uncond)
-            probs = torch.softmax(logits / temperature, dim=-1)
+        print(f"[{generation_id}] Decoding image...")
+        if task_id:
+            update_task(task_id, {
+                "status": "decoding",
+                "progress": 85,
+                "message": "Decoding image",
+                "timestamp": time.time()
+            })
 
-            next_token = torch.multinomial(probs, num_samples=1)
-            generated_tokens[:, i] = next_token.squeeze(dim=-1)
+        # The decode loop ran on the scheduler thread and is traced there;
+        # this trace covers the rest of the request
+        profiler = None
+        if profile:
+            from torch.profiler import ProfilerActivity
+            profiler = torch.profiler.profile(activities=[ProfilerActivity.CPU], record_shapes=True)
+            profiler.__enter__()
 
-            next_token = torch.cat([next_token.unsqueeze(dim=1), next_token.unsqueeze(dim=1)], dim=1).view(-1)
-            img_embeds = mmgpt.prepare_gen_img_embeds(next_token)
-            inputs_embeds = img_embeds.unsqueeze(dim=1)
+        # The decode and encode stages run on their own executors; this
+        # thread only waits for the image while the batch moves on
+        visual_img = decode_stage.submit(generated_tokens).result()
 
-        print("Decoding image...")
         if task_id:
-            with tasks_lock:
-                generation_tasks[task_id].update({
-                    "status": "decoding",
-                    "progress": 85,
-                    "message": "Decoding image",
-                    "timestamp": time.time()
-                })
-            
-        dec = mmgpt.gen_vision_model.decode_code(
-            generated_tokens.to(dtype=torch.int),
-            shape=[1, 8, img_size // patch_size, img_size // patch_size]
-        )
-        dec = dec.to(torch.float32).cpu().numpy().transpose(0, 2, 3, 1)
-        dec = np.clip((dec + 1) / 2 * 255, 0, 255)
-        visual_img = np.zeros((1, img_size, img_size, 3), dtype=np.uint8)
-        visual_img[:, :, :] = dec
-
-        # Generate a unique filename based on timestamp
-        filename = f"generated_image_{int(time.time())}.jpg"
-        save_path = os.path.join('generated_samples', filename)
-        
-        if task_id:
-            with tasks_lock:
-                generation_tasks[task_id].update({
-                    "status": "saving",
-                    "progress": 95,
-                    "message": "Saving image",
-                    "timestamp": time.time()
-                })
+            update_task(task_id, {
+                "status": "saving",
+                "progress": 95,
+                "message": "Saving image",
+                "timestamp": time.time()
+            })
             
-        PIL.Image.fromarray(visual_img[0]).save(save_path)
-        print(f"Image saved to {os.path.abspath(save_path)}")
+        stored = encode_stage.submit((visual_img[0], image_format, quality)).result()
+        filename, save_path = stored.name, stored.path
+        print(f"Image stored as {os.path.abspath(save_path)}")
+
+        if profiler is not None:
+            profiler.__exit__(None, None, None)
+            profiler.export_chrome_trace(profile_paths[1])
+            print(f"[{generation_id}] Profiler traces written to {', '.join(profile_paths)}")
         
         if task_id:
-            with tasks_lock:
-                generation_tasks[task_id].update({
-                    "status": "completed",
-                    "progress": 100,
-                    "message": "Image generation complete",
-                    "timestamp": time.time(),
-                    "filename": filename,
-                    "path": save_path
-                })
+            completed = {
+                "status": "completed",
+                "progress": 100,
+                "message": "Image generation complete",
+                "timestamp": time.time(),
+                "seed": sequence.seed,
+                "filename": filename,
+                "path": save_path
+            }
+            if profile:
+                completed["profile_traces"] = profile_paths
+            if preview_seconds is not None:
+                # Total time spent rendering the task's previews
+                completed["preview_render_seconds"] = round(preview_seconds, 3)
+            update_task(task_id, completed)
             
         return save_path
 
-    # Use local references to the model that are thread-safe
-    device = next(current_model.parameters()).device
-    
-    # Add a lock to prevent multiple concurrent token generations
-    # This is a critical section that can't be parallelized effectively on CPU
-    with generation_lock:
-        print(f"Starting image generation process for task {task_id if task_id else 'synchronous'}")
-        image_path = generate_cpu(current_model, current_processor, prompt, task_id=task_id, parallel_size=1)
-        print(f"Completed image generation for task {task_id if task_id else 'synchronous'}")
+    print(f"Starting image generation process for task {task_id if task_id else 'synchronous'}")
+    cancel_key = cancel_key or task_id
+    cancel_token = cancel_registry.register(cancel_key, deadline)
+    try:
+        with STAGE_SECONDS.labels("total").time():
+            image_path = generate_cpu(
+                current_model, current_processor, prompt, task_id=task_id,
+                temperature=temperature, cfg_weight=cfg_weight, cfg_schedule=cfg_schedule, seed=seed,
+                profile=profile, image_format=image_format, quality=quality, cancel_token=cancel_token,
+                preview_every=preview_every
+            )
+    finally:
+        cancel_registry.unregister(cancel_key)
+    print(f"Completed image generation for task {task_id if task_id else 'synchronous'}")
     
     return image_path
-    
-# Global lock for token generation process
-# This ensures only one image is being generated at a time
-generation_lock = threading.Lock()
+
+
+@uses_model
+def generate_pictures(user_prompts, task_ids=None, seeds=None,
+                      cfg_weight: float = 5.0, temperature: float = 1.0,
+                      cfg_schedule: CFGSchedule = None,
+                      image_format: str = None, quality: int = None,
+                      deadline: float = None, cancel_key=None, preview_every: int = None):
+    """
+    Generate one image per prompt as a batch: every sequence is submitted to
+    the batch scheduler at once so they are decoded in the same steps, and the
+    finished tokens are turned into pixels with a single decode_code call.
+    Returns the paths of the generated images, in prompt order.
+
+    task_ids and seeds, if given, hold one entry (or None) per prompt.
+    Each image can be cancelled by its task id, the images without one
+    together by cancel_key; cancelled images get a None path. If every
+    image was cancelled, e.g. past the deadline, GenerationCancelled is raised.
+    With preview_every, images with a task id get previews as in generate_picture.
+    """
+    current_processor = vl_chat_processor
+    count = len(user_prompts)
+    task_ids = list(task_ids or [None] * count)
+    seeds = list(seeds or [None] * count)
+    print(f"Processing batch generation request for {count} image(s)")
+
+    from batch_scheduler import GenerationSequence
+    cancel_tokens = {}  # Images without a task id share the token of cancel_key
+    try:
+        with STAGE_SECONDS.labels("total").time():
+            sequences = []
+            for user_prompt, task_id, seed in zip(user_prompts, task_ids, seeds):
+                key = task_id or cancel_key
+                if key not in cancel_tokens:
+                    cancel_tokens[key] = cancel_registry.register(key, deadline)
+                if task_id:
+                    update_task(task_id, {
+                        "status": "generating",
+                        "progress": 15,
+                        "message": "Waiting for a slot in the generation batch",
+                        "timestamp": time.time(),
+                        "prompt": user_prompt[:50] + "..." if len(user_prompt) > 50 else user_prompt
+                    })
+                with STAGE_SECONDS.labels("template").time():
+                    prompt = apply_prompt_template(current_processor, user_prompt)
+                with STAGE_SECONDS.labels("tokenize").time():
+                    input_ids = current_processor.tokenizer.encode(prompt)
+                sequence = GenerationSequence(
+                    input_ids,
+                    task_id=task_id,
+                    temperature=temperature,
+                    cfg_weight=cfg_weight,
+                    cfg_schedule=cfg_schedule,
+                    seed=seed,
+                    on_progress=token_progress_callback(task_id),
+                    cancel_token=cancel_tokens[key],
+                )
+                if task_id and preview_every:
+                    sequence.on_progress = preview_progress_callback(task_id, sequence, preview_every)
+                sequences.append(sequence)
+
+            scheduler = get_batch_scheduler()
+            for sequence in sequences:
+                scheduler.submit(sequence)
+            finished = []  # Indices of the images that were not cancelled
+            cancelled = None
+            with STAGE_SECONDS.labels("token_generation").time():
+                for index, sequence in enumerate(sequences):
+                    try:
+                        sequence.wait()
+                        finished.append(index)
+                    except GenerationCancelled as e:
+                        cancelled = e
+                        if task_ids[index]:
+                            update_task(task_ids[index], task_failure(e))
+                    finally:
+                        if task_ids[index] and preview_every:
+                            preview_renderer.discard(task_ids[index])
+            if not finished:
+                raise cancelled
+            tokens = torch.cat([sequences[index].generated_tokens for index in finished])
+
+            for index in finished:
+                if task_ids[index]:
+                    update_task(task_ids[index], {
+                        "status": "decoding",
+                        "progress": 85,
+                        "message": "Decoding image",
+                        "timestamp": time.time()
+                    })
+            pixels = decode_stage.submit(tokens).result()
+
+            paths = [None] * count
+            encoded = [encode_stage.submit((pixels[row], image_format, quality)) for row in range(len(finished))]
+            for row, index in enumerate(finished):
+                stored = encoded[row].result()
+                paths[index] = stored.path
+                if task_ids[index]:
+                    update_task(task_ids[index], {
+                        "status": "completed",
+                        "progress": 100,
+                        "message": "Image generation complete",
+                        "timestamp": time.time(),
+                        "seed": sequences[index].seed,
+                        "filename": stored.name,
+                        "path": stored.path
+                    })
+    finally:
+        for key in cancel_tokens:
+            cancel_registry.unregister(key)
+    print(f"Completed batch generation of {len(finished)}/{count} image(s)")
+    return paths
+
+
+# Functions worker processes run on behalf of the parent, by name
+WORKER_FUNCTIONS = {
+    "generate_picture": generate_picture,
+    "generate_pictures": generate_pictures,
+}
+
+def run_worker_function(name, *args, **kwargs):
+    """
+    Handler of the worker processes: call one of WORKER_FUNCTIONS.
+    """
+    return WORKER_FUNCTIONS[name](*args, **kwargs)
+
+
+# Maximum number of images decoded together in one batched forward pass
+MAX_BATCH_SIZE = int(os.environ.get("JANUS_MAX_BATCH_SIZE", "4"))
+# Reuse the KV cache of the shared prompt template, disabled with JANUS_PREFIX_CACHE=0
+PREFIX_CACHE_ENABLED = os.environ.get("JANUS_PREFIX_CACHE", "1") != "0"
+# Run the decode step through torch.compile (JANUS_COMPILE=1). Compiling takes
+# a while, so it happens during the warmup, before the service reports ready;
+# if it fails the step runs eagerly
+COMPILE_DECODE = os.environ.get("JANUS_COMPILE", "0") == "1"
+
+# Continuous batching scheduler shared by all generation requests.
+# Created once the model is loaded, see get_batch_scheduler()
+batch_scheduler = None
+scheduler_lock = InstrumentedLock(LOCK_WAIT_SECONDS.labels("scheduler"))
+
+def get_batch_scheduler():
+    """
+    Return the batch scheduler, creating it around the loaded model on first use.
+    """
+    global batch_scheduler
+    with scheduler_lock:
+        if batch_scheduler is None:
+            from batch_scheduler import BatchScheduler
+            batch_scheduler = BatchScheduler(
+                vl_gpt, vl_chat_processor,
+                max_batch_size=MAX_BATCH_SIZE,
+                use_prefix_cache=PREFIX_CACHE_ENABLED,
+                compile_decode=COMPILE_DECODE
+            )
+            compiled = ", compiled decode step" if batch_scheduler.engine.compile else ""
+            print(f"Batch scheduler started (max batch size: {MAX_BATCH_SIZE}{compiled})")
+        return batch_scheduler
+
+
+def task_failure(error):
+    """
+    Task fields recording why a generation did not complete: "cancelled"
+    (with the reason) for cancellations and deadlines, "failed" otherwise.
+    """
+    if is_cancellation(error):
+        return {
+            "status": "cancelled",
+            "message": "Image generation cancelled",
+            "reason": getattr(error, "reason", None) or str(error).rpartition(": ")[2],
+            "timestamp": time.time()
+        }
+    return {
+        "status": "failed",
+        "message": "Image generation failed",
+        "error": str(error),
+        "timestamp": time.time()
+    }
+
+
+def run_generation_job(user_prompt: str, task_id=None, cache_key=None, image_metadata=None, **generation_kwargs):
+    """
+    Entry point for queue workers: generate the image, index it with
+    image_metadata (user_id, project_id), store it in the result cache and
+    record failures on the task so pollers see them.
+    """
+    try:
+        if worker_pool is not None:
+            image_path = worker_pool.run("generate_picture", user_prompt, task_id, **generation_kwargs)
+        else:
+            image_path = generate_picture(user_prompt, task_id, **generation_kwargs)
+        image = image_store.get(os.path.basename(image_path))
+        if image is not None:
+            image_index.add(image.name, len(image.data), task_id=task_id, prompt=user_prompt, **(image_metadata or {}))
+        if cache_key and result_cache is not None and image is not None:
+            try:
+                result_cache.put(cache_key, image.data, image.name.rpartition(".")[2])
+            except OSError as e:
+                print(f"Could not cache generated image: {e}")
+        return image_path
+    except Exception as e:
+        if task_id:
+            update_task(task_id, task_failure(e))
+        raise
+
+
+def run_batch_job(user_prompts, task_ids=None, image_metadata=None, **generation_kwargs):
+    """
+    Entry point for queue workers running a /generate_batch job: generate
+    every image, index them and mark all tasks failed if the batch fails.
+    Cancelled images have a None path.
+    """
+    task_ids = task_ids or [None] * len(user_prompts)
+    try:
+        if worker_pool is not None:
+            image_paths = worker_pool.run("generate_pictures", user_prompts, task_ids, **generation_kwargs)
+        else:
+            image_paths = generate_pictures(user_prompts, task_ids, **generation_kwargs)
+        for user_prompt, task_id, image_path in zip(user_prompts, task_ids, image_paths):
+            if image_path is None:
+                continue
+            image = image_store.get(os.path.basename(image_path))
+            if image is not None:
+                image_index.add(
+                    image.name, len(image.data), task_id=task_id, prompt=user_prompt, **(image_metadata or {})
+                )
+        return image_paths
+    except Exception as e:
+        for task_id in task_ids:
+            if task_id:
+                update_task(task_id, task_failure(e))
+        raise
+
+
+# CPU layout measured for this host type with benchmarks/tune_threads.py, if
+# the tuning file has a profile for it; the JANUS_ settings below override it
+TUNING_PATH = os.environ.get("JANUS_TUNING", "tuning.json")
+TUNING = read_tuning(TUNING_PATH, model="janus") or {}
+if TUNING:
+    print(f"Using the CPU tuning profile from {TUNING_PATH} "
+          f"({TUNING.get('images_per_hour')} images/hour when measured)")
+
+# Number of forked worker processes sharing the model weights; 0 generates in
+# this process. Each worker process runs its own batch scheduler
+WORKER_PROCESSES = int(os.environ.get("JANUS_WORKER_PROCESSES", str(TUNING.get("worker_processes", 0))))
+# torch intra-op threads per worker process (or of this process), by default
+# the cores split evenly between worker processes and torch's default otherwise
+THREADS_PER_WORKER = int(os.environ.get(
+    "JANUS_THREADS_PER_WORKER",
+    str(TUNING.get("threads_per_worker") or max(1, (os.cpu_count() or 1) // max(1, WORKER_PROCESSES)))
+))
+# torch inter-op threads, 0 keeps torch's default
+INTEROP_THREADS = int(os.environ.get("JANUS_INTEROP_THREADS", str(TUNING.get("interop_threads", 0))))
+# Pinning of the generating process(es) to CPUs: none, cores or numa (see cpu_tuning)
+CPU_PIN = os.environ.get("JANUS_CPU_PIN", TUNING.get("pin", "none"))
+CPU_SETS = worker_cpu_sets(cpu_topology(), max(1, WORKER_PROCESSES), CPU_PIN)
+
+if WORKER_PROCESSES > 0:
+    # Inherited by the worker processes, which set their own threads and CPUs
+    apply_thread_settings(interop_threads=INTEROP_THREADS)
+else:
+    threads_configured = bool(TUNING) or "JANUS_THREADS_PER_WORKER" in os.environ
+    apply_thread_settings(
+        THREADS_PER_WORKER if threads_configured else None, INTEROP_THREADS, CPU_SETS[0] if CPU_SETS else None
+    )
+
+# Started by start_worker_pool() when WORKER_PROCESSES > 0
+worker_pool = None
+
+# Jobs per process that can be in the VQ decode and encode stages (see
+# pipeline.py) while a full batch is sampling tokens; also the bound of each
+# stage's queue
+PIPELINE_DEPTH = int(os.environ.get("JANUS_PIPELINE_DEPTH", str(MAX_BATCH_SIZE)))
+# Threads of the encode/persist stage
+ENCODE_WORKERS = int(os.environ.get("JANUS_ENCODE_WORKERS", "2"))
+# Jobs each process works on at once: a full batch sampling plus the ones
+# being decoded and encoded, so the batch refills as soon as a sequence is done
+JOBS_PER_PROCESS = MAX_BATCH_SIZE + PIPELINE_DEPTH
+
+# Number of jobs allowed to wait for a worker before /generate answers 429
+QUEUE_DEPTH = int(os.environ.get("JANUS_QUEUE_DEPTH", "32"))
+# Worker threads feeding jobs to the scheduler(s); by default enough to keep
+# every worker process's batch and pipeline full
+NUM_WORKERS = int(os.environ.get("JANUS_WORKERS", str(JOBS_PER_PROCESS * max(1, WORKER_PROCESSES))))
+
+generation_queue = JobQueue(run_generation_job, max_depth=QUEUE_DEPTH, num_workers=NUM_WORKERS)
+
+QUEUED_JOBS.set_function(lambda: generation_queue.stats()["queued"])
+ACTIVE_JOBS.set_function(lambda: generation_queue.stats()["running"])
+TASKS.set_function(lambda: len(task_store))
+
+# Allows /generate requests with "profile": true to capture torch profiler
+# traces into PROFILE_FOLDER. Off by default since traces are large
+PROFILING_ENABLED = os.environ.get("JANUS_PROFILING", "0") == "1"
+PROFILE_FOLDER = os.path.join(STATE_FOLDER, 'profiles')
+
+# Output format of generated images (jpeg, webp or png) and encoder quality,
+# overridable per request with "format" and "quality"; no quality keeps PIL's default
+IMAGE_FORMAT, IMAGE_QUALITY = validate_format(
+    os.environ.get("JANUS_IMAGE_FORMAT"), os.environ.get("JANUS_IMAGE_QUALITY") or None
+)
+# Encoded images kept in memory for serving, by total size
+IMAGE_MEMORY_MAX_BYTES = int(os.environ.get("JANUS_IMAGE_MEMORY_MAX_BYTES", str(128 * 1024 * 1024)))
+image_store = ImageStore('generated_samples', max_bytes=IMAGE_MEMORY_MAX_BYTES)
+
+# Retention of generated images: the oldest are deleted once they are older than
+# JANUS_IMAGE_RETENTION_DAYS or exceed JANUS_IMAGE_RETENTION_COUNT images or
+# JANUS_IMAGE_RETENTION_BYTES in total (0 disables a bound), checked every
+# JANUS_IMAGE_GC_INTERVAL seconds
+IMAGE_RETENTION_DAYS = float(os.environ.get("JANUS_IMAGE_RETENTION_DAYS", "30"))
+IMAGE_RETENTION_COUNT = int(os.environ.get("JANUS_IMAGE_RETENTION_COUNT", "0"))
+IMAGE_RETENTION_BYTES = int(os.environ.get("JANUS_IMAGE_RETENTION_BYTES", str(2 * 1024 ** 3)))
+IMAGE_GC_INTERVAL = float(os.environ.get("JANUS_IMAGE_GC_INTERVAL", "300"))
+IMAGE_INDEX_PATH = os.path.join(STATE_FOLDER, 'image_index.json')
+if os.path.exists(os.path.join('generated_samples', 'index.json')) and not os.path.exists(IMAGE_INDEX_PATH):
+    # Written inside the served folder by earlier versions
+    os.replace(os.path.join('generated_samples', 'index.json'), IMAGE_INDEX_PATH)
+image_index = ImageIndex(
+    'generated_samples', image_store.prefix, MIMETYPES,
+    max_age=IMAGE_RETENTION_DAYS * 86400, max_count=IMAGE_RETENTION_COUNT, max_bytes=IMAGE_RETENTION_BYTES,
+    on_remove=image_store.discard, index_path=IMAGE_INDEX_PATH,
+)
+image_index.start(IMAGE_GC_INTERVAL)
+atexit.register(image_index.save)
+STORED_IMAGES.set_function(lambda: image_index.stats()["images"])
+STORED_IMAGE_BYTES.set_function(lambda: image_index.stats()["bytes"])
+
+# Progressive previews, requested per task with "preview": true (see preview.py):
+# the partial image is rendered every JANUS_PREVIEW_EVERY_TOKENS image tokens
+# (overridable with "preview_every", at least PREVIEW_MIN_EVERY_TOKENS) as a
+# JANUS_PREVIEW_SIZE pixel JPEG of JANUS_PREVIEW_QUALITY. 0 disables previews
+PREVIEW_EVERY_TOKENS = int(os.environ.get("JANUS_PREVIEW_EVERY_TOKENS", "96"))
+PREVIEW_MIN_EVERY_TOKENS = 32
+PREVIEW_SIZE = int(os.environ.get("JANUS_PREVIEW_SIZE", "192"))
+PREVIEW_QUALITY = int(os.environ.get("JANUS_PREVIEW_QUALITY", "60"))
+preview_renderer = PreviewRenderer(
+    lambda tokens, step: render_preview(vl_gpt, tokens, step, PREVIEW_SIZE, PREVIEW_QUALITY),
+    publish_preview,
+)
+preview_store = PreviewStore()
+
+# Stages after token sampling: VQ decoding of the tokens of every waiting image
+# at once, then encoding and storing the pixels (see pipeline.py)
+decode_stage = PipelineStage("vq_decode", decode_pending, max_queued=PIPELINE_DEPTH, max_batch=MAX_BATCH_SIZE)
+encode_stage = PipelineStage(
+    "encode", lambda items: [store_image(*item) for item in items],
+    workers=ENCODE_WORKERS, max_queued=PIPELINE_DEPTH
+)
+
+# Content-addressed cache of finished images, disabled with JANUS_RESULT_CACHE=0
+RESULT_CACHE_ENABLED = os.environ.get("JANUS_RESULT_CACHE", "1") != "0"
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("JANUS_RESULT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+result_cache = ResultCache(
+    os.path.join(STATE_FOLDER, 'result_cache'), max_bytes=RESULT_CACHE_MAX_BYTES
+) if RESULT_CACHE_ENABLED else None
+
+# Jobs currently queued or running, by cache key, priority and preview
+# interval, so identical requests can attach to them instead of generating the same image twice. Every request
+# attached to a job counts as one of its waiters; the job is only cancelled
+# once the last of them gives up (see cancel_task and abandon_job)
+inflight_jobs = {}
+# Tasks of async requests attached to a synchronous request's job, by task id
+attached_tasks = {}
+inflight_lock = InstrumentedLock(LOCK_WAIT_SECONDS.labels("inflight"))
+
+def track_inflight(cache_key, job):
+    """
+    Remove a job from inflight_jobs once it is done, unless another job has
+    taken its cache key since. Call without holding inflight_lock.
+    """
+    def forget(job):
+        with inflight_lock:
+            if inflight_jobs.get(cache_key) is job:
+                del inflight_jobs[cache_key]
+    job.add_done_callback(forget)
+
+def follow_job(job, task_id):
+    """
+    Record the outcome of a job without a task, i.e. a synchronous request's,
+    on the task of an async request attached to it, unless that request
+    detached from the job since. The task must be in attached_tasks.
+    """
+    def on_done(job):
+        with inflight_lock:
+            if attached_tasks.get(task_id) is not job:
+                return  # Detached, already recorded as cancelled
+            del attached_tasks[task_id]
+        if job.error is not None:
+            update_task(task_id, task_failure(job.error))
+            return
+        update_task(task_id, {
+            "status": "completed",
+            "progress": 100,
+            "message": "Image generation complete",
+            "timestamp": time.time(),
+            "filename": os.path.basename(job.result),
+            "path": job.result
+        })
+    job.add_done_callback(on_done)
+
+# Average number of image tokens per request, used for ETAs
+IMAGE_TOKEN_NUM_PER_IMAGE = 576
+
+# Per-sequence decode rate measured from worker process progress updates
+worker_tokens_per_second = None
+
+
+def start_worker_pool():
+    """
+    Fork the generation worker processes. Must run after load_model() so the
+    workers share the loaded weights copy-on-write instead of loading their own.
+    """
+    global worker_pool
+
+    def on_start(forward_update):
+        global task_update_forwarder
+        task_update_forwarder = forward_update
+        if WARMUP_ENABLED or COMPILE_DECODE:
+            warmup_model()
+        # Metrics recorded by the parent before the fork are reported by the parent
+        REGISTRY.reset()
+
+    worker_pool = ProcessWorkerPool(
+        run_worker_function,
+        num_processes=WORKER_PROCESSES,
+        jobs_per_process=JOBS_PER_PROCESS,
+        threads_per_process=THREADS_PER_WORKER,
+        on_start=on_start,
+        on_update=record_worker_update,
+        reporter=REGISTRY.snapshot,
+        on_report=REGISTRY.merge,
+        on_message=lambda message: cancel_registry.cancel(*message),
+        cpu_sets=CPU_SETS,
+    )
+    pinned = f", pinned by {CPU_PIN}" if CPU_SETS else ""
+    print(f"Started {WORKER_PROCESSES} worker processes with {THREADS_PER_WORKER} threads each{pinned}")
+    return worker_pool
+
+
+def record_worker_update(task_id, fields):
+    """
+    Apply a task update sent by a worker process and track the decode rate.
+    """
+    global worker_tokens_per_second
+    previous = task_store.get(task_id) or {}
+    if "tokens_generated" in fields and "tokens_generated" in previous:
+        tokens = fields["tokens_generated"] - previous["tokens_generated"]
+        seconds = fields["timestamp"] - previous["timestamp"]
+        if tokens > 0 and seconds > 0:
+            rate = tokens / seconds
+            if worker_tokens_per_second is None:
+                worker_tokens_per_second = rate
+            else:
+                worker_tokens_per_second = 0.8 * worker_tokens_per_second + 0.2 * rate
+    update_task(task_id, fields)
+
+
+def current_tokens_per_second():
+    """
+    Return the measured per-sequence decode rate, or None before any decoding.
+    """
+    if worker_pool is not None:
+        return worker_tokens_per_second
+    return batch_scheduler.tokens_per_second() if batch_scheduler else None
+
+
+def estimate_eta(task_id, task_data):
+    """
+    Estimate the seconds until a task completes from the measured decode rate.
+    Returns (queue_position, eta_seconds); either may be None if unknown.
+    """
+    tokens_per_second = current_tokens_per_second()
+    status = task_data.get("status")
+
+    if status == "pending":
+        position = generation_queue.position(task_id)
+        if position is None or tokens_per_second is None:
+            return position, None
+        wait = generation_queue.estimate_wait(position) or 0
+        return position, wait + IMAGE_TOKEN_NUM_PER_IMAGE / tokens_per_second
+
+    if status in TERMINAL_STATUSES or tokens_per_second is None:
+        return None, None
+
+    total = task_data.get("tokens_total", IMAGE_TOKEN_NUM_PER_IMAGE)
+    remaining = total - task_data.get("tokens_generated", 0)
+    return None, remaining / tokens_per_second
 
 
 # Add a root route for health checks
@@ -303,55 +1212,178 @@ generation_lock = threading.Lock()
 def health_check():
     return jsonify({"status": "Image generation service running"}), 200
 
-# Add a route to serve generated images directly
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics: per-stage latencies, queue and batch sizes, lock waits and memory."""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """
+    Readiness probe: 503 until the model is loaded (and warmed up), with startup
+    timings. Once ready, a model freed as idle is reloaded by the next request,
+    so the service stays ready; "model" reports its residency in this process.
+    """
+    if draining.is_set():
+        return jsonify({"status": "draining", "startup_seconds": STARTUP_TIMINGS}), 503
+    if model_ready.is_set():
+        model = {
+            "resident": vl_gpt is not None,
+            "idle_seconds": round(model_residency.idle_for(), 1),
+            "idle_evict_seconds": model_residency.idle_seconds or None,
+            "events": list(model_events),
+        }
+        return jsonify({"status": "ready", "startup_seconds": STARTUP_TIMINGS, "model": model}), 200
+    if startup_error is not None:
+        return jsonify({"status": "failed", "error": startup_error, "startup_seconds": STARTUP_TIMINGS}), 503
+    return jsonify({"status": "loading", "startup_seconds": STARTUP_TIMINGS}), 503
+
+# Image names are content hashes, so their URLs can be cached for good
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+def image_response(image, cache_control=IMMUTABLE_CACHE_CONTROL):
+    """
+    Serve a StoredImage from memory with its content hash as ETag; a matching
+    If-None-Match gets 304 Not Modified.
+    """
+    response = Response(image.data, mimetype=image.mimetype)
+    response.set_etag(image.etag)
+    response.headers['Cache-Control'] = cache_control
+    return response.make_conditional(request)
+
+# Add a route to serve generated images directly. Only image files are
+# served: anything else in the folder, or a subdirectory, is not found
 @app.route('/generated_samples/<path:filename>')
 def serve_generated_image(filename):
-    file_path = os.path.join(app.config['GENERATED_FOLDER'], filename)
-    if os.path.exists(file_path):
-        return send_file(file_path, mimetype='image/jpeg')
-    else:
+    image = image_store.get(filename) if image_store.is_image_name(filename) else None
+    if image is None:
         return jsonify({"error": "Image not found"}), 404
+    return image_response(image)
 
 @app.route('/latest_image', methods=['GET'])
 def get_latest_image():
-    """Returns the most recently generated image"""
-    try:
-        # Get all jpg files in the generated folder
-        files = [f for f in os.listdir(app.config['GENERATED_FOLDER']) 
-                if f.endswith('.jpg') and f.startswith('generated_image_')]
-        
-        if not files:
-            return jsonify({"error": "No images found"}), 404
-            
-        # Sort by timestamp (newest first)
-        files.sort(reverse=True)
-        latest_file = files[0]
-        
-        return send_file(
-            os.path.join(app.config['GENERATED_FOLDER'], latest_file),
-            mimetype='image/jpeg'
-        )
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    """
+    Returns the most recently generated image, of one project with ?projectId=
+    """
+    project_id = request.args.get('projectId')
+    record = image_index.latest(project_id)
+    image = image_store.get(record.name) if record is not None else None
+    if image is None:
+        return jsonify({"error": "No images found"}), 404
+    response = image_response(image, cache_control='no-cache')
+    response.headers['X-Image-URL'] = f"/generated_samples/{image.name}"
+    return response
+
+
+def progress_payload(task_id, task_data):
+    """
+    Build the /progress response body for a task snapshot, including the
+    queue position and ETA when known.
+    """
+    payload = {"task_id": task_id, **task_data}
+    queue_position, eta_seconds = estimate_eta(task_id, task_data)
+    if queue_position is not None:
+        payload["queue_position"] = queue_position
+    if eta_seconds is not None:
+        payload["eta_seconds"] = round(eta_seconds, 1)
+    if task_data.get("status") == "completed":
+        payload["result_url"] = f"/result/{task_id}"
+        if "filename" in task_data:
+            payload["image_url"] = f"/generated_samples/{task_data['filename']}"
+    return payload
 
 
 # Add endpoint to check progress of a generation task
 @app.route('/progress/<task_id>', methods=['GET'])
 def check_progress(task_id):
-    with tasks_lock:
-        if task_id not in generation_tasks:
-            return jsonify({
-                "error": "Task not found",
-                "task_id": task_id
-            }), 404
-            
-        # Make a copy of the task data to avoid race conditions
-        task_data = dict(generation_tasks[task_id])
-        
-    return jsonify({
-        "task_id": task_id,
-        **task_data
-    })
+    task_data = task_store.get(task_id)
+    if task_data is None:
+        return jsonify({
+            "error": "Task not found",
+            "task_id": task_id
+        }), 404
+
+    return jsonify(progress_payload(task_id, task_data))
+
+
+# Seconds between keep-alive comments on idle event streams; also how quickly
+# a disconnected client is noticed
+EVENT_STREAM_KEEPALIVE = 15
+# With a shared task store a task may be generated by another server process,
+# whose updates never reach this process's event bus; event streams re-read
+# the task's record this often instead
+EVENT_STREAM_POLL_SECONDS = 1.0
+
+def event_stream_wait():
+    """Seconds an event stream waits for an update before checking the task store."""
+    return EVENT_STREAM_POLL_SECONDS if task_store.shared else EVENT_STREAM_KEEPALIVE
+
+def refreshed_task_snapshot(task_id, snapshot):
+    """
+    With a shared task store, return the task's record if another process
+    changed it since ``snapshot``; None otherwise.
+    """
+    if not task_store.shared:
+        return None
+    record = task_store.get(task_id)
+    return record if record is not None and record != snapshot else None
+
+def task_event_message(task_id, snapshot):
+    """
+    Format a task snapshot as a Server-Sent Event: "progress" while the task
+    runs, its final status once it is done. Returns (event, message).
+    """
+    status = snapshot.get("status")
+    event = status if status in TERMINAL_STATUSES else "progress"
+    return event, f"event: {event}\ndata: {json.dumps(progress_payload(task_id, snapshot))}\n\n"
+
+
+@app.route('/events/<task_id>', methods=['GET'])
+def stream_task_events(task_id):
+    """
+    Server-Sent Events stream of a task's progress. Sends a "progress" event
+    per update and ends with a "completed" or "failed" event carrying the
+    final state, including the result URL.
+    """
+    # Subscribe before reading the current state so no update is missed
+    subscriber = task_events.subscribe(task_id)
+    task_data = task_store.get(task_id)
+    if task_data is None:
+        task_events.unsubscribe(task_id, subscriber)
+        return jsonify({
+            "error": "Task not found",
+            "task_id": task_id
+        }), 404
+
+    def stream():
+        try:
+            snapshot = task_data
+            while True:
+                event, message = task_event_message(task_id, snapshot)
+                yield message
+                if event != "progress":
+                    return
+                idle = 0.0
+                while True:
+                    try:
+                        snapshot = subscriber.get(timeout=event_stream_wait())
+                        break
+                    except queue.Empty:
+                        refreshed = refreshed_task_snapshot(task_id, snapshot)
+                        if refreshed is not None:
+                            snapshot = refreshed
+                            break
+                        idle += event_stream_wait()
+                        if idle >= EVENT_STREAM_KEEPALIVE:
+                            idle = 0.0
+                            yield ": keep-alive\n\n"
+        finally:
+            task_events.unsubscribe(task_id, subscriber)
+
+    response = Response(stream_with_context(stream()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 @app.route('/status/<task_id>', methods=['GET'])
 def get_status_and_result(task_id):
@@ -359,24 +1391,23 @@ def get_status_and_result(task_id):
     Returns both progress info and the image if it's ready.
     This reduces the number of requests needed.
     """
-    with tasks_lock:
-        if task_id not in generation_tasks:
-            return jsonify({
-                "error": "Task not found",
-                "task_id": task_id
-            }), 404
-            
-        # Make a copy of the task data to avoid race conditions
-        task_data = dict(generation_tasks[task_id])
+    task_data = task_store.get(task_id)
+    if task_data is None:
+        return jsonify({
+            "error": "Task not found",
+            "task_id": task_id
+        }), 404
     
     # Check if the task is completed and return the image
     if task_data.get("status") == "completed" and "path" in task_data:
-        if os.path.exists(task_data["path"]):
+        image = image_store.get(task_data.get("filename"))
+        if image is not None:
             # In a normal implementation, we'd return both the image and status
             # But Flask can't return both data and a file easily, so we'll add
             # the status info to response headers
 
-            response = send_file(task_data["path"], mimetype='image/jpeg')
+            # The same URL answers JSON until the task completes, so clients revalidate
+            response = image_response(image, cache_control='no-cache')
             response.headers['X-Task-Status'] = 'completed'
             response.headers['X-Task-Progress'] = '100'
             return response
@@ -399,11 +1430,9 @@ def get_status_and_result(task_id):
 
 @app.route('/result/<task_id>', methods=['GET'])
 def get_result(task_id):
-    with tasks_lock:
-        if task_id not in generation_tasks:
-            return jsonify({"error": "Task not found"}), 404
-            
-        task_data = dict(generation_tasks[task_id])
+    task_data = task_store.get(task_id)
+    if task_data is None:
+        return jsonify({"error": "Task not found"}), 404
     
     # Check task status
     if task_data.get("status") != "completed":
@@ -414,10 +1443,223 @@ def get_result(task_id):
         return jsonify({"error": "Image path not found in task data"}), 500
         
     # Check if file exists
-    if not os.path.exists(task_data["path"]):
+    image = image_store.get(task_data.get("filename"))
+    if image is None:
         return jsonify({"error": "Image file does not exist on disk"}), 500
-        
-    return send_file(task_data["path"], mimetype='image/jpeg')
+
+    return image_response(image)
+
+@app.route('/preview/<task_id>', methods=['GET'])
+def get_preview(task_id):
+    """
+    Latest preview of a task generated with "preview": true, or its image once
+    it is completed. 404 until the first preview is rendered.
+    """
+    task_data = task_store.get(task_id)
+    if task_data is None:
+        return jsonify({"error": "Task not found", "task_id": task_id}), 404
+
+    if task_data.get("status") == "completed":
+        image = image_store.get(task_data.get("filename"))
+        if image is not None:
+            response = image_response(image, cache_control='no-cache')
+            response.headers['X-Task-Status'] = 'completed'
+            return response
+    preview = preview_store.get(task_id)
+    if preview is None:
+        return jsonify({"error": "No preview available", "status": task_data.get("status")}), 404
+    response = image_response(preview, cache_control='no-cache')
+    response.headers['X-Task-Status'] = task_data.get("status", "unknown")
+    response.headers['X-Preview-Step'] = preview.etag.rpartition("-")[2]
+    return response
+
+@app.route('/task/<task_id>', methods=['DELETE'])
+def cancel_task(task_id):
+    """
+    Cancel a task: a queued task is dropped right away, a running one stops
+    at the next decode step and ends with the "cancelled" status.
+    """
+    task_data = task_store.get(task_id)
+    if task_data is None:
+        return jsonify({"error": "Task not found"}), 404
+    if task_data.get("status") in TERMINAL_STATUSES:
+        return jsonify({"error": "Task already finished", "status": task_data.get("status")}), 409
+    if task_data.get("owner", SERVER_ID) != SERVER_ID:
+        # Its job is queued in another process sharing the task store
+        return jsonify({"error": "Task is handled by another server process", "status": task_data.get("status")}), 409
+
+    # A batch job carries all of its tasks, so only the task's image is stopped
+    if "batch_id" in task_data:
+        stop_generation(task_id)
+        status = "cancelling"
+        print(f"Cancel requested for task {task_id} ({status})")
+        return jsonify({"task_id": task_id, "status": status, "status_url": f"/status/{task_id}"}), 202
+
+    # Identical requests share a job: one giving up only detaches from it
+    # while others still wait for the result
+    with inflight_lock:
+        job = attached_tasks.get(task_id)
+        if job is None:
+            job = next((job for job in inflight_jobs.values() if job.task_id == task_id), None)
+        if job is not None:
+            job.waiters -= 1
+        detached = job is not None and job.waiters > 0
+        if detached and job.task_id != task_id:
+            del attached_tasks[task_id]
+    if detached:
+        if job.task_id != task_id:
+            update_task(task_id, task_failure(GenerationCancelled(CANCELLED)))
+        status = "detached"
+    elif job is not None and job.task_id != task_id:
+        # The last request following a synchronous request's job
+        status = "cancelled" if cancel_generation(job.job_id, job.kwargs["cancel_key"]) else "cancelling"
+    else:
+        status = "cancelled" if cancel_generation(task_id, task_id) else "cancelling"
+    print(f"Cancel requested for task {task_id} ({status})")
+    return jsonify({"task_id": task_id, "status": status, "status_url": f"/status/{task_id}"}), 202
+
+
+def parse_generation_options(data):
+    """
+    Read the sampling, guidance and output format options of a /generate or
+    /generate_batch payload into generate_picture keyword arguments. Options
+    left at their defaults are omitted. Raises ValueError for invalid values.
+    """
+    generation_kwargs = {
+        "seed": int(data['seed']) if data.get('seed') is not None else None,
+        "cfg_weight": float(data.get('cfg_weight', 5.0)),
+        "temperature": float(data.get('temperature', 1.0)),
+    }
+
+    # Optional guidance schedule: cfg_decay ("linear"/"cosine") towards
+    # cfg_final_weight, and dropping the unconditional row from the
+    # cfg_cutoff fraction (or cfg_cutoff_step token) of the image on
+    cfg_schedule = CFGSchedule.from_request(data, generation_kwargs["cfg_weight"])
+    if not cfg_schedule.is_default:
+        generation_kwargs["cfg_schedule"] = cfg_schedule
+
+    # Output format ("jpeg", "webp" or "png") and encoder quality (1-100)
+    image_format, quality = validate_format(data.get('format', IMAGE_FORMAT), data.get('quality', IMAGE_QUALITY))
+    if (image_format, quality) != (IMAGE_FORMAT, IMAGE_QUALITY):
+        generation_kwargs["image_format"] = image_format
+        generation_kwargs["quality"] = quality
+
+    # Seconds the generation may take from now, including the time spent queued
+    if data.get('deadline_seconds') is not None:
+        deadline_seconds = float(data['deadline_seconds'])
+        if deadline_seconds <= 0:
+            raise ValueError("deadline_seconds must be positive")
+        generation_kwargs["deadline"] = time.time() + deadline_seconds
+
+    # Progressive previews of async tasks, every preview_every image tokens
+    if data.get('preview') and PREVIEW_EVERY_TOKENS > 0:
+        preview_every = int(data.get('preview_every', PREVIEW_EVERY_TOKENS))
+        if preview_every < PREVIEW_MIN_EVERY_TOKENS:
+            raise ValueError(f"preview_every must be at least {PREVIEW_MIN_EVERY_TOKENS}")
+        generation_kwargs["preview_every"] = preview_every
+    return generation_kwargs
+
+
+# How often synchronous requests check whether their client went away
+DISCONNECT_POLL_SECONDS = 1.0
+
+def client_disconnected():
+    """
+    Whether the client of the current request closed its connection. Only
+    detectable when the server exposes the socket (werkzeug does).
+    """
+    sock = request.environ.get('werkzeug.socket')
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        # A closed connection is readable with nothing left to read
+        return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b''
+    except (OSError, ValueError):
+        return True
+
+
+def stop_generation(cancel_key, reason=CANCELLED):
+    """
+    Stop the running generation registered under cancel_key at its next
+    decode step, in whichever process runs it. A generation that has not
+    started yet stops as soon as it does.
+    """
+    if worker_pool is not None:
+        worker_pool.broadcast((cancel_key, reason))
+    else:
+        cancel_registry.cancel(cancel_key, reason)
+
+
+def cancel_generation(job_id, cancel_key, reason=CANCELLED):
+    """
+    Cancel a generation: a job still waiting in the queue is removed from it,
+    a running one is stopped by the batch scheduler at its next step. Returns
+    whether the job was removed from the queue.
+    """
+    job = generation_queue.cancel(job_id, reason)
+    if job is None:
+        stop_generation(cancel_key, reason)
+        return False
+
+    # Its inflight_jobs entry goes with the done callback (see track_inflight)
+    if job.task_id:
+        update_task(job.task_id, task_failure(job.error))
+    return True
+
+
+def wait_for_client(job, cancel_key):
+    """
+    Wait for the job of a synchronous request. If the client disconnects
+    first, the generation is cancelled unless another request still waits
+    for it, and GenerationCancelled is raised.
+    """
+    while True:
+        try:
+            return job.wait(timeout=DISCONNECT_POLL_SECONDS)
+        except TimeoutError:
+            pass
+        if client_disconnected():
+            break
+    abandon_job(job, cancel_key)
+    raise GenerationCancelled(CLIENT_DISCONNECTED)
+
+
+def abandon_job(job, cancel_key):
+    """
+    Called when the client of a synchronous request went away: cancel the
+    job unless another request still waits for it.
+    """
+    with inflight_lock:
+        job.waiters -= 1
+        abandoned = job.waiters <= 0
+    if abandoned:
+        print(f"Client of job {job.job_id} disconnected, cancelling it")
+        cancel_generation(job.job_id, cancel_key, CLIENT_DISCONNECTED)
+
+
+def finish_sync_request(job, cancel_key, request_id: str, respond):
+    """
+    Wait for the job of a synchronous request and build the response with
+    ``respond(result)``, or the cancellation response. A server that can wait
+    without blocking a thread (see async_server) puts a "janus.defer_job"
+    hook in the WSGI environ: it gets (job, cancel_key, finish) and calls
+    ``finish(job.wait)`` in a request context once the job is done.
+    """
+    def finish(wait):
+        try:
+            result = wait()
+        except Exception as e:
+            if not is_cancellation(e):
+                raise
+            return cancelled_response(e, request_id)
+        return respond(result)
+
+    defer = request.environ.get("janus.defer_job")
+    if defer is not None:
+        return defer(job, cancel_key, finish)
+    return finish(lambda: wait_for_client(job, cancel_key))
+
 
 @app.route('/generate', methods=['POST', 'OPTIONS'])
 def generate():
@@ -425,17 +1667,8 @@ def generate():
         # Handle preflight request
         response = app.make_default_options_response()
         return response
-    
-    # Check if we're already generating an image (for synchronous mode)
-    if not generation_lock.acquire(blocking=False):
-        print("⚠️ Generation already in progress, returning busy status")
-        return jsonify({
-            "error": "Image generation already in progress. Please try again after current generation completes.",
-            "status": "busy"
-        }), 429
-    
-    # Release the lock - we'll acquire it again in generate_picture if needed
-    generation_lock.release()
+    if draining.is_set():
+        return draining_response()
     
     try:
         data = request.get_json()
@@ -451,59 +1684,169 @@ def generate():
             print(f"User ID: {data['userId']}")
         if 'projectId' in data:
             print(f"Project ID: {data['projectId']}")
+        # Recorded with the image in the image index
+        image_metadata = {"user_id": data.get('userId'), "project_id": data.get('projectId')}
         
         # Check if direct synchronous response is requested
         use_async = data.get('async', True)
+
+        # Interactive jobs are served ahead of background ones
+        priority = PRIORITIES.get(data.get('priority', 'interactive'), PRIORITY_INTERACTIVE)
+
+        # Sampling parameters, guidance schedule and output format; together
+        # with the prompt they form the cache key
+        try:
+            generation_kwargs = parse_generation_options(data)
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+        cfg_schedule = generation_kwargs.get("cfg_schedule")
+        image_format = generation_kwargs.get("image_format", IMAGE_FORMAT)
+        quality = generation_kwargs.get("quality", IMAGE_QUALITY)
+
+        # Torch profiler traces of this request, see PROFILING_ENABLED
+        if data.get('profile'):
+            if not PROFILING_ENABLED:
+                return jsonify({"error": "Profiling is disabled, start the service with JANUS_PROFILING=1"}), 400
+            generation_kwargs["profile"] = True
+
+        # Requests without a seed share one cache entry per prompt, so repeated
+        # illustrations are served from the cache; pass a seed or "cache": false
+        # to get a fresh sample
+        cache_key = None
+        if result_cache is not None and data.get('cache', True) and not generation_kwargs.get("profile"):
+            cache_key = ResultCache.key(
+                user_prompt, generation_kwargs["cfg_weight"], generation_kwargs["temperature"],
+                generation_kwargs["seed"], MODEL_ID,
+                cfg_schedule=cfg_schedule.describe() if cfg_schedule is not None else None,
+                image_format=None if (image_format, quality) == ("jpeg", None) else f"{image_format}:{quality}"
+            )
+            cached_path = result_cache.get(cache_key)
+            if cached_path:
+                print(f"Cache hit for request {request_id}")
+                return cached_result_response(cached_path, user_prompt, request_id, use_async, image_metadata)
+
+        # Identical requests in flight share one job, if they also agree on what
+        # the job does besides the image: its priority and previews. A request
+        # with a deadline gets its own, so neither imposes its deadline on the other
+        dedup_key = None
+        if cache_key and "deadline" not in generation_kwargs:
+            dedup_key = (cache_key, priority, generation_kwargs.get("preview_every"))
         
         if use_async:
             # Create a task ID for tracking progress
             task_id = str(uuid.uuid4())
             
             # Create the task entry first to avoid race conditions
-            with tasks_lock:
-                generation_tasks[task_id] = {
-                    "status": "pending",
-                    "progress": 0,
-                    "message": "Task created, waiting to start",
-                    "timestamp": time.time(),
-                    "prompt": user_prompt[:50] + "..." if len(user_prompt) > 50 else user_prompt,
-                    "request_id": request_id
-                }
+            task_store.create(task_id, {
+                "status": "pending",
+                "progress": 0,
+                "message": "Task created, waiting to start",
+                "timestamp": time.time(),
+                "prompt": user_prompt[:50] + "..." if len(user_prompt) > 50 else user_prompt,
+                "request_id": request_id,
+                **TASK_OWNER
+            })
             
-            # Start generation in a separate thread - ONLY ONE thread per request
-            thread = threading.Thread(
-                target=generate_picture,
-                args=(user_prompt, task_id),
-                daemon=True
-            )
-            thread.start()
+            # Hand the job to the worker pool; only a full queue is rejected.
+            # An identical request already in flight is reused instead
+            job = None
+            with inflight_lock:
+                existing = inflight_jobs.get(dedup_key) if dedup_key else None
+                if existing is not None:
+                    existing.waiters += 1
+                if existing is not None and existing.task_id:
+                    task_store.delete(task_id)
+                    task_id = existing.task_id
+                    cache_status = "inflight"
+                    print(f"Attaching request {request_id} to in-flight task {task_id}")
+                elif existing is not None:
+                    # A synchronous request's job: it keeps running even if that
+                    # client goes away, and its outcome is recorded on this task
+                    attached_tasks[task_id] = existing
+                    cache_status = "inflight"
+                    print(f"Attaching request {request_id} to in-flight job {existing.job_id}")
+                else:
+                    job = GenerationJob(
+                        args=(user_prompt, task_id),
+                        kwargs={"cache_key": cache_key, "image_metadata": image_metadata, **generation_kwargs},
+                        task_id=task_id,
+                        priority=priority
+                    )
+                    job.waiters = 1
+                    try:
+                        generation_queue.submit(job)
+                    except QueueFullError as e:
+                        task_store.delete(task_id)
+                        return queue_full_response(e)
+                    if dedup_key:
+                        inflight_jobs[dedup_key] = job
+                    cache_status = "miss" if cache_key else "disabled"
+            if job is not None and dedup_key:
+                track_inflight(dedup_key, job)
+            elif existing is not None and not existing.task_id:
+                update_task(task_id, {"status": "pending", "message": "Waiting for an identical in-flight generation"})
+                follow_job(existing, task_id)
+
+            queue_position = generation_queue.position(task_id)
             
             # Return only one task ID
-            return jsonify({
+            payload = {
                 "task_id": task_id,
                 "status": "processing",
-                "message": "Image generation started",
+                "message": "Image generation queued",
+                "queue_position": queue_position,
+                "cache": cache_status,
                 "progress_url": f"/progress/{task_id}",
+                "events_url": f"/events/{task_id}",
                 "result_url": f"/result/{task_id}",
                 "status_url": f"/status/{task_id}"
-            })
+            }
+            if "preview_every" in generation_kwargs:
+                payload["preview_url"] = f"/preview/{task_id}"
+            response = jsonify(payload)
+            response.headers['X-Cache'] = cache_status.upper()
+            return response
         else:
             # Run synchronously (the way test_service.py uses it)
-            # This is faster because it doesn't create multiple images
-            if generation_lock.acquire(blocking=False):
-                try:
-                    print(f"Starting synchronous image generation for request: {request_id}")
-                    image_path = generate_picture(user_prompt)
-                    print(f"Completed synchronous image generation for request: {request_id}")
-                    return send_file(image_path, mimetype='image/jpeg')
-                finally:
-                    generation_lock.release()
-            else:
-                print(f"⚠️ Could not acquire generation lock for synchronous request: {request_id}")
-                return jsonify({
-                    "error": "Image generation already in progress. Please try again after current generation completes.",
-                    "status": "busy"
-                }), 429
+            # The request waits in the same queue as async ones do
+            print(f"Starting synchronous image generation for request: {request_id}")
+            submitted = False
+            with inflight_lock:
+                job = inflight_jobs.get(dedup_key) if dedup_key else None
+                if job is not None:
+                    cache_status = "inflight"
+                    print(f"Attaching request {request_id} to in-flight job {job.job_id}")
+                else:
+                    job = GenerationJob(
+                        args=(user_prompt,),
+                        kwargs={"cache_key": cache_key, "image_metadata": image_metadata, **generation_kwargs},
+                        priority=priority
+                    )
+                    job.kwargs["cancel_key"] = job.job_id
+                    try:
+                        generation_queue.submit(job)
+                    except QueueFullError as e:
+                        return queue_full_response(e)
+                    if dedup_key:
+                        inflight_jobs[dedup_key] = job
+                    submitted = True
+                    cache_status = "miss" if cache_key else "disabled"
+                job.waiters += 1
+            if submitted and dedup_key:
+                track_inflight(dedup_key, job)
+
+            def respond(image_path):
+                print(f"Completed synchronous image generation for request: {request_id}")
+                image = image_store.get(os.path.basename(image_path))
+                if image is None:
+                    return jsonify({"error": "Generated image was not found"}), 500
+                response = Response(image.data, mimetype=image.mimetype)
+                response.set_etag(image.etag)
+                response.headers['X-Image-URL'] = f"/generated_samples/{image.name}"
+                response.headers['X-Cache'] = cache_status.upper()
+                return response
+
+            return finish_sync_request(job, job.kwargs.get("cancel_key", job.task_id), request_id, respond)
     except Exception as e:
         import traceback
         print(f"Error during generation: {e}")
@@ -514,6 +1857,252 @@ def generate():
         }), 500
 
 
+# Most images a single /generate_batch request may ask for
+MAX_BATCH_IMAGES = int(os.environ.get("JANUS_MAX_BATCH_IMAGES", "8"))
+
+@app.route('/generate_batch', methods=['POST', 'OPTIONS'])
+def generate_batch():
+    """
+    Generate several images as one batch, from a list of "prompts" or from one
+    "prompt" with a number of "variants". The images are decoded in the same
+    scheduler steps and VQ-decoded together. Async requests get one task per
+    image; with "async": false the images are returned as a zip archive.
+    """
+    if request.method == 'OPTIONS':
+        return app.make_default_options_response()
+    if draining.is_set():
+        return draining_response()
+
+    try:
+        data = request.get_json(silent=True)
+        if not data or ('prompts' not in data and 'prompt' not in data):
+            return jsonify({"error": "Missing 'prompts' or 'prompt' in request data."}), 400
+
+        if 'prompts' in data:
+            user_prompts = data['prompts']
+            if not isinstance(user_prompts, list) or not all(isinstance(p, str) and p for p in user_prompts):
+                return jsonify({"error": "'prompts' must be a list of non-empty strings"}), 400
+        else:
+            try:
+                variants = int(data.get('variants', 1))
+            except (TypeError, ValueError):
+                return jsonify({"error": "'variants' must be an integer"}), 400
+            user_prompts = [data['prompt']] * variants
+        if not 1 <= len(user_prompts) <= MAX_BATCH_IMAGES:
+            return jsonify({"error": f"A batch must have between 1 and {MAX_BATCH_IMAGES} images"}), 400
+
+        try:
+            generation_kwargs = parse_generation_options(data)
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+        # Variants of one prompt differ by seed: seed, seed + 1, ... (random without a seed)
+        base_seed = generation_kwargs.pop("seed")
+        seeds = [base_seed + index if base_seed is not None else None for index in range(len(user_prompts))]
+
+        request_id = request.headers.get('X-Request-ID', 'none')
+        priority = PRIORITIES.get(data.get('priority', 'interactive'), PRIORITY_INTERACTIVE)
+        image_metadata = {"user_id": data.get('userId'), "project_id": data.get('projectId')}
+        batch_id = str(uuid.uuid4())
+        print(f"Received batch generation request {batch_id} for {len(user_prompts)} image(s) (Request ID: {request_id})")
+
+        if data.get('async', True):
+            task_ids = [str(uuid.uuid4()) for _ in user_prompts]
+            for task_id, user_prompt in zip(task_ids, user_prompts):
+                task_store.create(task_id, {
+                    "status": "pending",
+                    "progress": 0,
+                    "message": "Task created, waiting to start",
+                    "timestamp": time.time(),
+                    "prompt": user_prompt[:50] + "..." if len(user_prompt) > 50 else user_prompt,
+                    "request_id": request_id,
+                    "batch_id": batch_id,
+                    **TASK_OWNER
+                })
+            try:
+                generation_queue.submit(GenerationJob(
+                    args=(user_prompts, task_ids),
+                    kwargs={"seeds": seeds, "image_metadata": image_metadata, **generation_kwargs},
+                    task_ids=task_ids,
+                    priority=priority,
+                    handler=run_batch_job
+                ))
+            except QueueFullError as e:
+                for task_id in task_ids:
+                    task_store.delete(task_id)
+                return queue_full_response(e)
+
+            return jsonify({
+                "batch_id": batch_id,
+                "status": "processing",
+                "message": f"Batch of {len(task_ids)} images queued",
+                "queue_position": generation_queue.position(task_ids[0]),
+                "task_ids": task_ids,
+                "tasks": [
+                    {
+                        "task_id": task_id,
+                        "progress_url": f"/progress/{task_id}",
+                        "events_url": f"/events/{task_id}",
+                        "result_url": f"/result/{task_id}",
+                        "status_url": f"/status/{task_id}",
+                        **({"preview_url": f"/preview/{task_id}"} if "preview_every" in generation_kwargs else {})
+                    }
+                    for task_id in task_ids
+                ]
+            })
+
+        job = GenerationJob(
+            args=(user_prompts,),
+            kwargs={"seeds": seeds, "image_metadata": image_metadata, **generation_kwargs},
+            priority=priority,
+            handler=run_batch_job
+        )
+        job.kwargs["cancel_key"] = job.job_id
+        job.waiters = 1
+        try:
+            generation_queue.submit(job)
+        except QueueFullError as e:
+            return queue_full_response(e)
+
+        def respond(image_paths):
+            # Encoded images are already compressed, so they are stored as is
+            archive = io.BytesIO()
+            with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_STORED) as zf:
+                for index, image_path in enumerate(image_paths):
+                    if image_path is None:
+                        continue  # Cancelled
+                    image = image_store.get(os.path.basename(image_path))
+                    if image is None:
+                        return jsonify({"error": "Generated image was not found"}), 500
+                    zf.writestr(f"image_{index}.{image.name.rpartition('.')[2]}", image.data)
+            print(f"Completed synchronous batch generation {batch_id}")
+            response = Response(archive.getvalue(), mimetype='application/zip')
+            response.headers['Content-Disposition'] = f'attachment; filename="batch_{batch_id}.zip"'
+            return response
+
+        return finish_sync_request(job, job.job_id, request_id, respond)
+    except Exception as e:
+        import traceback
+        print(f"Error during batch generation: {e}")
+        print(traceback.format_exc())
+        return jsonify({
+            "error": str(e),
+            "request_id": request.headers.get('X-Request-ID', 'none')
+        }), 500
+
+
+def cached_result_response(image_path: str, user_prompt: str, request_id: str, use_async: bool,
+                           image_metadata=None):
+    """
+    Answer /generate from the result cache. Async callers get a task that is
+    already completed so the usual progress/result flow keeps working.
+    """
+    with open(image_path, "rb") as f:
+        image = image_store.put(f.read(), image_path.rpartition(".")[2])
+    image_index.add(image.name, len(image.data), prompt=user_prompt, **(image_metadata or {}))
+
+    if not use_async:
+        response = Response(image.data, mimetype=image.mimetype)
+        response.set_etag(image.etag)
+        response.headers['X-Image-URL'] = f"/generated_samples/{image.name}"
+        response.headers['X-Cache'] = 'HIT'
+        return response
+
+    task_id = str(uuid.uuid4())
+    task_store.create(task_id, {
+        "status": "completed",
+        "progress": 100,
+        "message": "Image served from cache",
+        "timestamp": time.time(),
+        "prompt": user_prompt[:50] + "..." if len(user_prompt) > 50 else user_prompt,
+        "request_id": request_id,
+        "filename": image.name,
+        "path": image.path,
+        "cache": "hit"
+    })
+
+    response = jsonify({
+        "task_id": task_id,
+        "status": "completed",
+        "message": "Image served from cache",
+        "cache": "hit",
+        "progress_url": f"/progress/{task_id}",
+        "events_url": f"/events/{task_id}",
+        "result_url": f"/result/{task_id}",
+        "status_url": f"/status/{task_id}"
+    })
+    response.headers['X-Cache'] = 'HIT'
+    return response
+
+
+# Responses to synchronous requests whose generation was stopped, by reason;
+# 499 (client closed request) is only logged since nobody reads it
+CANCELLED_STATUS_CODES = {DEADLINE_EXCEEDED: 504, CLIENT_DISCONNECTED: 499}
+
+def cancelled_response(error, request_id: str):
+    """
+    Build the response of a synchronous request whose generation was
+    cancelled, ran past its deadline or lost its client.
+    """
+    reason = task_failure(error)["reason"]
+    print(f"Synchronous generation for request {request_id} stopped: {reason}")
+    return jsonify({
+        "error": "Image generation cancelled",
+        "reason": reason,
+        "request_id": request_id
+    }), CANCELLED_STATUS_CODES.get(reason, 409)
+
+
+# Retry-After sent with generation requests refused while draining
+DRAINING_RETRY_AFTER = 30
+
+def draining_response():
+    """Refuse a generation request while the service shuts down."""
+    response = jsonify({
+        "error": "The service is shutting down, retry on another instance",
+        "status": "draining"
+    })
+    response.headers['Retry-After'] = str(DRAINING_RETRY_AFTER)
+    return response, 503
+
+
+def queue_full_response(error: QueueFullError):
+    """Build the 429 response for a full generation queue."""
+    print(f"⚠️ {error}, rejecting request")
+    response = jsonify({
+        "error": "Image generation queue is full. Please try again later.",
+        "status": "busy",
+        "queued": error.depth
+    })
+    if error.retry_after is not None:
+        response.headers['Retry-After'] = str(max(1, int(error.retry_after)))
+    return response, 429
+
+
+def prepare_model():
+    """
+    Load the model, warm it up if enabled and mark the service ready,
+    recording how long each step took since the process started.
+    """
+    global startup_error
+    try:
+        load_model()
+        if (WARMUP_ENABLED or COMPILE_DECODE) and WORKER_PROCESSES == 0:
+            # Worker processes warm up their own scheduler after the fork
+            warmup_model()
+            record_startup("warmup", time.time() - PROCESS_START)
+    except Exception as e:
+        startup_error = str(e)
+        raise
+    record_startup("ready", time.time() - PROCESS_START)
+    model_ready.set()
+    print(f"Startup timings (seconds since process start): {STARTUP_TIMINGS}")
+    if IDLE_EVICT_SECONDS > 0 and WORKER_PROCESSES > 0:
+        print("⚠️ Idle eviction is disabled with worker processes, which share the model's weights")
+        model_residency.idle_seconds = 0
+    elif IDLE_EVICT_SECONDS > 0:
+        print(f"The model is freed after {IDLE_EVICT_SECONDS / 60:g} idle minutes")
+    model_residency.start()
+
 
 def preload_model_in_background():
     """
@@ -523,7 +2112,7 @@ def preload_model_in_background():
     def _preload():
         print("Preloading model in background...")
         try:
-            load_model()
+            prepare_model()
             print("✅ Model preloaded successfully!")
         except Exception as e:
             print(f"❌ Error preloading model: {e}")
@@ -533,8 +2122,22 @@ def preload_model_in_background():
     thread.start()
     return thread
 
+def start_backend():
+    """
+    Load the model and start generating: in worker processes sharing its
+    weights, or in this process while the HTTP server is already up.
+    """
+    if WORKER_PROCESSES > 0:
+        # Load before forking so every worker process shares the same weights
+        prepare_model()
+        start_worker_pool()
+    else:
+        # Start preloading model as soon as the server starts
+        preload_model_in_background()
+
+
 if __name__ == '__main__':
+    # Development server; see async_server.py for production serving
     print("Janus Image Generation service starting on port 9999...")
-    # Start preloading model as soon as the server starts
-    preload_thread = preload_model_in_background()
+    start_backend()
     app.run(host='0.0.0.0', port=9999, debug=False, threaded=True)
\ No newline at end of file
@@ -0,0 +1,174 @@
+"""
+CPU-ready model snapshots for fast service start.
+
+``load_model`` normally goes through ``VLChatProcessor.from_pretrained`` and
+``AutoModelForCausalLM.from_pretrained(trust_remote_code=True)``, patches the
+config for CPU and converts the weights, every time the service starts. A
+snapshot stores the result of all that once:
+
+  snapshot.json  model/config/processor classes, the patched config and the
+                 precision the weights were prepared for
+  model.pt       state dict (plus non-persistent buffers) in the torch zip
+                 format, loaded with ``mmap=True`` straight into a model built
+                 on the meta device, so no weights are copied or initialised
+  processor/     the processor's ``save_pretrained`` output
+
+Prepare one with:
+  python snapshot.py --output janus_snapshot --precision bf16
+and start the service with JANUS_SNAPSHOT=janus_snapshot.
+"""
+
+import argparse
+import importlib
+import json
+import os
+import time
+
+import torch
+
+SNAPSHOT_FORMAT_VERSION = 1
+METADATA_FILE = "snapshot.json"
+WEIGHTS_FILE = "model.pt"
+PROCESSOR_DIR = "processor"
+
+
+def _class_path(cls):
+    return f"{cls.__module__}:{cls.__qualname__}"
+
+
+def _import_class(path):
+    module, _, name = path.partition(":")
+    obj = importlib.import_module(module)
+    for part in name.split("."):
+        obj = getattr(obj, part)
+    return obj
+
+
+def read_metadata(directory):
+    """Return a snapshot's metadata, or None if ``directory`` holds no snapshot."""
+    try:
+        with open(os.path.join(directory, METADATA_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_snapshot(model, processor, directory, precision="fp32", vision_precision="fp32", source=None):
+    """
+    Write ``model`` (float weights, already in their final dtype) and
+    ``processor`` as a snapshot in ``directory``.
+
+    int8 models can not be stored as plain tensors; pass the float model with
+    ``precision="int8"`` and it is quantized when the snapshot is loaded.
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    persistent = model.state_dict()
+    buffers = {
+        name: buffer for name, buffer in model.named_buffers()
+        if name not in persistent
+    }
+    weights_path = os.path.join(directory, WEIGHTS_FILE)
+    torch.save({"state_dict": persistent, "buffers": buffers}, weights_path + ".tmp")
+    os.replace(weights_path + ".tmp", weights_path)
+
+    processor.save_pretrained(os.path.join(directory, PROCESSOR_DIR))
+
+    metadata = {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "source": source,
+        "created": time.time(),
+        "precision": precision,
+        "vision_precision": vision_precision,
+        "model_class": _class_path(type(model)),
+        "config_class": _class_path(type(model.config)),
+        "config": model.config.to_dict(),
+        "processor_class": _class_path(type(processor)),
+    }
+    with open(os.path.join(directory, METADATA_FILE), "w") as f:
+        json.dump(metadata, f, indent=2)
+    return metadata
+
+
+def _build_empty(model_class, config):
+    """Instantiate the model without allocating or initialising weights when possible."""
+    try:
+        with torch.device("meta"):
+            return model_class(config)
+    except Exception as e:
+        print(f"Could not build the model on the meta device ({e}), building it on the CPU")
+    try:
+        from transformers.modeling_utils import no_init_weights
+    except ImportError:
+        return model_class(config)
+    with no_init_weights():
+        return model_class(config)
+
+
+def _set_buffer(model, name, tensor):
+    module_name, _, attr = name.rpartition(".")
+    module = model.get_submodule(module_name) if module_name else model
+    module._buffers[attr] = tensor
+
+
+def load_snapshot(directory):
+    """
+    Load a snapshot written by ``save_snapshot``.
+    Returns (model, processor, metadata); the model is in eval mode.
+    """
+    from precision import apply_precision
+
+    metadata = read_metadata(directory)
+    if metadata is None:
+        raise FileNotFoundError(f"No model snapshot in {directory}")
+    if metadata.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+        raise ValueError(f"Unsupported snapshot format {metadata.get('format_version')} in {directory}")
+
+    config = _import_class(metadata["config_class"]).from_dict(metadata["config"])
+    model = _build_empty(_import_class(metadata["model_class"]), config)
+
+    saved = torch.load(os.path.join(directory, WEIGHTS_FILE), mmap=True, weights_only=True)
+    model.load_state_dict(saved["state_dict"], assign=True)
+    for name, buffer in saved["buffers"].items():
+        _set_buffer(model, name, buffer)
+
+    missing = [name for name, t in list(model.named_parameters()) + list(model.named_buffers()) if t.is_meta]
+    if missing:
+        raise ValueError(f"Snapshot in {directory} does not cover {', '.join(missing[:5])}")
+    model.eval()
+
+    if metadata["precision"] == "int8":
+        model = apply_precision(model, "int8", metadata["vision_precision"])
+
+    processor = _import_class(metadata["processor_class"]).from_pretrained(os.path.join(directory, PROCESSOR_DIR))
+    return model, processor, metadata
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", required=True, help="directory to write the snapshot to")
+    parser.add_argument("--precision", default=None, help="fp32, bf16 or int8 (default: JANUS_PRECISION)")
+    parser.add_argument("--vision-precision", default=None, help="fp32 or bf16 (default: JANUS_VISION_PRECISION)")
+    args = parser.parse_args()
+
+    import server
+
+    precision = args.precision or server.PRECISION
+    vision_precision = args.vision_precision or server.VISION_PRECISION
+
+    start = time.time()
+    # int8 weights are quantized at load time, so the snapshot keeps them in float32
+    server.load_model(precision="fp32" if precision == "int8" else precision, vision_precision=vision_precision)
+    print(f"Model loaded from {server.MODEL_PATH} in {time.time() - start:.1f}s, writing snapshot...")
+
+    start = time.time()
+    save_snapshot(
+        server.vl_gpt, server.vl_chat_processor, args.output,
+        precision=precision, vision_precision=vision_precision, source=server.MODEL_PATH,
+    )
+    print(f"Snapshot written to {os.path.abspath(args.output)} in {time.time() - start:.1f}s")
+    print(f"Start the service with JANUS_SNAPSHOT={args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -26,11 +26,31 @@ source venv/bin/activate
 # Always ensure dependencies are installed
 echo "Installing/updating dependencies..."
 pip install -U pip
-pip install flask flask-cors torch pillow transformers numpy
+pip install flask flask-cors aiohttp torch pillow transformers numpy
 
-# Start the service
+# Prepare the model snapshot once if JANUS_SNAPSHOT points to a directory without one,
+# so later starts memory-map it instead of running from_pretrained
+if [ -n "$JANUS_SNAPSHOT" ] && [ ! -f "$JANUS_SNAPSHOT/snapshot.json" ]; then
+    echo "Preparing model snapshot in $JANUS_SNAPSHOT..."
+    JANUS_SNAPSHOT= python3 snapshot.py --output "$JANUS_SNAPSHOT"
+fi
+
+# With JANUS_AUTOTUNE=1, measure the best thread/process layout once per host type
+# (see benchmarks/tune_threads.py); server.py applies it at startup
+TUNING_FILE="${JANUS_TUNING:-tuning.json}"
+if [ "$JANUS_AUTOTUNE" = "1" ] && ! python3 -c "import sys, cpu_tuning; sys.exit(cpu_tuning.read_tuning('$TUNING_FILE') is None)"; then
+    echo "Tuning the CPU thread layout for this host type..."
+    python3 benchmarks/tune_threads.py --output "$TUNING_FILE"
+fi
+
+# Start the service: the aiohttp server by default, Flask's development
+# server with JANUS_SERVER=flask
 echo "Launching server on port 9999..."
-python3 server.py
+if [ "$JANUS_SERVER" = "flask" ]; then
+    python3 server.py
+else
+    python3 async_server.py
+fi
 
 # Print message when the service stops
 echo "Janus Image Generation service has stopped."
\ No newline at end of file
@@ -0,0 +1,63 @@
+"""
+Publish/subscribe bus for task progress updates.
+
+Clients used to poll ``/progress/<task_id>`` in a loop, each poll copying
+the task record out of the task store. Subscribers instead get every update
+pushed to them as it happens (see the ``/events/<task_id>`` SSE endpoint).
+"""
+
+import queue
+import threading
+
+
+class TaskEventBus:
+    """
+    Fans out task snapshots to per-subscriber queues.
+
+    Every event is a full snapshot of the task record, so a slow subscriber
+    whose queue is full only loses intermediate snapshots: the oldest one is
+    dropped and the latest state is always delivered.
+    """
+
+    def __init__(self, max_queued: int = 16):
+        self.max_queued = max_queued
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, task_id, subscriber=None) -> queue.Queue:
+        """
+        Return a queue that receives the snapshots published for task_id. A
+        custom subscriber needs queue.Queue's put_nowait and get_nowait.
+        """
+        if subscriber is None:
+            subscriber = queue.Queue(maxsize=self.max_queued)
+        with self._lock:
+            self._subscribers.setdefault(task_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, task_id, subscriber: queue.Queue):
+        with self._lock:
+            subscribers = self._subscribers.get(task_id)
+            if subscribers is None:
+                return
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._subscribers[task_id]
+
+    def publish(self, task_id, snapshot: dict):
+        with self._lock:
+            subscribers = list(self._subscribers.get(task_id, ()))
+        for subscriber in subscribers:
+            while True:
+                try:
+                    subscriber.put_nowait(snapshot)
+                    break
+                except queue.Full:
+                    try:
+                        subscriber.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
@@ -0,0 +1,239 @@
+"""
+Store of generation task records, with eviction of finished tasks.
+
+Every /generate used to add an entry to a module-level dict that was never
+removed, so a long running service kept every task it had ever seen. Task
+records now live in a task store:
+
+- once a task reaches a terminal status its record is compacted, dropping
+  the fields that only matter while it runs;
+- finished tasks are evicted once they are older than a TTL and, oldest
+  first, beyond a maximum count. Unfinished tasks are never evicted.
+
+Two backends share the same interface:
+
+- MemoryTaskStore keeps the records in this process;
+- SQLiteTaskStore keeps them in a SQLite database file that several server
+  processes on the host read and write, so any of them behind a load
+  balancer can answer polls for a task another one is generating. Only the
+  records are shared; the task's job stays with the process running it.
+"""
+
+import collections
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from metrics import TASKS_EVICTED
+
+# Statuses a task does not leave again
+TERMINAL_STATUSES = ("completed", "failed", "cancelled")
+
+# Fields dropped from a record once its task is finished
+TRANSIENT_FIELDS = ("tokens_generated", "tokens_total", "preview_step", "preview_url", "preview_seconds")
+
+
+def compact(record: dict) -> dict:
+    """Drop the fields a finished task's record no longer needs."""
+    for field in TRANSIENT_FIELDS:
+        record.pop(field, None)
+    return record
+
+
+class MemoryTaskStore:
+    """
+    Task records in this process. ``lock`` guards the records, by default a
+    plain threading.Lock.
+    """
+
+    shared = False
+
+    def __init__(self, ttl: float = 86400, max_finished: int = 10000, lock=None):
+        self.ttl = ttl
+        self.max_finished = max_finished
+        self._records = {}
+        self._finished = collections.OrderedDict()  # task id -> finish time, oldest first
+        self._lock = lock if lock is not None else threading.Lock()
+
+    def get(self, task_id):
+        """Return a copy of a task's record, or None if there is none."""
+        with self._lock:
+            record = self._records.get(task_id)
+            return dict(record) if record is not None else None
+
+    def create(self, task_id, record: dict):
+        """Add (or replace) a task's record."""
+        now = time.time()
+        with self._lock:
+            self._records[task_id] = dict(record)
+            self._finished.pop(task_id, None)
+            if record.get("status") in TERMINAL_STATUSES:
+                compact(self._records[task_id])
+                self._finished[task_id] = now
+            self._evict(now)
+
+    def update(self, task_id, fields: dict, unless_finished: bool = False):
+        """
+        Merge fields into a task's record and return a copy of the new
+        record. A task without a record, never created or already evicted or
+        deleted, is left alone and None is returned; records are only made by
+        ``create``. With unless_finished, so is a finished task.
+        """
+        now = time.time()
+        with self._lock:
+            record = self._records.get(task_id)
+            if record is None or (task_id in self._finished and unless_finished):
+                return None
+            record.update(fields)
+            if record.get("status") in TERMINAL_STATUSES and task_id not in self._finished:
+                compact(record)
+                self._finished[task_id] = now
+                self._evict(now)
+            return dict(record)
+
+    def delete(self, task_id):
+        with self._lock:
+            self._records.pop(task_id, None)
+            self._finished.pop(task_id, None)
+
+    def __len__(self):
+        return len(self._records)
+
+    def _evict(self, now):
+        while self._finished:
+            task_id, finished_at = next(iter(self._finished.items()))
+            if finished_at >= now - self.ttl and (not self.max_finished or len(self._finished) <= self.max_finished):
+                break
+            reason = "ttl" if finished_at < now - self.ttl else "size"
+            del self._finished[task_id]
+            del self._records[task_id]
+            TASKS_EVICTED.labels(reason).inc()
+
+
+class SQLiteTaskStore:
+    """
+    Task records in a SQLite database at ``path``, shared by every process
+    opening it. Each thread uses its own connection; writes are serialized
+    by SQLite, and eviction runs at most every ``evict_interval`` seconds.
+    """
+
+    shared = True
+
+    def __init__(self, path: str, ttl: float = 86400, max_finished: int = 10000, evict_interval: float = 10.0):
+        self.path = path
+        self.ttl = ttl
+        self.max_finished = max_finished
+        self.evict_interval = evict_interval
+        self._local = threading.local()
+        self._last_evict = 0.0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._transaction() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS tasks "
+                "(task_id TEXT PRIMARY KEY, record TEXT NOT NULL, finished_at REAL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS tasks_finished_at ON tasks (finished_at)")
+
+    def _connection(self):
+        # Connections must not cross a fork, so they are keyed by process too
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def get(self, task_id):
+        """Return a copy of a task's record, or None if there is none."""
+        row = self._connection().execute("SELECT record FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def create(self, task_id, record: dict):
+        """Add (or replace) a task's record."""
+        now = time.time()
+        finished_at = None
+        if record.get("status") in TERMINAL_STATUSES:
+            record, finished_at = compact(dict(record)), now
+        with self._transaction() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO tasks (task_id, record, finished_at) VALUES (?, ?, ?)",
+                (task_id, json.dumps(record, separators=(",", ":")), finished_at)
+            )
+            self._maybe_evict(db, now)
+
+    def update(self, task_id, fields: dict, unless_finished: bool = False):
+        """
+        Merge fields into a task's record and return a copy of the new
+        record. A task without a record, never created or already evicted or
+        deleted, is left alone and None is returned; records are only made by
+        ``create``. With unless_finished, so is a finished task.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute("SELECT record, finished_at FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+            if row is None:
+                return None
+            record, finished_at = json.loads(row[0]), row[1]
+            if finished_at is not None and unless_finished:
+                return None
+            record.update(fields)
+            if record.get("status") in TERMINAL_STATUSES and finished_at is None:
+                compact(record)
+                finished_at = now
+            db.execute(
+                "INSERT OR REPLACE INTO tasks (task_id, record, finished_at) VALUES (?, ?, ?)",
+                (task_id, json.dumps(record, separators=(",", ":")), finished_at)
+            )
+            self._maybe_evict(db, now)
+        return record
+
+    def delete(self, task_id):
+        with self._transaction() as db:
+            db.execute("DELETE FROM tasks WHERE task_id = ?", (task_id,))
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+
+    def _maybe_evict(self, db, now):
+        if now - self._last_evict < self.evict_interval:
+            return
+        self._last_evict = now
+        expired = db.execute("DELETE FROM tasks WHERE finished_at < ?", (now - self.ttl,)).rowcount
+        if expired:
+            TASKS_EVICTED.labels("ttl").inc(expired)
+        if self.max_finished:
+            excess = db.execute(
+                "DELETE FROM tasks WHERE task_id IN (SELECT task_id FROM tasks WHERE finished_at IS NOT NULL "
+                "ORDER BY finished_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_finished,)
+            ).rowcount
+            if excess:
+                TASKS_EVICTED.labels("size").inc(excess)
+
+
+def open_task_store(backend: str, path: str = None, ttl: float = 86400, max_finished: int = 10000, lock=None):
+    """
+    Create the task store of a backend name: "memory" or "sqlite" (with the
+    database at ``path``). Raises ValueError for unknown backends.
+    """
+    if backend == "memory":
+        return MemoryTaskStore(ttl=ttl, max_finished=max_finished, lock=lock)
+    if backend == "sqlite":
+        return SQLiteTaskStore(path, ttl=ttl, max_finished=max_finished)
+    raise ValueError(f"Unknown task store '{backend}', expected memory or sqlite")
@@ -2,6 +2,7 @@
 """
 Test script for the Janus image generation service.
 This script sends a test request to the service and saves the response.
+For behavior under concurrent load, see benchmarks/load_test.py.
 
 Usage:
   python test_service.py "A detailed technical drawing of a drone with propellers"
@@ -0,0 +1,231 @@
+"""
+Multi-process generation workers that share one copy of the model weights.
+
+A single service process is limited to one batch scheduler and to the GIL.
+Starting several service copies would duplicate the model in RAM. Instead, the
+parent loads the model once and then forks N worker processes: fork shares
+every page copy-on-write, and since inference never writes to the weights,
+each worker only adds its own activations, KV caches and Python heap.
+
+The parent sends jobs over a multiprocessing queue. Workers report progress
+updates and results on an event queue that a reader thread in the parent
+drains.
+"""
+
+import gc
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+import uuid
+
+from cancellation import is_cancellation
+from cpu_tuning import apply_thread_settings
+
+
+class WorkerError(Exception):
+    """
+    Raised in the parent when a job failed inside a worker process. ``kind``
+    is the class name of the exception raised in the worker, if any.
+    """
+
+    def __init__(self, message, kind=None):
+        super().__init__(message)
+        self.kind = kind
+
+
+def _worker_main(index, handler, tasks, events, jobs_per_process, threads_per_process, cpus, on_start,
+                 reporter, report_interval, messages, on_message):
+    """Entry point of a worker process."""
+    import torch
+
+    apply_thread_settings(threads_per_process, cpus=cpus)
+    if on_start is not None:
+        on_start(lambda task_id, fields: events.put(("update", None, (task_id, fields))))
+    pinned = f", pinned to CPUs {cpus}" if cpus else ""
+    print(f"Worker process {index} (pid {os.getpid()}) ready with {torch.get_num_threads()} threads{pinned}")
+
+    def run_jobs():
+        while True:
+            job_id, args, kwargs = tasks.get()
+            events.put(("started", job_id, os.getpid()))
+            try:
+                result = handler(*args, **kwargs)
+            except Exception as e:
+                if not is_cancellation(e):
+                    traceback.print_exc()
+                events.put(("error", job_id, (type(e).__name__, f"{type(e).__name__}: {e}")))
+            else:
+                events.put(("done", job_id, result))
+
+    def report():
+        while True:
+            time.sleep(report_interval)
+            try:
+                events.put(("report", None, (os.getpid(), reporter())))
+            except Exception as e:
+                print(f"Worker process {index} could not send its report: {e}")
+
+    def receive():
+        while True:
+            message = messages.get()
+            try:
+                on_message(message)
+            except Exception as e:
+                print(f"Worker process {index} could not handle message {message!r}: {e}")
+
+    # Several jobs per process so the process' batch scheduler has something to batch
+    threads = [threading.Thread(target=run_jobs, daemon=True) for _ in range(jobs_per_process)]
+    if reporter is not None:
+        threading.Thread(target=report, daemon=True).start()
+    if on_message is not None:
+        threading.Thread(target=receive, daemon=True).start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+class _PendingJob:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.pid = None
+
+
+class ProcessWorkerPool:
+    """
+    Runs ``handler(*args, **kwargs)`` in forked worker processes.
+
+    Must be created after the model has been loaded and before the process
+    starts other threads that could hold locks at fork time. ``on_start`` is
+    called in each worker with a function that forwards task updates to the
+    parent, where they are passed to ``on_update(task_id, fields)``. Every
+    ``report_interval`` seconds each worker sends ``reporter()`` to the
+    parent's ``on_report(pid, report)``. Messages passed to ``broadcast`` are
+    handed to ``on_message(message)`` in every worker. ``cpu_sets``, if
+    given, holds the CPUs each worker process is pinned to (see cpu_tuning).
+    """
+
+    def __init__(self, handler, num_processes, jobs_per_process=1, threads_per_process=None,
+                 on_start=None, on_update=None, reporter=None, on_report=None, report_interval=5.0,
+                 on_message=None, cpu_sets=None):
+        self.handler = handler
+        self.num_processes = num_processes
+        self.jobs_per_process = jobs_per_process
+        self.threads_per_process = threads_per_process
+        self.cpu_sets = cpu_sets
+        self.on_start = on_start
+        self.on_update = on_update
+        self.reporter = reporter
+        self.on_report = on_report
+        self.report_interval = report_interval
+        self.on_message = on_message
+
+        self._context = multiprocessing.get_context("fork")
+        self._tasks = self._context.Queue()
+        self._events = self._context.Queue()
+        self._pending = {}
+        self._messages = [None] * num_processes  # Per-process broadcast queues
+        self._lock = threading.Lock()
+
+        # Keep the garbage collector from touching (and so copying) every
+        # object page inherited from the parent
+        gc.freeze()
+        self._processes = [self._start_process(index) for index in range(num_processes)]
+
+        self._reader = threading.Thread(target=self._read_events, name="worker-pool-events", daemon=True)
+        self._reader.start()
+
+    def run(self, *args, **kwargs):
+        """Run a job in one of the worker processes and return its result."""
+        job_id = str(uuid.uuid4())
+        pending = _PendingJob()
+        with self._lock:
+            self._pending[job_id] = pending
+        self._tasks.put((job_id, args, kwargs))
+
+        pending.done.wait()
+        if pending.error is not None:
+            kind, message = pending.error
+            raise WorkerError(message, kind)
+        return pending.result
+
+    def broadcast(self, message):
+        """Send a message to every worker process' ``on_message``."""
+        for messages in self._messages:
+            if messages is not None:
+                messages.put(message)
+
+    def stats(self):
+        """Return the number of live worker processes and jobs in flight."""
+        with self._lock:
+            return {
+                "processes": sum(1 for process in self._processes if process.is_alive()),
+                "jobs_in_flight": len(self._pending),
+            }
+
+    def _start_process(self, index):
+        self._messages[index] = self._context.Queue()
+        process = self._context.Process(
+            target=_worker_main,
+            args=(index, self.handler, self._tasks, self._events, self.jobs_per_process,
+                  self.threads_per_process, self.cpu_sets[index] if self.cpu_sets else None,
+                  self.on_start, self.reporter, self.report_interval, self._messages[index], self.on_message),
+            name=f"generation-worker-process-{index}",
+            daemon=True,
+        )
+        process.start()
+        return process
+
+    def _read_events(self):
+        while True:
+            try:
+                kind, job_id, payload = self._events.get(timeout=1.0)
+            except queue.Empty:
+                self._check_processes()
+                continue
+
+            if kind == "update":
+                if self.on_update is not None:
+                    try:
+                        self.on_update(*payload)
+                    except Exception as e:
+                        print(f"Task update from worker failed: {e}")
+                continue
+            if kind == "report":
+                if self.on_report is not None:
+                    self.on_report(*payload)
+                continue
+
+            with self._lock:
+                pending = self._pending.get(job_id)
+                if pending is None:
+                    continue
+                if kind == "started":
+                    pending.pid = payload
+                    continue
+                del self._pending[job_id]
+
+            if kind == "done":
+                pending.result = payload
+            else:
+                pending.error = payload
+            pending.done.set()
+
+    def _check_processes(self):
+        """Fail the jobs of crashed workers and replace the dead processes."""
+        for index, process in enumerate(self._processes):
+            if process.is_alive():
+                continue
+            print(f"⚠️ Worker process {index} (pid {process.pid}) exited with code {process.exitcode}, restarting")
+            with self._lock:
+                lost = [job_id for job_id, pending in self._pending.items() if pending.pid == process.pid]
+                for job_id in lost:
+                    pending = self._pending.pop(job_id)
+                    pending.error = (None, f"Worker process exited with code {process.exitcode}")
+                    pending.done.set()
+            self._processes[index] = self._start_process(index)